@@ -19,7 +19,7 @@ warnings.simplefilter('ignore', UserWarning)
 
 
 def quick_setup(qubit_list, connectivity_dic=None, rng=None, *, seed=None,
-                **kwargs):
+                streams=None, **kwargs):
     """
     Quick setup: a function to return a setup that may be immediately
     used to make a qsoverlay builder.
@@ -85,7 +85,8 @@ def quick_setup(qubit_list, connectivity_dic=None, rng=None, *, seed=None,
                 in the resonator. None=off.
                 Note - turning this on
                 will require a circuit be repeatedly simulated
-                to acquire good statistics of this noise.
+                to acquire good statistics of this noise
+                (see flux_monte_carlo.run_flux_monte_carlo).
                 (arXiv:1703.04136 App.B.5 final
                  equation.)
     high_frequency(=False): Whether this qubit
@@ -106,6 +107,11 @@ def quick_setup(qubit_list, connectivity_dic=None, rng=None, *, seed=None,
                 in the reset itself).
     sampler(=None): sampler to generate measurement results.
     rng(=None): seed to generate new sampler if the above is None.
+    streams(=None): a RandomStreams to take the random numbers for
+                the sampler and the quasistatic flux of every qubit
+                from (from the streams ('sampler', qubit) and
+                ('quasistatic_flux', qubit)), instead of rng and
+                the global numpy generator.
     readout_error(=0.005): readout error in a sampler if the
                 above is None
                 (epsilon_{RO}^0=epsilon_{RO}^1 in
@@ -115,14 +121,15 @@ def quick_setup(qubit_list, connectivity_dic=None, rng=None, *, seed=None,
         warnings.warn('`seed` keyword argument is deprecated,'
                       ' please use `rng`', DeprecationWarning)
         rng = seed
-    if 'sampler' not in kwargs.keys():
+    if 'sampler' not in kwargs.keys() and streams is None:
         kwargs['state'] = _ensure_rng(rng)
 
     setup = {
         'gate_dic': get_gate_dic(),
         'update_rules': get_update_rules(**kwargs),
         'qubit_dic': {
-            q: get_qubit(**kwargs) for q in qubit_list
+            q: get_qubit(**kwargs, **qubit_streams(streams, q, kwargs))
+            for q in qubit_list
         }
     }
 
@@ -140,7 +147,7 @@ def quick_setup(qubit_list, connectivity_dic=None, rng=None, *, seed=None,
 def asymmetric_setup(qubit_parameters=None,
                      connectivity_dic=None,
                      rng=None,
-                     *, seed=None, **kwargs):
+                     *, seed=None, streams=None, **kwargs):
     """
     Prepares a setup for asymmetric qubits that may be immediately used to make
     a qsoverlay builder
@@ -153,6 +160,9 @@ def asymmetric_setup(qubit_parameters=None,
     [['q1', 'q2', .., 'qn'],[{'t1': value, 't2': value, ...},
     {'t1': value, 't2: value, ...}, ..., {'t1': value, 't2': value, ...}]]
     Unspecified parameters will take the default values from get_qubit function
+
+    streams: a RandomStreams for the samplers and quasistatic
+    flux of the qubits (see quick_setup).
     """
     if qubit_parameters is None:
         qubit_parameters = {}
@@ -165,14 +175,15 @@ def asymmetric_setup(qubit_parameters=None,
         warnings.warn('`seed` keyword argument is deprecated,'
                       ' please use `rng`', DeprecationWarning)
         rng = seed
-    if 'sampler' not in kwargs.keys():
+    if 'sampler' not in kwargs.keys() and streams is None:
         kwargs['state'] = _ensure_rng(rng)
 
     qubit_list = qubit_parameters.keys()
     asym_setup = {
         'gate_dic': get_gate_dic(),
         'update_rules': get_update_rules(**kwargs),
-        'qubit_dic': {q: get_qubit(**params)
+        'qubit_dic': {q: get_qubit(**params,
+                                   **qubit_streams(streams, q, params))
                       for q, params in qubit_parameters.items()}
     }
     if connectivity_dic:
@@ -187,6 +198,21 @@ def asymmetric_setup(qubit_parameters=None,
     return Setup(**asym_setup)
 
 
+def qubit_streams(streams, qubit, params):
+    """
+    Returns the keyword arguments for get_qubit that take the random
+    numbers of a qubit from a RandomStreams (or nothing if streams
+    is None).
+    """
+    if streams is None:
+        return {}
+    qubit_kwargs = {'flux_state': streams.random_state('quasistatic_flux',
+                                                       qubit)}
+    if 'sampler' not in params:
+        qubit_kwargs['state'] = streams.random_state('sampler', qubit)
+    return qubit_kwargs
+
+
 def get_gate_dic():
     """
     Returns the set of gates allowed on DiCarlo qubits.
@@ -259,6 +285,7 @@ def get_qubit(noise_flag=True,
               state=None,
               sampler=None,
               readout_error=0.005,
+              flux_state=None,
               **kwargs):
     """
     The dictionary for parameters of the DiCarlo qubits, with standard
@@ -267,6 +294,9 @@ def get_qubit(noise_flag=True,
     This is a bit messy right now, but has the advantage of telling
     the user which parameters they can set. Not sure how to improve
     over this.
+
+    flux_state: the numpy RandomState to draw the quasistatic flux
+    from (by default the global numpy generator).
     """
     if sampler is None:
         if noise_flag is True:
@@ -276,8 +306,10 @@ def get_qubit(noise_flag=True,
             readout_error = 0
             sampler = uniform_sampler(state=state)
 
+    if flux_state is None:
+        flux_state = np.random
     if static_flux_std is not None:
-        quasistatic_flux = static_flux_std * np.random.randn()
+        quasistatic_flux = static_flux_std * flux_state.randn()
     else:
         quasistatic_flux = None
 
@@ -306,6 +338,7 @@ def get_qubit(noise_flag=True,
             'kappa': kappa,
             'chi': chi,
             'quasistatic_flux': quasistatic_flux,
+            'static_flux_std': static_flux_std,
             'high_frequency': high_frequency,
             'sampler': sampler,
             'readout_error': readout_error,
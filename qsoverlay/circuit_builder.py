@@ -6,11 +6,44 @@ of at what time the next gate can be executed.
 Does not do any compilation; this should possibly be inserted later.
 """
 
+import copy
 import numpy as np
+from numpy import pi
 import quantumsim.circuit
 import quantumsim.ptm
+from .circuit_passes import _classical_kws, fuse_single_qubit_gates
+from .gate_functions import (
+    copy_gate, insert_CZ, insert_CPhase, insert_measurement, insert_reset)
+from .parameters import (
+    ParameterTable, as_parameter, is_symbolic, negate_symbolic)
+from .qasm_reader import QasmReader, BARRIER
 from .update_functions import update_function_dic
 
+# Gates that the frame of a qubit commutes with, gates that reset
+# the frame, and rotations that absorb the frame (see virtual_z).
+_diagonal_functions = (
+    insert_CZ, insert_CPhase, quantumsim.circuit.CPhase,
+    quantumsim.circuit.NoisyCPhase, quantumsim.circuit.CPhaseRotation)
+_frame_reset_functions = (
+    insert_measurement, insert_reset, quantumsim.circuit.ResetGate,
+    quantumsim.circuit.Measurement)
+_rotation_functions = (
+    quantumsim.circuit.RotateX, quantumsim.circuit.RotateY,
+    quantumsim.circuit.RotateXY, quantumsim.circuit.RotateEuler)
+# Rotations whose noise parameters can be changed in place
+# (see drift_models.refresh_gate).
+_noise_rotations = (
+    quantumsim.circuit.RotateX, quantumsim.circuit.RotateY,
+    quantumsim.circuit.RotateXY, quantumsim.circuit.RotateZ)
+
+
+def classical_bits(kwargs):
+    '''
+    Returns the classical bits named in the arguments of a gate.
+    '''
+    return tuple(kwargs[kw] for kw in _classical_kws
+                 if kwargs.get(kw) is not None)
+
 
 class Builder:
 
@@ -20,6 +53,8 @@ class Builder:
                  gate_dic=None,
                  gate_set=None,
                  update_rules=None,
+                 schedule='asap',
+                 virtual_z=False,
                  **kwargs):
         '''
         qubit_dic: list of the qubits in the system.
@@ -37,10 +72,21 @@ class Builder:
             along with the qubits it is performed between.
         update_rules: a set of rules for updating the system.
             (i.e. between experiments).
+        schedule: the scheduling policy applied when the circuit
+            is finalized (see Builder.reschedule); one of 'asap',
+            'alap' or 'balanced'.
+        virtual_z: if True, Z rotations are not inserted as gates, but
+            tracked in a frame for every qubit and absorbed in later
+            gates (see Builder._update_frame). Any remaining frames
+            are applied as noiseless Z rotations when finalizing.
 
         kwargs: Can add t1 and t2 via the kwargs instead of
             passing them with the qubit_dic.
         '''
+        # The dispatch table holds one precompiled record per gate
+        # instance, and is emptied whenever the setup is replaced.
+        self._dispatch = {}
+
         if setup is not None:
             self.qubit_dic = setup.qubit_dic
             self.gate_dic = setup.gate_dic
@@ -53,8 +99,139 @@ class Builder:
             self.update_rules = update_rules or []
 
         self.save_flag = True
+        self.schedule = schedule
+        self.virtual_z = virtual_z
         self.new_circuit(**kwargs)
 
+    @property
+    def qubit_dic(self):
+        return self._qubit_dic
+
+    @qubit_dic.setter
+    def qubit_dic(self, qubit_dic):
+        self._qubit_dic = qubit_dic
+        self.invalidate_dispatch()
+
+    @property
+    def gate_dic(self):
+        return self._gate_dic
+
+    @gate_dic.setter
+    def gate_dic(self, gate_dic):
+        self._gate_dic = gate_dic
+        self.invalidate_dispatch()
+
+    @property
+    def gate_set(self):
+        return self._gate_set
+
+    @gate_set.setter
+    def gate_set(self, gate_set):
+        self._gate_set = gate_set
+        self.invalidate_dispatch()
+
+    def invalidate_dispatch(self):
+        '''
+        Forget all precompiled gate records. This happens automatically
+        when qubit_dic, gate_dic or gate_set are replaced, but needs to
+        be called by hand if any of these are edited in place.
+        '''
+        self._dispatch = {}
+        self._frame_records = {}
+
+    def get_dispatch(self, gate_tuple):
+        '''
+        Returns the dispatch record for a gate instance
+        (gate_name, qubit0, ...), compiling it from the
+        gate_set and gate_dic on first use.
+
+        The record contains everything add_gate would otherwise
+        recalculate for every gate:
+            - function: the template function to call
+            - kind: 'string', 'gate' (a quantumsim.circuit.Gate
+                subclass) or 'builder' (a callback taking the builder)
+            - circuit_args: static arguments for the gate, with
+                the qubit keywords (bit or bit0, bit1, ..) included.
+            - gate_time and time_offset: the length of the gate,
+                and the offset of the gate in its time window.
+            - time_flag: whether the gate set fixes the time itself.
+            - composite: whether the gate is decomposed into other
+                gates by its function.
+            - parameter_kws: the user keywords that can take symbolic
+                parameters (by default, all but output bits).
+            - noise_params: the noise parameters of the qubit that
+                the gate depends on and the update rules change
+                (see register_noise_gate).
+        '''
+        try:
+            return self._dispatch[gate_tuple]
+        except KeyError:
+            pass
+
+        gate_name = gate_tuple[0]
+        qubit_list = gate_tuple[1:]
+        circuit_args, builder_args = self.gate_set[gate_tuple]
+        template = self.gate_dic[gate_name]
+        function = template['function']
+
+        if isinstance(function, str):
+            kind = 'string'
+        elif isinstance(function, type) and\
+                issubclass(function, quantumsim.circuit.Gate):
+            kind = 'gate'
+        else:
+            kind = 'builder'
+
+        # Add qubits to the kwargs as appropriate.
+        # Note that we do *not* add classical bits here.
+        if len(qubit_list) == 1:
+            qubit_kwargs = {'bit': qubit_list[0]}
+        else:
+            qubit_kwargs = {'bit'+str(j): qubit
+                            for j, qubit in enumerate(qubit_list)}
+
+        gate_time = builder_args['gate_time']
+        if 'exec_time' in builder_args:
+            time_offset = builder_args['exec_time']
+        else:
+            # If we have no exec time, assume the gate occurs in the
+            # middle of the time window allocated.
+            time_offset = gate_time / 2
+
+        if function in _noise_rotations:
+            # Only parameters that an update rule changes are
+            # registered, as every registered gate is copied when
+            # a fork refreshes it.
+            updated = self._updated_noise_params()
+            noise_params = [
+                param for kw, param in template['circuit_args'].items()
+                if kw == param and (updated is None or param in updated)]
+        else:
+            noise_params = []
+
+        record = {
+            'name': gate_name,
+            'qubits': qubit_list,
+            'function': function,
+            'kind': kind,
+            'num_qubits': template['num_qubits'],
+            'user_kws': template['user_kws'],
+            'circuit_args': {**circuit_args, **qubit_kwargs},
+            'qubit_kwargs': qubit_kwargs,
+            'gate_time': gate_time,
+            'time_offset': time_offset,
+            'time_flag': 'time' in circuit_args,
+            # Composite gates (builder callbacks that take no time
+            # themselves) are decomposed and fed back to the builder.
+            'composite': kind == 'builder' and gate_time == 0,
+            'parameter_kws': template.get('parameter_kws', [
+                kw for kw in template['user_kws']
+                if kw not in ('output_bit', 'real_output_bit')]),
+            'noise_params': noise_params
+        }
+        self._dispatch[gate_tuple] = record
+        return record
+
     def new_circuit(self, circuit_title='New Circuit', **kwargs):
 
         '''
@@ -66,9 +243,48 @@ class Builder:
         # Update the circuit list
         self.circuit_list = []
 
+        # The operations log stores every gate scheduled by the
+        # builder, with the quantumsim gates it added, so that
+        # the circuit can be rescheduled later. Each entry is
+        # [qubits, asap start, gate time, group, gates, start, fixed],
+        # where qubits includes the classical bits the gate writes or
+        # reads, group labels gates that must start simultaneously,
+        # and fixed marks gates with a time fixed by the user.
+        self._ops = []
+        self._group = None
+        self._num_groups = 0
+
+        # The gates depending on symbolic parameters
+        self.parameters = ParameterTable()
+
+        # Gates returned to the user for adjusting
+        self._adjustable_gates = []
+
+        # The gates depending on a noise parameter of a qubit, as
+        # {(parameter, qubit): [gates]}, for the update rules.
+        self.noise_gates = {}
+
+        # The values of the noise parameters that the noise gates
+        # were last updated to (see drift_models.DriftRule).
+        self.noise_values = {}
+
         # Times stores the current time of every qubit (beginning at 0)
         self.times = {}
 
+        # The time every classical bit is last written or read
+        # (see classical_bits), so that gates using a bit stay in order.
+        self._bit_times = {}
+
+        # The frame phase of every qubit (see virtual_z)
+        self.frames = {}
+
+        # Whether the circuit is shared with a fork (see fork), the
+        # ids of the gates this builder copied from shared gates since
+        # it last forked, and whether any gates might be shared at all.
+        self._shared = False
+        self._owned = set()
+        self._has_forks = False
+
         # Make qubits
         for qubit, qubit_args in sorted(self.qubit_dic.items()):
 
@@ -93,6 +309,115 @@ class Builder:
 
             # Initialise the time of the latest gate on each qubit to 0
             self.times[qubit] = 0
+            self.frames[qubit] = 0
+
+    def fork(self):
+        '''
+        Returns a new builder continuing from the current state of
+        this one, so that circuits sharing a prefix only need to
+        build the prefix once.
+
+        The fork shares the circuit (including its gates), times and
+        circuit list with this builder, until either of them adds
+        another gate; then that builder takes its own copy of the
+        lists (but not of the gates in them). Gates are only copied
+        when a builder first changes them: when binding parameters
+        (see ParameterTable.bind), when an update rule changes a noise
+        gate (see claim_noise_gates), when rescheduling moves a gate,
+        or when the user adjusts a returned gate with adjust_gate
+        (adjusting a returned gate directly changes every builder
+        sharing it).
+        Measurements stay shared, and record the results of both
+        circuits.
+        '''
+        fork = copy.copy(self)
+        fork.parameters = self.parameters.fork()
+        fork.noise_values = self.noise_values.copy()
+        self.parameters.claim = self._own_gates
+        fork.parameters.claim = fork._own_gates
+        self._owned = set()
+        fork._owned = set()
+        self._shared = fork._shared = True
+        self._has_forks = fork._has_forks = True
+        return fork
+
+    def _materialize(self):
+        '''
+        Gives the builder its own copy of any state shared with
+        a fork, before changing it.
+        '''
+        if not self._shared:
+            return
+        self._shared = False
+
+        circuit = quantumsim.circuit.Circuit(self.circuit.title)
+        circuit.qubits = list(self.circuit.qubits)
+        circuit.gates = list(self.circuit.gates)
+        self.circuit = circuit
+
+        # The entries of the operations log are only changed when
+        # rescheduling, which copies them first.
+        self._ops = list(self._ops)
+        self.circuit_list = list(self.circuit_list)
+        self._adjustable_gates = list(self._adjustable_gates)
+        self.noise_gates = {key: list(gates)
+                            for key, gates in self.noise_gates.items()}
+        self.times = dict(self.times)
+        self._bit_times = dict(self._bit_times)
+        self.frames = dict(self.frames)
+
+    def _own_gates(self, gates):
+        '''
+        Returns the gates, with every gate that may be shared with
+        a fork replaced by a copy (in the circuit and in every record
+        of the builder), so that they can be changed in place.
+        '''
+        if not self._has_forks:
+            return gates
+
+        gate_map = {}
+        for gate in gates:
+            if id(gate) not in self._owned and id(gate) not in gate_map:
+                gate_map[id(gate)] = copy.copy(gate)
+        if not gate_map:
+            return gates
+        self._owned.update(id(gate) for gate in gate_map.values())
+
+        self._materialize()
+        self.circuit.gates = [gate_map.get(id(gate), gate)
+                              for gate in self.circuit.gates]
+        for n, op in enumerate(self._ops):
+            if any(id(gate) in gate_map for gate in op[4]):
+                self._ops[n] = op[:4] + [
+                    [gate_map.get(id(gate), gate) for gate in op[4]]] +\
+                    op[5:]
+        self._adjustable_gates = [gate_map.get(id(gate), gate)
+                                  for gate in self._adjustable_gates]
+        self.noise_gates = {
+            key: [gate_map.get(id(gate), gate) for gate in gates]
+            for key, gates in self.noise_gates.items()}
+        self.parameters.remap(gate_map)
+
+        return [gate_map.get(id(gate), gate) for gate in gates]
+
+    def adjust_gate(self, gate, *args):
+        '''
+        Adjusts a gate returned by add_gate (i.e. gate.adjust(*args)),
+        copying it first if it is shared with a fork (see fork).
+        Returns the adjusted gate, which replaces the given gate in
+        this builder.
+        '''
+        gate, = self._own_gates([gate])
+        gate.adjust(*args)
+        return gate
+
+    def claim_noise_gates(self, parameter, qubit):
+        '''
+        Returns the gates depending on a noise parameter of a qubit
+        (see register_noise_gate), for an update rule to change in
+        place (copying any gates shared with a fork first).
+        '''
+        return self._own_gates(self.noise_gates.get((parameter, qubit), []))
 
     def make_reverse_circuit(self, title='reversed',
                              finalize=True):
@@ -108,14 +433,17 @@ class Builder:
         reversed_circuit_list = list(reversed(self.circuit_list))
         for n, gate_desc in enumerate(reversed_circuit_list):
             gate_name = gate_desc[0]
+            if gate_name == BARRIER:
+                continue
 
             num_qubits = self.gate_dic[gate_name]['num_qubits']
             user_kws = self.gate_dic[gate_name]['user_kws']
 
             if 'angle' in user_kws:
                 gate_desc = list(gate_desc)
-                angle_index = user_kws.index('angle')
-                gate_desc[num_qubits + 1 + angle_index] *= -1
+                angle_index = num_qubits + 1 + user_kws.index('angle')
+                gate_desc[angle_index] = negate_symbolic(
+                    gate_desc[angle_index])
                 reversed_circuit_list[n] = tuple(gate_desc)
 
         reversed_circuit_builder = Builder(qubit_dic=self.qubit_dic,
@@ -130,88 +458,127 @@ class Builder:
 
     def add_qasm(self, qasm_generator, qubits_first=True, **params):
         '''
-        Converts a qasm file into a circuit.
-        qasm_generator should yield lines of qasm when called.
+        Converts a list of gates in a simple qasm-like format
+        into a circuit. qasm_generator should yield lines of qasm.
 
         I assume that qasm lines take the form:
         GATE [arg0, arg1, ..] qubit0 [qubit1, ..]
-        Importantly, currently only allowing for a single space
-        in between words.
+        (or GATE qubit0 [qubit1, ..] [arg0, arg1, ..] when
+        qubits_first is True), with words separated by spaces
+        or commas. OpenQASM 2 files should be read with
+        add_openqasm instead.
         '''
         returned_gate_list = []
         for line in qasm_generator:
 
+            words = line.replace(',', ' ').replace(';', ' ').split()
+            if not words:
+                continue
+
             # Copy kwargs to prevent overwriting
             kwargs = {**params}
-
-            # Get positions of spaces in line
-            spaces = [i for i, x in enumerate(line) if x == ',' or x == ' ']
-            spaces.append(len(line))
-
-            # Get the gate name
-            gate_name = line[:spaces[0]]
-
-            num_qubits = self.gate_dic[gate_name]['num_qubits']
-            user_kws = self.gate_dic[gate_name]['user_kws']
+            gate_name = words[0]
 
             if gate_name == 'measure':
                 # line looks like 'measure q -> c;'
-                qubit_list = [line[spaces[0]+1:spaces[1]]]
-                output_bit = [line[spaces[2]+1:spaces[3]]]
-                self.add_gate('Measure', qubit_list,
-                              output_bit=output_bit)
+                self.add_gate('Measure', [words[1]], output_bit=words[3])
                 continue
 
-            if qubits_first:
-                # Create qubit list
-                qubit_list = [line[spaces[j]+1:
-                              spaces[j+1]]
-                              for j in range(num_qubits)]
-
-                # Add arguments from qasm to kwargs
-                for n, kw in enumerate(user_kws):
-                    try:
-                        kwargs[kw] = float(line[spaces[n+num_qubits]+1:
-                                                spaces[n + num_qubits+1]])
-                    except:
-                        kwargs[kw] = line[spaces[n+num_qubits]+1:
-                                          spaces[n+num_qubits+1]]
+            template = self.gate_dic[gate_name]
+            num_qubits = template['num_qubits']
+            user_kws = template['user_kws']
 
+            if qubits_first:
+                qubit_list = words[1:num_qubits+1]
+                args = words[num_qubits+1:]
             else:
-                # Add arguments from qasm to kwargs
-                for n, kw in enumerate(user_kws):
-                    try:
-                        kwargs[kw] = float(line[spaces[n]+1:spaces[n+1]])
-                    except Exception:
-                        kwargs[kw] = line[spaces[n]+1:spaces[n+1]]
-
-                # Create qubit list
-                qubit_list = [line[spaces[len(user_kws)+j]+1:
-                              spaces[len(user_kws)+j+1]]
-                              for j in range(num_qubits)]
-
-            try:
-                returned_gate = self.add_gate(gate_name, qubit_list, **kwargs)
-                if returned_gate is not None:
-                    returned_gate_list.append(returned_gate)
-            except Exception as inst:
-                print()
-                print('Adding gate failed!')
+                qubit_list = words[len(user_kws)+1:
+                                   len(user_kws)+num_qubits+1]
+                args = words[1:len(user_kws)+1]
+
+            # Add arguments from qasm to kwargs
+            for kw, arg in zip(user_kws, args):
                 try:
-                    print(kwargs['angle'])
-                except:
-                    pass
-                print(line, gate_name, qubit_list, kwargs)
-                raise inst
+                    kwargs[kw] = float(arg)
+                except ValueError:
+                    kwargs[kw] = arg
+
+            record = self.get_dispatch((gate_name, *qubit_list))
+            returned_gate = self._insert_gate(record, False, kwargs)
+            if returned_gate is not None:
+                returned_gate_list.append(returned_gate)
 
         return returned_gate_list
 
-    def add_circuit_list(self, circuit_list):
+    def add_openqasm(self, source, register_map=None, gate_map=None,
+                     batch_size=10000):
+        '''
+        Reads an OpenQASM 2 file (given as a file name or a file object)
+        into the circuit. The file is streamed and the gates are added
+        in batches of batch_size via the bulk path of add_circuit_list,
+        so the whole file is never held in memory.
+
+        register_map: a dictionary from qasm register names to the
+            list of qubit (or classical bit) names in the register.
+            By default, q[3] is mapped to the qubit 'q3'.
+        gate_map: translation of qasm gates to the gate_dic
+            (see qasm_reader.default_gate_map).
+
+        Barriers are added as by add_barrier (and so are saved in the
+        circuit list). Gates that are neither mapped, defined nor in
+        the gate_dic raise a QasmError.
+        Returns the list of adjustable gates in the circuit.
+        '''
+        reader = QasmReader(register_map=register_map, gate_map=gate_map,
+                            gate_names=self.gate_dic)
+
+        adjustable_gates = []
+        batch = []
+        for gate_desc in reader.read(source):
+            batch.append(gate_desc)
+            if len(batch) >= batch_size:
+                adjustable_gates += self.add_circuit_list(batch, bulk=True)
+                batch = []
+
+        adjustable_gates += self.add_circuit_list(batch, bulk=True)
+        return adjustable_gates
+
+    def add_barrier(self, qubits=()):
+        '''
+        Aligns the times of a set of qubits (all qubits if none are
+        given), so that no later gate on them starts before an earlier
+        gate on any of them has ended. The barrier is saved in the
+        circuit list as (BARRIER, qubit0, qubit1, ..), and is logged
+        as an empty operation, so that rescheduling keeps the qubits
+        aligned.
+        '''
+        self._materialize()
+        if self.save_flag:
+            self.circuit_list.append((BARRIER, *qubits))
+        qubits = tuple(qubits) or tuple(self.times)
+        barrier_time = max(self.times[qubit] for qubit in qubits)
+        for qubit in qubits:
+            self.times[qubit] = barrier_time
+        self._ops.append([qubits, barrier_time, 0, None, [],
+                          barrier_time, False])
+
+    def add_circuit_list(self, circuit_list, bulk=False):
 
         '''
         Adds a circuit in the list format stored by qsoverlay
         to the builder.
+
+        bulk: if True, the start time of every gate in the list is
+            calculated first (see schedule_circuit_list), and the
+            quantumsim gates are only created afterwards. This gives
+            the same circuit as adding the gates one by one, but
+            requires that composite gates only decompose themselves
+            by feeding gate descriptions back to the builder.
         '''
+        if bulk:
+            return self._add_scheduled(
+                self.schedule_circuit_list(circuit_list))
+
         adjustable_gates = []
         for gate_desc in circuit_list:
             temp_ag = self < gate_desc
@@ -219,15 +586,255 @@ class Builder:
                 adjustable_gates.append(temp_ag)
         return adjustable_gates
 
+    def schedule_circuit_list(self, circuit_list):
+        '''
+        Calculates the as-soon-as-possible start time of every gate
+        in a circuit list, without adding anything to the circuit.
+        Composite gates are decomposed into the gates they feed
+        back to the builder.
+
+        Returns a list with an entry for every gate description in
+        circuit_list, containing the descriptions to save, the
+        return_flag, and a list of (record, kwargs, start, group)
+        entries for the gates to be inserted (with the time set in
+        kwargs, and start None if the time was fixed by the user).
+        self.times is advanced to the end of the scheduled circuit.
+        '''
+
+        # The qubit times are held in a vector indexed by
+        # integers for the duration of the scheduling.
+        # (A list is used over a numpy array, as each gate
+        # only touches one or two elements at a time.)
+        self._materialize()
+        qubit_index = {qubit: n for n, qubit in enumerate(self.times)}
+        time_vec = list(self.times.values())
+        for bit, time in self._bit_times.items():
+            qubit_index[bit] = len(time_vec)
+            time_vec.append(time)
+
+        def bit_indices(bits):
+            '''
+            Returns the indices of classical bits in time_vec,
+            adding any bits that were not used before.
+            '''
+            for bit in bits:
+                if bit not in qubit_index:
+                    qubit_index[bit] = len(time_vec)
+                    time_vec.append(0)
+            return [qubit_index[bit] for bit in bits]
+
+        def schedule_gate(gate_desc, leaves, group=None):
+            '''
+            Schedules a single gate description, returning
+            the description to save and its return_flag.
+            '''
+
+            gate_name = gate_desc[0]
+
+            template = self.gate_dic[gate_name]
+            num_qubits = template['num_qubits']
+            user_kws = template['user_kws']
+
+            if len(gate_desc) == len(user_kws) + num_qubits + 2:
+                return_flag = gate_desc[-1]
+            else:
+                assert len(gate_desc) == len(user_kws) + num_qubits + 1
+                return_flag = False
+
+            record = self.get_dispatch(tuple(gate_desc[:num_qubits + 1]))
+            kwargs = {**record['circuit_args'],
+                      **{kw: arg for kw, arg in
+                         zip(user_kws, gate_desc[num_qubits+1:])},
+                      **record['qubit_kwargs']}
+
+            user_data = [kwargs[kw] for kw in user_kws]
+            if return_flag is not False:
+                saved_desc = (gate_name, *record['qubits'],
+                              *user_data, return_flag)
+            else:
+                saved_desc = (gate_name, *record['qubits'], *user_data)
+
+            if record['parameter_kws']:
+                for kw in record['parameter_kws']:
+                    kwargs[kw] = as_parameter(kwargs.get(kw))
+
+            flushes = []
+            if self.virtual_z and not record['composite']:
+                record, kwargs, flushes = self._update_frame(
+                    record, kwargs, return_flag)
+                if record is None:
+                    return saved_desc, return_flag
+
+            if 'time' in kwargs:
+                if record['composite']:
+                    # As in _insert_gate, the gates that a composite
+                    # gate decomposes into are scheduled as usual
+                    # (rather than replayed against the builder later).
+                    recorder = _GateRecorder()
+                    record['function'](builder=recorder, **kwargs)
+                    for sub_desc in recorder.circuit_list:
+                        schedule_desc(sub_desc, leaves)
+                    return saved_desc, return_flag
+                for qubit, angle in flushes:
+                    leaves.append((self._frame_record(qubit), {
+                        'bit': qubit, 'time': kwargs['time'],
+                        'angle': angle}, None, None))
+                leaves.append((record, kwargs, None, None))
+                return saved_desc, return_flag
+
+            indices = [qubit_index[qubit] for qubit in record['qubits']] +\
+                bit_indices(classical_bits(kwargs))
+            time = max([time_vec[n] for n in indices])
+            kwargs['time'] = time + record['time_offset']
+
+            for qubit, angle in flushes:
+                leaves.append((self._frame_record(qubit), {
+                    'bit': qubit, 'time': time, 'angle': angle}, time, None))
+
+            if record['composite']:
+                recorder = _GateRecorder()
+                record['function'](builder=recorder, **kwargs)
+                for sub_desc in recorder.circuit_list:
+                    schedule_desc(sub_desc, leaves)
+            else:
+                leaves.append((record, kwargs, time, group))
+
+            end_time = time + record['gate_time']
+            for n in indices:
+                if time_vec[n] < end_time:
+                    time_vec[n] = end_time
+
+            return saved_desc, return_flag
+
+        def schedule_desc(gate_desc, leaves):
+            '''
+            Schedules a gate description or a set of simultaneous
+            gate descriptions, returning the list of descriptions
+            to save and the return_flag.
+            '''
+
+            if gate_desc[0] == BARRIER:
+                qubits = tuple(gate_desc[1:]) or tuple(self.times)
+                indices = [qubit_index[qubit] for qubit in qubits]
+                time = max([time_vec[n] for n in indices])
+                for n in indices:
+                    time_vec[n] = time
+                leaves.append(({'kind': 'barrier', 'qubits': qubits},
+                               None, time, None))
+                return [tuple(gate_desc)], False
+
+            if type(gate_desc[0]) is str:
+                saved_desc, return_flag = schedule_gate(gate_desc, leaves)
+                return [saved_desc], return_flag
+
+            # Simultaneous gates (see add_gates_simultaneous)
+            indices = [
+                qubit_index[qubit]
+                for sub_desc in gate_desc
+                for qubit in sub_desc[
+                    1:self.gate_dic[sub_desc[0]]['num_qubits']+1]]
+            starting_time = max([time_vec[n] for n in indices])
+            for n in indices:
+                time_vec[n] = starting_time
+            group = self._num_groups
+            self._num_groups += 1
+            saved_descs = [schedule_gate(sub_desc, leaves, group)[0]
+                           for sub_desc in gate_desc]
+            return saved_descs, False
+
+        schedule = []
+        for gate_desc in circuit_list:
+            leaves = []
+            saved_descs, return_flag = schedule_desc(gate_desc, leaves)
+            schedule.append((saved_descs, return_flag, leaves))
+
+        for qubit, n in qubit_index.items():
+            if qubit in self.times:
+                self.times[qubit] = time_vec[n]
+            else:
+                self._bit_times[qubit] = time_vec[n]
+
+        return schedule
+
+    def _add_scheduled(self, schedule):
+        '''
+        Adds the gates from the output of schedule_circuit_list
+        to the circuit.
+        '''
+        self._materialize()
+        gates = self.circuit.gates
+        adjustable_gates = []
+
+        # Quantumsim gates with the same arguments (other than
+        # time and qubits) share the same PTM, so we only create
+        # each such gate once and copy it afterwards (as in
+        # quantumsim.circuit.Circuit.add_subcircuit).
+        prototypes = {}
+
+        prev_flag = self.save_flag
+        self.save_flag = False
+        try:
+            for saved_descs, return_flag, leaves in schedule:
+                if prev_flag:
+                    self.circuit_list.extend(saved_descs)
+
+                for record, kwargs, start, group in leaves:
+                    if record['kind'] == 'barrier':
+                        # See add_barrier
+                        self._ops.append([record['qubits'], start, 0, None,
+                                          [], start, False])
+                        continue
+                    num_gates = len(gates)
+                    parameter_args = self._bind_parameters(record, kwargs)
+                    kind = record['kind']
+                    if kind == 'gate':
+                        gates.append(self._make_gate(
+                            record, kwargs, prototypes))
+                        for param in record['noise_params']:
+                            self.register_noise_gate(
+                                param, record['qubits'][0], gates[-1])
+                    elif kind == 'string':
+                        self.circuit.add_gate(record['function'], **kwargs)
+                    else:
+                        record['function'](builder=self, **kwargs)
+
+                    if parameter_args is not None:
+                        self._add_parametric_gate(
+                            record, num_gates, parameter_args)
+
+                    if start is None:
+                        if not record['composite']:
+                            start = kwargs['time'] - record['time_offset']
+                            self._ops.append([
+                                record['qubits'] + classical_bits(kwargs),
+                                start, record['gate_time'], None,
+                                gates[num_gates:], start, True])
+                    else:
+                        self._ops.append([
+                            record['qubits'] + classical_bits(kwargs),
+                            start, record['gate_time'], group,
+                            gates[num_gates:], start, False])
+
+                if return_flag is not False:
+                    adjustable_gates.append(gates[-int(return_flag)])
+                    self._adjustable_gates.append(gates[-int(return_flag)])
+        finally:
+            self.save_flag = prev_flag
+
+        return adjustable_gates
+
     def __lt__(self, gate_desc):
 
         if type(gate_desc[0]) is not str:
             return self.add_gates_simultaneous(gate_desc)
 
         gate_name = gate_desc[0]
+        if gate_name == BARRIER:
+            return self.add_barrier(gate_desc[1:])
 
-        num_qubits = self.gate_dic[gate_name]['num_qubits']
-        user_kws = self.gate_dic[gate_name]['user_kws']
+        template = self.gate_dic[gate_name]
+        num_qubits = template['num_qubits']
+        user_kws = template['user_kws']
 
         if len(gate_desc) == len(user_kws) + num_qubits + 2:
             return_flag = gate_desc[-1]
@@ -235,19 +842,19 @@ class Builder:
             assert len(gate_desc) == len(user_kws) + num_qubits + 1
             return_flag = False
 
-        qubit_list = gate_desc[1:num_qubits + 1]
+        record = self.get_dispatch(tuple(gate_desc[:num_qubits + 1]))
 
         kwargs = {kw: arg for kw, arg in
                   zip(user_kws, gate_desc[num_qubits+1:])}
 
-        return self.add_gate(gate_name, qubit_list,
-                             return_flag=return_flag, **kwargs)
+        return self._insert_gate(record, return_flag, kwargs)
 
     def add_gates_simultaneous(self, gate_descriptions):
         '''
         takes a set of gate descriptions and begins the gates
         at the same time.
         '''
+        self._materialize()
         starting_time = max([
             self.times[gate_desc[j]]
             for gate_desc in gate_descriptions
@@ -259,8 +866,12 @@ class Builder:
             for qubit in qubit_list:
                 self.times[qubit] = starting_time
 
+        group = self._num_groups
+        self._num_groups += 1
         for gate_desc in gate_descriptions:
+            self._group = group
             gate_desc > self
+        self._group = None
 
     def add_gate(self, gate_name,
                  qubit_list, return_flag=False,
@@ -283,40 +894,42 @@ class Builder:
         # The gate tuple is a unique identifier for the gate, allowing
         # for asymmetry (as opposed to the name of the gate, which is
         # the same for every qubit/pair of qubits).
-        gate_tuple = (gate_name, *qubit_list)
+        record = self.get_dispatch((gate_name, *qubit_list))
 
-        circuit_args, builder_args = self.gate_set[gate_tuple]
+        return self._insert_gate(record, return_flag, kwargs)
+
+    def _insert_gate(self, record, return_flag, user_args):
+        """
+        Inserts a gate described by a dispatch record (see
+        get_dispatch) and the arguments given by the user.
+        """
+        if self._shared:
+            self._materialize()
+        qubit_list = record['qubits']
 
         # kwargs is the list of arguments that gets passed to the gate
         # itself. We initiate with the set of additional arguments passed
         # by the user and the arguments from the gate dic intended for
         # quantumsim.
-        kwargs = {**circuit_args, **kwargs}
+        kwargs = {**record['circuit_args'], **user_args,
+                  **record['qubit_kwargs']}
 
-        # Find the length of the gate
-        gate_time = builder_args['gate_time']
+        # Simultaneous gates are only aligned with their
+        # direct partners, not with any gates they decompose into.
+        group = self._group
+        self._group = None
+        num_gates = len(self.circuit.gates)
 
-        if 'time' in kwargs:
+        bits = classical_bits(kwargs)
+        if record['time_flag'] or 'time' in user_args:
             time_flag = True
+            time = kwargs['time'] - record['time_offset']
         else:
             time_flag = False
             # Calculate when to apply the gate
-            time = max(self.times[qubit] for qubit in qubit_list)
-            try:
-                kwargs['time'] = time + builder_args['exec_time']
-
-            except:
-                # If we have no exec time, assume the gate occurs in the
-                # middle of the time window allocated.
-                kwargs['time'] = time + gate_time/2
-
-        # Add qubits to the kwargs as appropriate.
-        # Note that we do *not* add classical bits here.
-        if len(qubit_list) == 1:
-            kwargs['bit'] = qubit_list[0]
-        else:
-            for j, qubit in enumerate(qubit_list):
-                kwargs['bit'+str(j)] = qubit
+            time = max([self.times[qubit] for qubit in qubit_list] +
+                       [self._bit_times.get(bit, 0) for bit in bits])
+            kwargs['time'] = time + record['time_offset']
 
         # Store a representation of the circuit for ease of access.
         # Note that this representation does not account for any
@@ -326,17 +939,38 @@ class Builder:
         # This also ensures that the user has entered all necessary
         # data.
         if self.save_flag:
-            user_data = [kwargs[kw]
-                         for kw in self.gate_dic[gate_name]['user_kws']]
+            user_data = [kwargs[kw] for kw in record['user_kws']]
             if return_flag is not False:
-                self.circuit_list.append((gate_name, *qubit_list,
+                self.circuit_list.append((record['name'], *qubit_list,
                                           *user_data, return_flag))
             else:
-                self.circuit_list.append((gate_name, *qubit_list,
+                self.circuit_list.append((record['name'], *qubit_list,
                                           *user_data))
 
+        # Track Z rotations in the frame of the qubits.
+        if self.virtual_z and not record['composite']:
+            record, kwargs, flushes = self._update_frame(
+                record, kwargs, return_flag)
+            if record is None:
+                self._group = group
+                return None
+            for qubit, angle in flushes:
+                flush_time = kwargs['time'] if time_flag else time
+                self.circuit.gates.append(quantumsim.circuit.RotateZ(
+                    bit=qubit, time=flush_time, angle=angle))
+                self._ops.append([(qubit,), flush_time, 0, None,
+                                  self.circuit.gates[-1:], flush_time,
+                                  time_flag])
+            num_gates = len(self.circuit.gates)
+
+        # Replace symbolic parameters by their current values.
+        parameter_args = None
+        if record['parameter_kws']:
+            parameter_args = self._bind_parameters(record, kwargs)
+
         # Get the gate to add to quantumsim.
-        gate = self.gate_dic[gate_name]['function']
+        gate = record['function']
+        kind = record['kind']
 
         # The save flag prevents saving multiple gate
         # definitions when using recursive gates (i.e.
@@ -350,38 +984,360 @@ class Builder:
         prev_flag = self.save_flag
         self.save_flag = False
         try:
-            if isinstance(gate, str):
+            if kind == 'gate':
+                # Equivalent to circuit.add_gate, without re-checking
+                # the type of the gate.
+                self.circuit.gates.append(gate(**kwargs))
+                for param in record['noise_params']:
+                    self.register_noise_gate(
+                        param, qubit_list[0], self.circuit.gates[-1])
+
+            elif kind == 'string':
                 self.circuit.add_gate(gate, **kwargs)
 
-            elif isinstance(gate, type) and\
-                    issubclass(gate, quantumsim.circuit.Gate):
-                self.circuit.add_gate(gate(**kwargs))
-
             else:
                 gate(builder=self, **kwargs)
 
+            if parameter_args is not None:
+                self._add_parametric_gate(record, num_gates, parameter_args)
+
             self.save_flag = prev_flag
+            self._group = group
         except:
             self.save_flag = prev_flag
+            self._group = group
             raise
 
         # Update time on qubits after gate is created
         # We do not do this if the user specifies the time as this
         # makes it impossible for us to properly account for the gate.
         if time_flag is False:
+            end_time = time + record['gate_time']
             for qubit in qubit_list:
-                self.times[qubit] = max(self.times[qubit], time + gate_time)
+                if self.times[qubit] < end_time:
+                    self.times[qubit] = end_time
+            for bit in bits:
+                if self._bit_times.get(bit, 0) < end_time:
+                    self._bit_times[bit] = end_time
+
+        # Gates with a fixed time are logged too, so that
+        # rescheduling keeps the other gates around them.
+        if not record['composite']:
+            self._ops.append([qubit_list + bits, time, record['gate_time'],
+                              None if time_flag else group,
+                              self.circuit.gates[num_gates:], time,
+                              time_flag])
 
         # My current best idea for adjustable gates - return the
         # gate that could be adjusted to the user.
         if return_flag is not False:
-            return self.circuit.gates[-int(return_flag)]
+            gate = self.circuit.gates[-int(return_flag)]
+            self._adjustable_gates.append(gate)
+            return gate
+
+    def _update_frame(self, record, kwargs, return_flag):
+        '''
+        Updates the frames of the qubits for a gate in virtual Z mode.
+        Z rotations are absorbed in the frame, and the frame is absorbed
+        in the axis of later X/Y rotations (as R_phi(theta) Rz(F) =
+        Rz(F) R_{phi - F}(theta)), or in the first angle of later Euler
+        rotations (which resets the frame). The frame commutes with
+        CZ and CPhase gates, and is reset by measurements and resets.
+        Before any other gate, the frame is applied as a noiseless
+        RotateZ gate. Gates returned to the user for adjusting are
+        never changed.
+
+        Returns the record and kwargs of the gate to insert (with the
+        record None if the gate was absorbed), and a list of
+        (qubit, angle) of the RotateZ gates to insert before it.
+        '''
+        function = record['function']
+        qubits = record['qubits']
+        frames = self.frames
+
+        if function is quantumsim.circuit.RotateZ:
+            angle = kwargs['angle']
+            if return_flag is False and not is_symbolic(angle):
+                frames[qubits[0]] += angle
+                return None, kwargs, []
+            return record, kwargs, []
+
+        if function in _diagonal_functions:
+            return record, kwargs, []
+
+        if function in _frame_reset_functions:
+            for qubit in qubits:
+                frames[qubit] = 0
+            return record, kwargs, []
+
+        if function in _rotation_functions and return_flag is False:
+            frame = frames[qubits[0]]
+            if frame == 0:
+                return record, kwargs, []
+
+            if function is quantumsim.circuit.RotateEuler:
+                frames[qubits[0]] = 0
+                return record, {
+                    **kwargs,
+                    'lamda': as_parameter(kwargs['lamda']) + frame}, []
+
+            if function is quantumsim.circuit.RotateXY:
+                phi = as_parameter(kwargs['phi'])
+                theta = kwargs['theta']
+            else:
+                phi = 0 if function is quantumsim.circuit.RotateX else pi/2
+                theta = kwargs['angle']
+            kwargs = {kw: arg for kw, arg in kwargs.items() if kw != 'angle'}
+            kwargs['phi'] = phi - frame
+            kwargs['theta'] = theta
+            return self._rotate_xy_record(record), kwargs, []
+
+        flushes = []
+        for qubit in qubits:
+            if frames.get(qubit, 0) != 0:
+                flushes.append((qubit, frames[qubit]))
+                frames[qubit] = 0
+        return record, kwargs, flushes
+
+    def _rotate_xy_record(self, record):
+        '''
+        Returns a copy of the dispatch record of a RotateX or RotateY
+        gate, creating a RotateXY gate with the same noise and timing.
+        '''
+        key = ('RotateXY', *record['qubits'], record['name'])
+        try:
+            return self._frame_records[key]
+        except KeyError:
+            pass
+        new_record = {
+            **record,
+            'function': quantumsim.circuit.RotateXY,
+            'user_kws': ['phi', 'theta'],
+            'parameter_kws': ['phi', 'theta']}
+        self._frame_records[key] = new_record
+        return new_record
+
+    def _frame_record(self, qubit):
+        '''
+        Returns a dispatch record for the noiseless RotateZ
+        gates that apply the frame of a qubit.
+        '''
+        key = ('RotateZ', qubit)
+        try:
+            return self._frame_records[key]
+        except KeyError:
+            pass
+        record = {
+            'name': 'RotateZ',
+            'qubits': (qubit,),
+            'function': quantumsim.circuit.RotateZ,
+            'kind': 'gate',
+            'num_qubits': 1,
+            'user_kws': ['angle'],
+            'circuit_args': {'bit': qubit},
+            'qubit_kwargs': {'bit': qubit},
+            'gate_time': 0,
+            'time_offset': 0,
+            'time_flag': False,
+            'composite': False,
+            'parameter_kws': [],
+            'noise_params': []
+        }
+        self._frame_records[key] = record
+        return record
+
+    def _bind_parameters(self, record, kwargs):
+        '''
+        Finds the symbolic parameters in the arguments of a gate.
+        Composite gates are passed the parameters as Parameter
+        objects, while other gates are created at the current
+        value of their parameters.
+
+        Returns the arguments for adjusting the gate later (with
+        the parameters kept), or None if the gate has no parameters.
+        '''
+        parameter_kws = record['parameter_kws']
+        if not any(is_symbolic(kwargs.get(kw)) for kw in parameter_kws):
+            return None
+
+        args = [as_parameter(kwargs[kw]) for kw in parameter_kws]
+        if record['composite']:
+            kwargs.update(zip(parameter_kws, args))
+            return None
+
+        kwargs.update(zip(parameter_kws, self.parameters.evaluate(args)))
+        return args
+
+    def _add_parametric_gate(self, record, num_gates, args):
+        '''
+        Records the first adjustable gate added to the circuit
+        since num_gates as depending on the parameters in args.
+        '''
+        for gate in self.circuit.gates[num_gates:]:
+            if hasattr(gate, 'adjust'):
+                self.parameters.add(gate, args)
+                return
+        raise ValueError('Gate {} cannot take symbolic parameters'.format(
+            record['name']))
+
+    @staticmethod
+    def _make_gate(record, kwargs, prototypes):
+        '''
+        Creates a quantumsim gate from its record, reusing a
+        previously created gate from prototypes if one exists
+        with the same arguments.
+        '''
+        qubit_kwargs = record['qubit_kwargs']
+        try:
+            key = (record['function'], *sorted(
+                (kw, arg) for kw, arg in kwargs.items()
+                if kw != 'time' and kw not in qubit_kwargs))
+            prototype, proto_qubits = prototypes[key]
+        except TypeError:
+            # Unhashable arguments
+            return record['function'](**kwargs)
+        except KeyError:
+            gate = record['function'](**kwargs)
+            # Measurements store their results, so are never shared.
+            if not gate.is_measurement:
+                prototypes[key] = (gate, qubit_kwargs)
+            return gate
+
+        name_map = {proto_qubits[kw]: qubit
+                    for kw, qubit in qubit_kwargs.items()}
+        return copy_gate(prototype, kwargs['time'], name_map)
+
+    def register_noise_gate(self, parameter, qubit, gate):
+        '''
+        Records that a gate depends on a noise parameter of a qubit
+        (e.g. 'quasistatic_flux'), so that update rules can update
+        the gate directly (see update_functions).
+        '''
+        self._materialize()
+        self.noise_gates.setdefault((parameter, qubit), []).append(gate)
+
+    def _updated_noise_params(self):
+        '''
+        Returns the noise parameters that the update rules change
+        (listed in the noise_params attribute of every rule), or None
+        if any rule does not list them.
+        '''
+        updated = set()
+        for rule in self.update_rules:
+            if isinstance(rule, str):
+                rule = update_function_dic.get(rule)
+            params = getattr(rule, 'noise_params', None)
+            if params is None:
+                return None
+            updated.update(params)
+        return updated
 
     def update(self, **kwargs):
+        '''
+        Applies the update rules of the setup (from
+        update_functions.update_function_dic) to the circuit.
+        '''
         for rule in self.update_rules:
             update_function_dic[rule](self, **kwargs)
 
-    def finalize(self, topo_order=False, t_add=0):
+    def reschedule(self, schedule='alap'):
+        """
+        Moves the gates in the circuit to follow a scheduling policy,
+        keeping the order of gates on every qubit and the total
+        length of the circuit:
+            - 'asap': every gate starts as soon as possible (this is
+                how gates are initially added by the builder).
+            - 'alap': every gate starts as late as possible.
+            - 'balanced': every gate starts halfway between the two,
+                spreading the slack of each gate over either side.
+        Gates with a time fixed by the user are not moved (and the
+        gates before them on their qubits end in time), gates writing
+        or reading the same classical bit keep their order, and
+        simultaneous gates stay simultaneous.
+
+        Returns a dictionary with the start time of the first gate
+        on every qubit that has a gate.
+        """
+        if schedule not in ('asap', 'alap', 'balanced'):
+            raise ValueError('Unknown schedule: {}'.format(schedule))
+
+        self._materialize()
+        ops = self._ops
+
+        if schedule == 'asap':
+            new_starts = [op[1] for op in ops]
+
+        else:
+            # Calculate the latest start of each gate in a
+            # backwards pass over the operations log.
+            circuit_time = max(self.times.values())
+            next_start = {}
+            groups = {}
+            for n, op in enumerate(ops):
+                if op[3] is not None:
+                    groups.setdefault(op[3], []).append(n)
+
+            new_starts = [None] * len(ops)
+            for n in reversed(range(len(ops))):
+                if new_starts[n] is not None:
+                    continue
+                if ops[n][6]:
+                    # Fixed gates stay, and later gates on their
+                    # qubits have to end before them.
+                    new_starts[n] = ops[n][5]
+                    for qubit in ops[n][0]:
+                        next_start[qubit] = min(
+                            next_start.get(qubit, circuit_time), ops[n][5])
+                    continue
+                if ops[n][3] is None:
+                    members = [n]
+                else:
+                    members = groups[ops[n][3]]
+                start = min([
+                    min([next_start.get(qubit, circuit_time)
+                         for qubit in ops[m][0]]) -
+                    ops[m][2] for m in members])
+                # A gate never moves before its asap start (which
+                # only happens to gates overlapping a fixed gate).
+                start = max(start, ops[n][1])
+                for m in members:
+                    new_starts[m] = start
+                    for qubit in ops[m][0]:
+                        next_start[qubit] = start
+
+            if schedule == 'balanced':
+                new_starts = [(op[1] + start) / 2
+                              for op, start in zip(ops, new_starts)]
+
+        if self._has_forks:
+            # Gates may be shared with forks, so are copied before
+            # being moved (see Builder.fork). The operations log is
+            # copied for the same reason.
+            self._own_gates([gate for op, start in zip(ops, new_starts)
+                             if start != op[5] for gate in op[4]])
+            ops = self._ops = [list(op) for op in self._ops]
+
+        first_starts = {}
+        for op, start in zip(ops, new_starts):
+            shift = start - op[5]
+            if shift != 0:
+                for gate in op[4]:
+                    gate.time += shift
+                op[5] = start
+            if not op[4]:
+                # Barriers do not make a qubit start resting.
+                continue
+            for qubit in op[0]:
+                if qubit not in self.times:
+                    # Classical bits do not rest.
+                    continue
+                if qubit not in first_starts or start < first_starts[qubit]:
+                    first_starts[qubit] = start
+
+        return first_starts
+
+    def finalize(self, topo_order=False, t_add=0, schedule=None,
+                 fuse=False, qubits=None):
         """
         Adds resting gates to all systems as required.
         quantumsim currently assumes fixed values for photon
@@ -389,9 +1345,43 @@ class Builder:
 
         Photons in quantumsim are currently broken, so
         they're not in here right now.
+
+        schedule: the scheduling policy to apply before adding the
+            resting gates (see Builder.reschedule). Defaults to the
+            schedule of the builder. For 'alap' and 'balanced', each
+            qubit only rests from the start of its first gate, and
+            qubits without gates do not rest at all (as they remain
+            in the ground state).
+        fuse: whether to fuse runs of single-qubit gates (including
+            resting gates) into single gates (see
+            circuit_passes.fuse_single_qubit_gates). Gates returned
+            for adjusting, gates with symbolic parameters and flux
+            noise gates are kept as they are; other gates that are
+            fused no longer follow drifting noise parameters (see
+            drift_models).
+        qubits: if given, the qubits (and classical bits) to keep in
+            the circuit; other qubits are removed, and do not rest.
+            (The circuit should not contain gates on them, see
+            circuit_passes.prune_circuit_list.)
         """
+        if schedule is None:
+            schedule = self.schedule
 
+        self._materialize()
         circuit_time = max(self.times.values())
+
+        if qubits is not None:
+            qubits = set(qubits)
+            self.circuit.qubits = [qubit for qubit in self.circuit.qubits
+                                   if qubit.name in qubits]
+
+        # Apply the remaining frames at the end of the circuit
+        for qubit, frame in self.frames.items():
+            if frame != 0:
+                self.circuit.gates.append(quantumsim.circuit.RotateZ(
+                    bit=qubit, time=circuit_time, angle=frame))
+                self.frames[qubit] = 0
+
         if type(t_add) == dict:
             circuit_time = {key: val + circuit_time
                             for key, val in t_add.items()}
@@ -408,9 +1398,54 @@ class Builder:
         #         chi=args['chi'])
         # else:
 
-        self.circuit.add_waiting_gates(tmin=0, tmax=circuit_time)
+        num_gates = len(self.circuit.gates)
+        if schedule == 'asap':
+            self.circuit.add_waiting_gates(tmin=0, tmax=circuit_time)
+        else:
+            first_starts = self.reschedule(schedule)
+            if first_starts:
+                self.circuit.add_waiting_gates(
+                    tmin=first_starts, tmax=circuit_time,
+                    only_qubits=list(first_starts))
+
+        # The resting gates depend on t1 and t2 of their qubit.
+        for gate in self.circuit.gates[num_gates:]:
+            if isinstance(gate, quantumsim.circuit.AmpPhDamp):
+                for param in ('t1', 't2'):
+                    self.register_noise_gate(
+                        param, gate.involved_qubits[0], gate)
+
         if topo_order is True:
             self.circuit.order()
         else:
             self.circuit.gates = sorted(self.circuit.gates,
                                         key=lambda x: x.time)
+
+        if fuse:
+            protected = {id(gate) for gate in self._adjustable_gates}
+            protected.update(id(gate) for gate, _ in self.parameters.gates)
+            fuse_single_qubit_gates(self.circuit, protected)
+            # Fused gates no longer follow their noise parameters.
+            remaining = {id(gate) for gate in self.circuit.gates}
+            self.noise_gates = {
+                key: [gate for gate in gates if id(gate) in remaining]
+                for key, gates in self.noise_gates.items()}
+
+
+class _GateRecorder:
+    '''
+    Stands in for a builder when a composite gate is decomposed
+    during scheduling, storing the gate descriptions that the
+    composite gate feeds back.
+    '''
+
+    def __init__(self):
+        self.circuit_list = []
+
+    def __lt__(self, gate_desc):
+        self.circuit_list.append(gate_desc)
+
+    def add_gate(self, gate_name, qubit_list, return_flag=False, **kwargs):
+        raise NotImplementedError(
+            'Composite gates can only be scheduled in bulk when they '
+            'add gates to the builder with builder < gate_desc.')
@@ -0,0 +1,277 @@
+"""
+circuit_cache: a cache of compiled circuits, so that the same circuit
+list is only built into a quantumsim circuit once for a given setup.
+
+Circuits are stored under a hash of the circuit list and a fingerprint
+of the setup, in a memory tier and an optional disk tier, both of which
+evict the least recently used circuits when full. Every hit returns a
+cheap copy of the stored circuit (sharing the PTMs of its gates), so
+that adjusting gates or recording measurements never affects the cache.
+"""
+
+import collections
+import copy
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+
+import quantumsim.circuit
+from .circuit_builder import Builder
+
+
+class CompiledCircuit:
+
+    def __init__(self, circuit, adjust_gates, measurement_gates,
+                 parameters, noise_gates=None, noise_values=None):
+        '''
+        A finalized circuit, with the handles to its gates
+        that the Controller needs.
+
+        adjust_gates: gates returned by the builder for adjusting.
+        measurement_gates: measurements returned by the builder.
+        parameters: the ParameterTable of the circuit.
+        noise_gates, noise_values: the gates depending on a noise
+            parameter, and the values they were last updated to
+            (see Builder.noise_gates), for the update rules.
+        '''
+        self.circuit = circuit
+        self.adjust_gates = adjust_gates
+        self.measurement_gates = measurement_gates
+        self.parameters = parameters
+        self.noise_gates = noise_gates or {}
+        self.noise_values = noise_values or {}
+
+    def copy(self, samplers=None):
+        '''
+        Returns a copy with new gate objects sharing the PTMs of
+        these gates. Measurements in the copy start without any
+        stored results.
+
+        samplers: a dictionary from qubits to the samplers to use for
+            their measurements (by default, the samplers are shared).
+            Circuits read from disk have no samplers, so every measured
+            qubit must then be in samplers.
+        '''
+        gate_map = {}
+        gates = []
+        for gate in self.circuit.gates:
+            new_gate = copy.copy(gate)
+            if gate.is_measurement:
+                new_gate.measurements = []
+                new_gate.probabilities = []
+                new_gate.projects = []
+                if samplers is not None:
+                    new_gate.sampler = samplers.get(gate.bit, gate.sampler)
+                if new_gate.sampler is None:
+                    raise ValueError('No sampler for the measurement of {}'
+                                     .format(gate.bit))
+            gate_map[id(gate)] = new_gate
+            gates.append(new_gate)
+
+        circuit = quantumsim.circuit.Circuit(self.circuit.title)
+        circuit.qubits = list(self.circuit.qubits)
+        circuit.gates = gates
+
+        return CompiledCircuit(
+            circuit,
+            [gate_map[id(gate)] for gate in self.adjust_gates],
+            [gate_map[id(gate)] for gate in self.measurement_gates],
+            self.parameters.copy(gate_map),
+            {key: [gate_map[id(gate)] for gate in gates]
+             for key, gates in self.noise_gates.items()},
+            self.noise_values.copy())
+
+
+def compile_circuit(circuit_list, setup, builder=None, **finalize_kwargs):
+    '''
+    Builds and finalizes a circuit list for a setup,
+    returning a CompiledCircuit.
+    '''
+    if builder is None:
+        builder = Builder(setup)
+    else:
+        builder.new_circuit()
+    adjust_gates = builder.add_circuit_list(circuit_list)
+    builder.finalize(**finalize_kwargs)
+    return CompiledCircuit(
+        builder.circuit,
+        [gate for gate in adjust_gates if not gate.is_measurement],
+        [gate for gate in adjust_gates if gate.is_measurement],
+        builder.parameters, builder.noise_gates, builder.noise_values)
+
+
+def setup_fingerprint(setup):
+    '''
+    Returns a hash of everything in a setup that changes the compiled
+    circuit (in the format of Setup.save). Samplers are not included,
+    as they are reattached to the circuit on every cache hit.
+    '''
+    qubit_dic = {
+        qubit: {key: val for key, val in params.items() if key != 'sampler'}
+        for qubit, params in setup.qubit_dic.items()}
+    gate_set = sorted(
+        [list(key), {key: val for key, val in circuit_args.items()
+                     if key != 'sampler'}, builder_args]
+        for key, (circuit_args, builder_args) in setup.gate_set.items())
+    gate_dic = {key: val.get('name', repr(val['function']))
+                for key, val in setup.gate_dic.items()}
+    return _hash([qubit_dic, gate_set, gate_dic])
+
+
+def builder_options(builder=None):
+    '''
+    Returns the options of a builder that change the compiled circuit
+    (those of a new Builder if builder is None).
+    '''
+    if builder is None:
+        return {'schedule': 'asap', 'virtual_z': False}
+    return {'schedule': builder.schedule, 'virtual_z': builder.virtual_z}
+
+
+def setup_samplers(setup):
+    '''
+    Returns a dictionary from qubits to the samplers
+    used by measurements on them in a setup.
+    '''
+    samplers = {}
+    for qubit, params in setup.qubit_dic.items():
+        if 'sampler' in params:
+            samplers[qubit] = params['sampler']
+    for key, (circuit_args, _) in setup.gate_set.items():
+        if 'sampler' in circuit_args and len(key) == 2:
+            samplers[key[1]] = circuit_args['sampler']
+    return samplers
+
+
+def _hash(data):
+    text = json.dumps(data, sort_keys=True, default=repr)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+class CircuitCache:
+
+    def __init__(self, max_entries=128, directory=None,
+                 max_disk_bytes=1 << 30):
+        '''
+        A cache of compiled circuits.
+
+        max_entries: number of circuits to keep in memory.
+        directory: directory for the disk tier (if None, circuits
+            are only cached in memory).
+        max_disk_bytes: size limit of the disk tier.
+        '''
+        self.max_entries = max_entries
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def key(self, circuit_list, setup, fingerprint=None, builder=None,
+            **finalize_kwargs):
+        if fingerprint is None:
+            fingerprint = setup_fingerprint(setup)
+        return _hash([circuit_list, fingerprint, builder_options(builder),
+                      finalize_kwargs])
+
+    def compile(self, circuit_list, setup, builder=None, fingerprint=None,
+                samplers=None, **finalize_kwargs):
+        '''
+        Returns a copy of the compiled circuit for a circuit list and a
+        setup, compiling it (with compile_circuit) if it is not cached.
+
+        builder: a Builder for the setup to compile with (its schedule
+            and virtual_z are part of the key).
+        fingerprint, samplers: the output of setup_fingerprint and
+            setup_samplers for the setup, to avoid recalculating these
+            when compiling many circuits for the same setup.
+        '''
+        key = self.key(circuit_list, setup, fingerprint, builder,
+                       **finalize_kwargs)
+        if samplers is None:
+            samplers = setup_samplers(setup)
+
+        entry = self.get(key)
+        if entry is None:
+            self.misses += 1
+            entry = compile_circuit(circuit_list, setup, builder,
+                                    **finalize_kwargs)
+            self.put(key, entry)
+        else:
+            self.hits += 1
+        return entry.copy(samplers)
+
+    def get(self, key):
+        '''
+        Returns the cached circuit for a key (not a copy), or None.
+        '''
+        try:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        except KeyError:
+            pass
+
+        if self.directory is None:
+            return None
+        filename = self._filename(key)
+        try:
+            with open(filename, 'rb') as infile:
+                entry = pickle.load(infile)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        # Mark the file as recently used.
+        os.utime(filename)
+        self._store(key, entry)
+        return entry
+
+    def put(self, key, entry):
+        self._store(key, entry)
+        if self.directory is not None:
+            self._write(key, entry)
+
+    def clear(self):
+        self.entries.clear()
+        if self.directory is not None:
+            for filename in self._disk_files():
+                os.remove(filename)
+
+    def _store(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def _filename(self, key):
+        return os.path.join(self.directory, key + '.pkl')
+
+    def _disk_files(self):
+        return [os.path.join(self.directory, name)
+                for name in os.listdir(self.directory)
+                if name.endswith('.pkl')]
+
+    def _write(self, key, entry):
+        # Samplers are generators, which cannot be pickled.
+        entry = entry.copy()
+        for gate in entry.circuit.gates:
+            if gate.is_measurement:
+                gate.sampler = None
+
+        # Write to a temporary file first, so that other processes
+        # sharing the directory never read a partial file.
+        handle, temp_name = tempfile.mkstemp(dir=self.directory,
+                                             suffix='.tmp')
+        with os.fdopen(handle, 'wb') as outfile:
+            pickle.dump(entry, outfile, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_name, self._filename(key))
+
+        files = sorted(self._disk_files(), key=os.path.getmtime)
+        total = sum(os.path.getsize(name) for name in files)
+        while total > self.max_disk_bytes and files:
+            name = files.pop(0)
+            total -= os.path.getsize(name)
+            os.remove(name)
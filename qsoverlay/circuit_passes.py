@@ -0,0 +1,167 @@
+"""
+circuit_passes: optimization passes on quantumsim circuits
+and qsoverlay circuit lists.
+"""
+import quantumsim.circuit
+from .qasm_reader import BARRIER
+
+# Gate arguments naming the classical bits that a gate writes or reads.
+_classical_kws = ('output_bit', 'real_output_bit', 'conditional_bit')
+
+
+def is_protected(gate, protected=()):
+    '''
+    Whether a gate needs to stay in the circuit as it is; either
+    because it can be adjusted later (it is in protected, or flagged
+    for updating by the quasistatic flux update rule), or because it
+    is conditional on a classical bit.
+    '''
+    return id(gate) in protected or\
+        getattr(gate, 'quasistatic_flux_flag', False) or\
+        gate.conditional_bit is not None
+
+
+def fuse_single_qubit_gates(circuit, protected=()):
+    '''
+    Fuses every run of consecutive single-qubit PTM gates on the same
+    qubit (including the resting gates) into a single gate, whose PTM
+    is the product of the PTMs in the run. The fused gate takes the
+    place and time of the last gate in the run, which is correct as
+    the gates it is moved past act on other qubits.
+
+    Runs end at any other gate on the qubit, and at protected gates
+    (see is_protected), which are never fused.
+
+    protected: the ids of gates that should be left alone.
+    Returns the number of gates removed from the circuit.
+    '''
+    gates = list(circuit.gates)
+    runs = {}
+
+    def flush(bit):
+        indices = runs.pop(bit, None)
+        if indices is None or len(indices) < 2:
+            return
+        ptm = gates[indices[0]].ptm
+        for n in indices[1:]:
+            ptm = gates[n].ptm.dot(ptm)
+        last_gate = gates[indices[-1]]
+        fused_gate = quantumsim.circuit.SinglePTMGate(
+            bit, last_gate.time, ptm)
+        fused_gate.label = 'F'
+        gates[indices[-1]] = fused_gate
+        for n in indices[:-1]:
+            gates[n] = None
+
+    for n, gate in enumerate(gates):
+        if isinstance(gate, quantumsim.circuit.SinglePTMGate) and\
+                len(gate.involved_qubits) == 1 and\
+                not is_protected(gate, protected):
+            runs.setdefault(gate.involved_qubits[0], []).append(n)
+        else:
+            for bit in gate.involved_qubits:
+                flush(bit)
+
+    for bit in list(runs):
+        flush(bit)
+
+    num_gates = len(gates)
+    circuit.gates = [gate for gate in gates if gate is not None]
+    return num_gates - len(circuit.gates)
+
+
+def gate_bits(gate_desc, gate_dic):
+    '''
+    Returns the qubits and classical bits used by a gate description
+    in a circuit list (or by a set of simultaneous descriptions).
+    '''
+    if type(gate_desc[0]) is not str:
+        return [bit for sub_desc in gate_desc
+                for bit in gate_bits(sub_desc, gate_dic)]
+    if gate_desc[0] == BARRIER:
+        return list(gate_desc[1:])
+
+    template = gate_dic[gate_desc[0]]
+    num_qubits = template['num_qubits']
+    bits = list(gate_desc[1:num_qubits+1])
+    for kw, arg in zip(template['user_kws'], gate_desc[num_qubits+1:]):
+        if kw in _classical_kws and arg is not None:
+            bits.append(arg)
+    return bits
+
+
+def is_adjustable(gate_desc, gate_dic):
+    '''
+    Whether a gate description returns a gate for adjusting
+    (measurements excluded).
+    '''
+    if type(gate_desc[0]) is not str or gate_desc[0] == BARRIER:
+        return False
+    template = gate_dic[gate_desc[0]]
+    user_kws = template['user_kws']
+    return len(gate_desc) == template['num_qubits'] + len(user_kws) + 2\
+        and 'output_bit' not in user_kws
+
+
+def light_cone(circuit_list, targets, gate_dic):
+    '''
+    Walks a circuit list backwards from a set of target qubits and
+    bits, finding the gates that can affect them (including the
+    measurements writing the bits that conditional gates read).
+
+    Returns a list of booleans marking these gates, and the set of
+    qubits and bits at the start of the circuit that the targets
+    depend on. Barriers on live qubits (or on all qubits) are kept,
+    but do not make their other qubits live.
+    '''
+    live = set(targets)
+    keep = [False] * len(circuit_list)
+    for n in reversed(range(len(circuit_list))):
+        bits = gate_bits(circuit_list[n], gate_dic)
+        if circuit_list[n][0] == BARRIER:
+            keep[n] = not bits or any(bit in live for bit in bits)
+            continue
+        if any(bit in live for bit in bits):
+            keep[n] = True
+            live.update(bits)
+    return keep, live
+
+
+def prune_circuit_list(circuit_list, targets, gate_dic):
+    '''
+    Removes every gate from a circuit list that cannot
+    affect the target qubits and bits.
+    '''
+    keep, _ = light_cone(circuit_list, targets, gate_dic)
+    return [gate_desc for gate_desc, flag in zip(circuit_list, keep)
+            if flag]
+
+
+def align_adjust_gates(circuit_list, keep, adjust_gates, gate_dic):
+    '''
+    Returns the adjustable gates of a pruned circuit list (with the
+    flags keep of light_cone) in the positions of the adjustable gate
+    descriptions of the full circuit list, with None in place of the
+    gates that were pruned.
+    '''
+    adjust_gates = iter(adjust_gates)
+    return [next(adjust_gates) if flag else None
+            for gate_desc, flag in zip(circuit_list, keep)
+            if is_adjustable(gate_desc, gate_dic)]
+
+
+def light_cone_closure(circuit_lists, targets, gate_dic):
+    '''
+    Returns the smallest set of qubits and bits containing the targets
+    that is closed under the light cones of all circuit lists, so
+    that pruning every circuit to this set is correct for any
+    sequence of the circuits.
+    '''
+    live = set(targets)
+    while True:
+        new_live = set(live)
+        for circuit_list in circuit_lists:
+            new_live.update(light_cone(circuit_list, live, gate_dic)[1])
+        if new_live == live:
+            return live
+        live = new_live
@@ -0,0 +1,199 @@
+"""
+drift_models: slow drift of the noise parameters of qubits (t1, t2,
+dephasing, quasistatic flux, ...) across consecutive experiments.
+
+Every drifting parameter of a qubit follows its own random process
+(OrnsteinUhlenbeck or RandomWalk). A DriftRule steps these processes
+as an update rule (see update_functions), and refreshes the PTMs of
+the gates that depend on a parameter (including the resting gates
+added by Builder.finalize, see Builder.noise_gates) only when the
+parameter has moved beyond a tolerance since their last refresh, so
+that a long drift simulation never rebuilds the circuit.
+
+Gates are built with the values in the gate_set of the setup, which
+the drift does not change; gates added after an update are refreshed
+on the next update that moves their parameters.
+"""
+import numpy as np
+import quantumsim.circuit
+import quantumsim.ptm
+
+
+class OrnsteinUhlenbeck:
+
+    def __init__(self, mean, std, correlation_time):
+        '''
+        An Ornstein-Uhlenbeck process, which drifts around mean with
+        a stationary standard deviation std, and forgets its value
+        after correlation_time (in units of the update step dt).
+        '''
+        self.mean = mean
+        self.std = std
+        self.correlation_time = correlation_time
+
+    def step(self, value, random_state=np.random, dt=1):
+        '''
+        Returns the value of the process a time dt after value.
+        '''
+        decay = np.exp(-dt / self.correlation_time)
+        return self.mean + decay * (value - self.mean) +\
+            self.std * np.sqrt(1 - decay**2) * random_state.randn()
+
+
+class RandomWalk:
+
+    def __init__(self, step_std, lower=None, upper=None):
+        '''
+        A Gaussian random walk with standard deviation step_std per
+        unit of time, clipped to the bounds lower and upper (if given).
+        '''
+        self.step_std = step_std
+        self.lower = lower
+        self.upper = upper
+
+    def step(self, value, random_state=np.random, dt=1):
+        '''
+        Returns the value of the walk a time dt after value.
+        '''
+        value = value + self.step_std * np.sqrt(dt) * random_state.randn()
+        if self.lower is not None:
+            value = max(value, self.lower)
+        if self.upper is not None:
+            value = min(value, self.upper)
+        return value
+
+
+def damping_ptm(duration, t1, t2):
+    '''
+    Returns the PTM of a resting gate (as quantumsim.circuit.AmpPhDamp),
+    where t2 is limited to 2 * t1.
+    '''
+    t2 = min(t2, 2 * t1)
+    if np.isclose(t2, 2 * t1):
+        t_phi = np.inf
+    else:
+        t_phi = 1 / (1 / t2 - 1 / (2 * t1)) / 2
+    gamma = 1 - np.exp(-duration / t1)
+    lamda = 1 - np.exp(-duration / t_phi)
+    return quantumsim.ptm.amp_ph_damping_ptm(gamma, lamda)
+
+
+def refresh_gate(gate, parameter, value):
+    '''
+    Changes a noise parameter of a gate and recalculates its PTM.
+    '''
+    if isinstance(gate, quantumsim.circuit.AmpPhDamp):
+        setattr(gate, parameter, value)
+        gate.ptm = damping_ptm(gate.duration, gate.t1, gate.t2)
+    elif getattr(gate, 'quasistatic_flux_flag', False):
+        gate.adjust(value)
+    elif isinstance(gate, quantumsim.circuit.RotateXY):
+        setattr(gate, parameter, value)
+        gate.adjust(gate.phi, gate.theta)
+    else:
+        setattr(gate, parameter, value)
+        gate.adjust(gate.angle)
+
+
+class DriftRule:
+
+    # The shortest t1 or t2 a drift may reach (quantumsim rejects
+    # resting gates with non-positive times).
+    min_time = 1e-9
+
+    def __init__(self, models, rtol=1e-3, atol=1e-12):
+        '''
+        An update rule that drifts the noise parameters of the qubits.
+
+        models: a dictionary from a parameter (e.g. 't1') or a
+            (parameter, qubit) pair to the process it follows
+            (an OrnsteinUhlenbeck or RandomWalk). A model given for a
+            parameter applies to every qubit that has the parameter.
+        rtol, atol: the gates depending on a parameter are only
+            refreshed once the parameter differs from the value they
+            were last refreshed to by more than atol + rtol * |value|.
+
+        Register the rule with update_functions.register_update_rule
+        to add it to the update_rules of a setup. Rotations are only
+        refreshed if the rule is in the update_rules of the builder
+        when they are added (see noise_params).
+        '''
+        self.models = models
+        self.rtol = rtol
+        self.atol = atol
+
+    @property
+    def noise_params(self):
+        '''
+        The parameters that drift, for the builder to register
+        the rotations depending on them (see Builder.get_dispatch).
+        '''
+        return sorted({key[0] if isinstance(key, tuple) else key
+                       for key in self.models})
+
+    def drifting(self, qubit_dic):
+        '''
+        Returns the (parameter, qubit) pairs that drift,
+        with their models.
+        '''
+        drifting = {}
+        for key, model in self.models.items():
+            if isinstance(key, tuple):
+                drifting[key] = model
+            else:
+                for qubit, params in sorted(qubit_dic.items()):
+                    if params.get(key) is not None:
+                        drifting.setdefault((key, qubit), model)
+        return drifting
+
+    def clamp(self, parameter, value, params):
+        '''
+        Keeps a drifted t1 or t2 physical: both stay above min_time,
+        and t2 stays below 2 * t1 (by holding t1 at t2 / 2 or t2 at
+        2 * t1, whichever drifted). Other parameters are returned as is.
+        '''
+        if parameter == 't1':
+            value = max(value, self.min_time)
+            if params.get('t2') is not None:
+                value = max(value, params['t2'] / 2)
+        elif parameter == 't2':
+            value = max(value, self.min_time)
+            if params.get('t1') is not None:
+                value = min(value, 2 * params['t1'])
+        return value
+
+    def __call__(self, builder, streams=None, dt=1, **kwargs):
+        '''
+        Steps every drifting parameter in builder.qubit_dic by dt, and
+        refreshes the gates whose parameters moved beyond the tolerance.
+        Drifted t1 and t2 values are clamped (see clamp) before they are
+        stored on the qubits or gates.
+
+        streams: a RandomStreams to draw the steps from (from the
+            stream ('drift', parameter, qubit)); by default the global
+            numpy generator is used.
+        '''
+        qubit_dic = builder.qubit_dic
+        qubits = {qubit.name: qubit for qubit in builder.circuit.qubits}
+
+        for (parameter, qubit), model in self.drifting(qubit_dic).items():
+            if streams is None:
+                random_state = np.random
+            else:
+                random_state = streams.random_state('drift', parameter, qubit)
+            value = model.step(qubit_dic[qubit][parameter], random_state, dt)
+            value = self.clamp(parameter, value, qubit_dic[qubit])
+            qubit_dic[qubit][parameter] = value
+
+            # New resting gates take t1 and t2 from the circuit qubits.
+            if parameter in ('t1', 't2') and qubit in qubits:
+                setattr(qubits[qubit], parameter, value)
+
+            key = (parameter, qubit)
+            applied = builder.noise_values.get(key)
+            if applied is not None and\
+                    abs(value - applied) <= self.atol + self.rtol * abs(value):
+                continue
+            builder.noise_values[key] = value
+            for gate in builder.claim_noise_gates(parameter, qubit):
+                refresh_gate(gate, parameter, value)
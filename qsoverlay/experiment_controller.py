@@ -5,24 +5,79 @@ states (single-shot or generate statistics), update circuit parameters (i.e.
 for a VQE).
 """
 
+import concurrent.futures
 import json
+import pickle
 
 import numpy as np
 
-from quantumsim.circuit import Measurement
+import quantumsim.circuit
 from quantumsim.sparsedm import SparseDM
 from .circuit_builder import Builder
+from .circuit_cache import (
+    compile_circuit, setup_fingerprint, setup_samplers)
+from .circuit_passes import (
+    align_adjust_gates, light_cone, light_cone_closure)
 from .experiment_setup import Setup
+from .pauli_functions import (
+    expectation_values, sample_expectation_values)
+from .state_functions import (
+    apply_superoperator, circuit_superoperator, copy_state,
+    marginal_distribution)
 
-sx = np.array([[0, 1], [1, 0]])
-sy = np.array([[0, -1j], [1j, 0]])
-sz = np.array([[1, 0], [0, -1]])
-s0 = np.array([[1, 0], [0, 1]])
-pauli_dic = {1: s0, 'X': sx, 'Y': sy, 'Z': sz}
+
+def circuit_time(builder, circuit_list):
+    '''
+    Returns the length of a circuit list, without building it.
+    '''
+    builder.new_circuit()
+    builder.schedule_circuit_list(circuit_list)
+    return max(builder.times.values(), default=0)
+
+
+def tomo_distribution(state, circuits, bits):
+    '''
+    Applies a list of circuits to a state, and returns the
+    probabilities of the outcomes of measuring bits.
+    '''
+    for circuit in circuits:
+        circuit.apply_to(state, apply_all_pending=False)
+    state.renormalize()
+    return state.peak_multiple_measurements(bits)
+
+
+# The prefix state and measured bits in a
+# worker process of Controller.simulate_tomo
+_tomo_worker_data = {}
+
+
+def _init_tomo_worker(state, bits):
+    _tomo_worker_data['state'] = state
+    _tomo_worker_data['bits'] = bits
+
+
+def _tomo_worker(job):
+    return tomo_distribution(copy_state(_tomo_worker_data['state']),
+                             pickle.loads(job), _tomo_worker_data['bits'])
+
+
+def _gate_state(gate):
+    '''
+    Returns the object holding the action of a quantumsim gate
+    (its PTM, if it has one).
+    '''
+    if hasattr(gate, 'ptm'):
+        return gate.ptm
+    return getattr(gate, 'two_ptm', gate)
 
 
 # noinspection PyStatementEffect
 class Controller:
+
+    # The largest number of qubits that a repeated circuit can act on
+    # to be applied as a single superoperator (see apply_circuit).
+    max_superoperator_qubits = 4
+
     def __init__(self,
                  filename=None,
                  setup=None,
@@ -34,7 +89,11 @@ class Controller:
                  adjust_gates=None,
                  measurement_gates=None,
                  angle_convert_matrices=None,
-                 mbits=None):
+                 parameters=None,
+                 mbits=None,
+                 cache=None,
+                 targets=None,
+                 streams=None):
 
         """
         qubits: list of qubits in the experiment
@@ -46,9 +105,24 @@ class Controller:
         msmt_circuits: dictionary of circuits to measure a state.
         adjust_gates: a list of adjustable gates in a circuit
             that the user might pass parameters to when they run
-            the circuit.
+            the circuit (None for gates removed by targets).
         measurement_gates: a set of Measurement type operators
             to extract extra details about the measurements made.
+        parameters: dictionary of the ParameterTables of the circuits
+            (as made by the qsoverlay builder), holding the gates
+            that depend on symbolic parameters.
+        cache: a CircuitCache to take circuits from when loading
+            (circuits are built from scratch if this is None).
+        targets: the qubits and bits that the user is interested in
+            when loading from a file. If given, every gate, qubit and
+            bit that cannot affect the targets is removed (see load).
+        streams: a RandomStreams to take all random numbers from: the
+            samplers of a setup loaded from a file (see Setup.load),
+            and the streams 'expectation_values' and 'shots' for
+            sampling in get_expectation_values and
+            sample_expectation_values. By default, random_state and
+            seed are used for the setup, and the global numpy
+            generator for sampling.
         """
 
         self.circuits = circuits or {}
@@ -63,20 +137,47 @@ class Controller:
         self.adjust_gates = adjust_gates or {}
         self.angle_convert_matrices = angle_convert_matrices or {}
         self.measurement_gates = measurement_gates or {}
+        self.parameters = parameters or {}
+        self.cache = cache
+        self.streams = streams
         self.state = None
 
+        # The superoperators of repeated circuits (see apply_circuit).
+        self._superoperators = {}
+
         if filename is not None:
-            self.load(filename, setup, random_state, seed)
+            self.load(filename, setup, random_state, seed, targets)
 
         self.make_state()
 
-    def load(self, filename, setup, random_state=None, seed=None):
+    @property
+    def state(self):
+        return self._state
+
+    @state.setter
+    def state(self, state):
+        self._state = state
+        self.clear_marginal_cache()
+
+    def load(self, filename, setup, random_state=None, seed=None,
+             targets=None):
+        """
+        Loads a set of circuit lists from a file, and builds them.
+
+        targets: if not None, the qubits and bits of interest. The
+            circuits are pruned to the light cone of the targets (taken
+            over all circuits, so that the circuits can be applied in
+            any order), and only the qubits and mbits within the light
+            cone are kept in the state. Gates returned for adjusting
+            are always kept.
+        """
 
         with open(filename, 'r') as infile:
             data = json.load(infile)
 
         if type(setup) == str:
-            setup = Setup(filename=setup, state=random_state, seed=seed)
+            setup = Setup(filename=setup, state=random_state, seed=seed,
+                          streams=self.streams)
 
         self.mbits = data['mbits']
         self.qubits = data['qubits']
@@ -85,19 +186,49 @@ class Controller:
             for key, val in data['angle_convert_matrices'].items()
         }
 
+        self.clear_superoperator_cache()
         b = Builder(setup)
+        if self.cache is not None:
+            fingerprint = setup_fingerprint(setup)
+            samplers = setup_samplers(setup)
+
+        if targets is not None:
+            live = light_cone_closure(data['circuit_lists'].values(),
+                                      targets, setup.gate_dic)
+            self.qubits = [q for q in self.qubits if q in live]
+            self.mbits = [m for m in self.mbits if m in live]
+
         for name, cl in data['circuit_lists'].items():
-            b.new_circuit()
-            adjust_gates = b.add_circuit_list(cl)
-            b.finalize()
-            self.circuits[name] = b.circuit
+            finalize_kwargs = {}
+            compiled_cl = cl
+            if targets is not None:
+                keep, _ = light_cone(cl, live, setup.gate_dic)
+                compiled_cl = [gate_desc for gate_desc, flag
+                               in zip(cl, keep) if flag]
+                # The remaining qubits rest until the end
+                # of the full circuit.
+                finalize_kwargs = {
+                    'qubits': sorted(live),
+                    't_add': circuit_time(b, cl) -
+                    circuit_time(b, compiled_cl)}
+
+            if self.cache is not None:
+                compiled = self.cache.compile(
+                    compiled_cl, setup, builder=b, fingerprint=fingerprint,
+                    samplers=samplers, **finalize_kwargs)
+            else:
+                compiled = compile_circuit(compiled_cl, setup, builder=b,
+                                           **finalize_kwargs)
+            self.circuits[name] = compiled.circuit
             self.circuit_lists[name] = cl
-            self.adjust_gates[name] = [
-                ag for ag in adjust_gates
-                if type(ag) is not Measurement]
-            self.measurement_gates[name] = [
-                ag for ag in adjust_gates
-                if type(ag) is Measurement]
+            self.parameters[name] = compiled.parameters
+            self.adjust_gates[name] = compiled.adjust_gates
+            if targets is not None:
+                # Pruned gates keep their place, so that angles are
+                # still passed to the right gates.
+                self.adjust_gates[name] = align_adjust_gates(
+                    cl, keep, compiled.adjust_gates, setup.gate_dic)
+            self.measurement_gates[name] = compiled.measurement_gates
             if name in data['angle_convert_matrices']:
                 self.angle_convert_matrices = \
                     data['angle_convert_matrices'][name]
@@ -130,17 +261,31 @@ class Controller:
         a) a string corresponding to an entry in self.circuits
         b) a tuple or list with the first entry a string corresponding
             to an entry in self.circuits and the remaining entries
-            angles to input for self.adjust_gates.
+            angles to input for self.adjust_gates. If the circuit
+            has symbolic parameters, the remaining entries are instead
+            the values of the parameters (in the order of
+            self.parameters[circuit].names), and may also be given
+            as a single dictionary or vector of parameter values.
         c) a tuple or list with the first entry the reserved keyword
             'record', and the remaining entries a list of mbits to
             store the current value of.
         d) a pair (n, circuit), where circuit is one of the above,
             and n is the number of times to repeat the circuit.
+            If the circuit contains no measurements, and its gates
+            split into groups of at most max_superoperator_qubits
+            qubits that do not interact (e.g. the resting gates of
+            idle qubits), every group is instead composed into a
+            single superoperator, which is raised to the n-th power
+            (so the cost grows with log(n)). The superoperators are
+            cached until the PTM of any gate is replaced (e.g. by
+            adjusting a gate or updating the noise); call
+            clear_superoperator_cache after changing a PTM in place.
         """
 
         # Record is a reserved keyword to copy the output
         # from a set of classical bits to return to the user.
 
+        self.clear_marginal_cache()
         if type(circuit) is list or type(circuit) is tuple:
 
             if circuit[0] == 'record':
@@ -151,19 +296,17 @@ class Controller:
 
             op_name = circuit[0]
             if type(op_name) == int:
+                if op_name > 1:
+                    return_data = self._apply_repeated(op_name, circuit[1])
+                    if return_data is not None:
+                        return return_data
                 return_data = []
                 for _ in range(op_name):
                     return_data.append(self.apply_circuit(circuit[1]))
                 return return_data
 
             else:
-                if op_name in self.angle_convert_matrices:
-                    angles = self.angle_convert_matrices[op_name] @ circuit[1:]
-                else:
-                    angles = circuit[1:]
-                for gate, param in zip(
-                        self.adjust_gates[op_name], angles):
-                    gate.adjust(param)
+                self._bind_circuit(circuit)
                 self.circuits[op_name].apply_to(self.state,
                                                 apply_all_pending=False)
 
@@ -182,6 +325,132 @@ class Controller:
 
         return None
 
+    def _apply_repeated(self, num_repetitions, circuit):
+        """
+        Applies a circuit num_repetitions times as superoperators, if
+        possible (see apply_circuit). Returns the output of every
+        repetition (as apply_circuit), or None if the circuit was
+        not applied.
+        """
+        if type(circuit) is list or type(circuit) is tuple:
+            if circuit[0] == 'record' or type(circuit[0]) == int:
+                return None
+            self._bind_circuit(circuit)
+            op_name = circuit[0]
+        else:
+            op_name = circuit
+
+        # The cache is keyed on the PTMs of the gates, which are
+        # replaced whenever a gate is adjusted or its noise updated.
+        # (The cache holds on to them, so their ids are not reused.)
+        gate_states = [_gate_state(gate)
+                       for gate in self.circuits[op_name].gates]
+        key = tuple(id(state) for state in gate_states)
+        entry = self._superoperators.get(op_name)
+        if entry is None or entry['key'] != key:
+            entry = {'key': key, 'gate_states': gate_states,
+                     'superoperators': self._make_superoperators(op_name),
+                     'powers': {}}
+            self._superoperators[op_name] = entry
+        if entry['superoperators'] is None:
+            return None
+
+        if num_repetitions not in entry['powers']:
+            entry['powers'][num_repetitions] = [
+                (qubits, np.linalg.matrix_power(
+                    superoperator, num_repetitions))
+                for qubits, superoperator in entry['superoperators']]
+        for qubits, superoperator in entry['powers'][num_repetitions]:
+            apply_superoperator(self.state, qubits, superoperator)
+
+        if op_name in self.measurement_gates:
+            return [[] for _ in range(num_repetitions)]
+        return [None] * num_repetitions
+
+    def _make_superoperators(self, op_name):
+        """
+        Returns the qubits and superoperator of every group of
+        interacting qubits in a circuit, or None if the circuit
+        cannot be applied as superoperators.
+        """
+        groups = []
+        for gate in self.circuits[op_name].gates:
+            if gate.is_measurement or\
+                    getattr(gate, 'conditional_bit', None) is not None:
+                return None
+            qubits = set(gate.involved_qubits)
+            gates = []
+            for group in [group for group in groups
+                          if group[0] & qubits]:
+                groups.remove(group)
+                qubits |= group[0]
+                gates += group[1]
+            groups.append((qubits, gates + [gate]))
+
+        superoperators = []
+        for qubits, gates in groups:
+            if len(qubits) > self.max_superoperator_qubits or\
+                    not qubits.issubset(self.qubits):
+                return None
+            qubits = sorted(qubits)
+            circuit = quantumsim.circuit.Circuit('group')
+            circuit.gates = gates
+            superoperator = circuit_superoperator(circuit, qubits)
+            if superoperator is None:
+                return None
+            superoperators.append((qubits, superoperator))
+        return superoperators
+
+    def clear_superoperator_cache(self):
+        '''
+        Forgets the superoperators of repeated circuits
+        (see apply_circuit).
+        '''
+        self._superoperators = {}
+
+    def _bind_circuit(self, circuit):
+        """
+        Passes the angles or parameter values given with a circuit
+        (case b of apply_circuit) to its gates.
+        """
+        op_name = circuit[0]
+        values = circuit[1:]
+        if len(values) == 1 and isinstance(
+                values[0], (dict, list, tuple, np.ndarray)):
+            values = values[0]
+
+        if isinstance(values, dict) or (
+                op_name in self.parameters and
+                self.parameters[op_name].index):
+            if op_name not in self.parameters:
+                raise ValueError('Circuit {} has no symbolic parameters '
+                                 'to bind values to'.format(op_name))
+            self.parameters[op_name].bind(values)
+        else:
+            if op_name in self.angle_convert_matrices:
+                angles = self.angle_convert_matrices[op_name] @\
+                    values
+            else:
+                angles = values
+            for gate, param in zip(
+                    self.adjust_gates[op_name], angles):
+                if gate is not None:
+                    gate.adjust(param)
+
+    def _bound_circuits(self, circuit):
+        """
+        Returns the list of quantumsim circuits that apply_circuit
+        would apply for a circuit, binding any values given with it.
+        """
+        if type(circuit) is list or type(circuit) is tuple:
+            if circuit[0] == 'record':
+                return []
+            if type(circuit[0]) == int:
+                return self._bound_circuits(circuit[1]) * circuit[0]
+            self._bind_circuit(circuit)
+            return [self.circuits[circuit[0]]]
+        return [self.circuits[circuit]]
+
     def __lt__(self, circuit):
         self.apply_circuit(circuit)
 
@@ -206,24 +475,79 @@ class Controller:
                       tomo_circuits,
                       measurement_model,
                       num_measurements,
-                      output_format, data_type):
+                      output_format, data_type,
+                      processes=None):
         """
-        Takes the current system state, copies it,
-        applies multiple tomography circuits, and runs them through
-        models for the measurement to return thresholded voltages.
+        Simulates a circuit from a new state followed by each of a set
+        of tomography circuits, and runs the results through models
+        for the measurement to return thresholded voltages.
+
+        The circuit is only simulated once, and every tomography
+        circuit is applied to a copy of the resulting state. (If the
+        circuit contains measurements, it is simulated again for every
+        tomography circuit, so that the measurement outcomes are
+        sampled independently.) Afterwards, self.state holds the
+        state after the last tomography circuit (or after the circuit
+        alone, when running in parallel).
+
+        processes: if given, the number of worker processes to
+            apply the tomography circuits in. Tomography circuits
+            containing measurements are always applied here.
+            The measurement model is always sampled here, in
+            the order of tomo_circuits.
         """
-        data = []
-        for tomo_circuit in tomo_circuits:
+        bits = measurement_model.qubits
+
+        prefix = self._bound_circuits(circuit)
+        if any(gate.is_measurement
+               for c in prefix for gate in c.gates):
+            rho_dists = []
+            for tomo_circuit in tomo_circuits:
+                self.make_state()
+                self < circuit
+                self < tomo_circuit
+                self.state.renormalize()
+                rho_dists.append(self.state.peak_multiple_measurements(
+                    bits))
+
+        else:
             self.make_state()
-            self < circuit
-            self < tomo_circuit
-            self.state.renormalize()
-            rho_dist = self.state.peak_multiple_measurements(
-                measurement_model.qubits)
-            data.append(measurement_model.sample(
-                rho_dist, num_measurements, data_type=data_type,
-                output_format=output_format))
-        return data
+            for c in prefix:
+                c.apply_to(self.state, apply_all_pending=False)
+            self.state.apply_all_pending()
+            self.clear_marginal_cache()
+            snapshot = self.state
+
+            rho_dists = [None] * len(tomo_circuits)
+            jobs = []
+            for n, tomo_circuit in enumerate(tomo_circuits):
+                circuits = self._bound_circuits(tomo_circuit)
+                if processes is not None and not any(
+                        gate.is_measurement
+                        for c in circuits for gate in c.gates):
+                    # Pickled straight away, as the gates may be
+                    # adjusted again for the next tomography circuit.
+                    jobs.append((n, pickle.dumps(circuits)))
+                    continue
+                self.state = copy_state(snapshot)
+                rho_dists[n] = tomo_distribution(
+                    self.state, circuits, bits)
+
+            if jobs:
+                with concurrent.futures.ProcessPoolExecutor(
+                        max_workers=processes,
+                        initializer=_init_tomo_worker,
+                        initargs=(snapshot, bits)) as executor:
+                    results = executor.map(
+                        _tomo_worker, [job for _, job in jobs])
+                    for (n, _), rho_dist in zip(jobs, results):
+                        rho_dists[n] = rho_dist
+                self.state = snapshot
+
+        return [measurement_model.sample(
+                    rho_dist, num_measurements, data_type=data_type,
+                    output_format=output_format)
+                for rho_dist in rho_dists]
 
     def get_expectation_values(self, msmts, num_repetitions=None):
         """
@@ -235,40 +559,18 @@ class Controller:
 
         input: msmts: list of measurement dictionaries, containing
         'X', 'Y', or 'Z' for each non-trivial qubit label.
-        """
-
-        results = []
-        self.state.apply_all_pending()
-        self.state.renormalize()
-        dm = self.state.full_dm.to_array()
-
-        for msmt in msmts:
-
-            mult = 1
-
-            # Make Pauli list
-            pauli_list = [1] * len(self.state.idx_in_full_dm)
-            for qubit in msmt:
-                if qubit not in self.state.idx_in_full_dm:
-                    if msmt[qubit] == 'Z':
-                        mult *= (-1) ** self.state.classical[qubit]
-                    elif msmt[qubit] in ['X', 'Y']:
-                        mult = 0
-                    else:
-                        raise ValueError('qubit measurements must be X, Y, Z')
-                else:
-                    pauli_list[self.state.idx_in_full_dm[qubit]] = msmt[qubit]
-
-            # Make measurement operator
-            op = pauli_dic[pauli_list[0]]
-            for label in pauli_list[1:]:
-                op = np.kron(pauli_dic[label], op)
 
-            result = mult * np.trace(op @ dm)
+        (See sample_expectation_values for estimates from
+        shared shots.)
+        """
 
-            assert np.imag(result) < 1e-9
-            result = float(np.real(result))
+        if self.streams is None:
+            random_state = np.random
+        else:
+            random_state = self.streams.random_state('expectation_values')
 
+        results = []
+        for result in expectation_values(self.state, msmts):
             if num_repetitions is not None:
                 bernoulli_rv = (1 - result) / 2
                 if -1e-6 < bernoulli_rv <= 0:
@@ -277,10 +579,9 @@ class Controller:
                     noisy_result = 1
                 else:
                     try:
-                        noisy_result = np.random.beta(bernoulli_rv *
-                                                      num_repetitions,
-                                                      (1 - bernoulli_rv) *
-                                                      num_repetitions)
+                        noisy_result = random_state.beta(
+                            bernoulli_rv * num_repetitions,
+                            (1 - bernoulli_rv) * num_repetitions)
                     except Exception:
                         raise ValueError(
                             'My bernoulli random variable is weird: {}'
@@ -292,6 +593,57 @@ class Controller:
 
         return np.array(results)
 
+    def sample_expectation_values(self, msmts, num_shots, weights=None,
+                                  random_state=None):
+        """
+        Estimates a set of Pauli strings on the current state from
+        a total budget of num_shots shots, as in an experiment.
+        The strings are split into qubit-wise commuting groups, each
+        measured in its own basis, and all strings in a group are
+        estimated from the same shots. Shots are allocated to the
+        groups in proportion to the weights of their strings (see
+        pauli_functions.sample_expectation_values).
+
+        weights: the weight of every string in msmts (e.g. its
+            coefficient in a Hamiltonian); by default all 1.
+        random_state: the numpy RandomState to sample with (by
+            default, the stream 'shots' of self.streams).
+        """
+        if random_state is None and self.streams is not None:
+            random_state = self.streams.random_state('shots')
+        elif random_state is None:
+            random_state = np.random
+        self.state.apply_all_pending()
+        return sample_expectation_values(
+            self.state, msmts, num_shots, weights, random_state)
+
+    def get_marginal(self, qubits):
+
+        """
+        Returns the probabilities of the measurement outcomes of a
+        list of qubits (or mbits) in the current state, as a vector
+        of length 2^len(qubits), where bit i of the index is the
+        outcome of qubits[i].
+
+        The diagonal of the density matrix and the marginals are
+        cached until the state is next changed by the controller
+        (or replaced); after changing self.state in place by hand,
+        call clear_marginal_cache.
+        """
+        key = tuple(qubits)
+        if key not in self._marginal_cache:
+            if self._diagonal is None:
+                self.state.apply_all_pending()
+                self.state.renormalize()
+                self._diagonal = self.state.full_dm.get_diag()
+            self._marginal_cache[key] = marginal_distribution(
+                self.state, qubits, self._diagonal)
+        return self._marginal_cache[key]
+
+    def clear_marginal_cache(self):
+        self._diagonal = None
+        self._marginal_cache = {}
+
     def get_prob_all_zero(self, qubits):
 
         """
@@ -299,12 +651,4 @@ class Controller:
         will return a 0 measurement (regardless of any other qubit
         measurement).
         """
-
-        self.state.apply_all_pending()
-        self.state.renormalize()
-
-        indices = [self.state.idx_in_full_dm[q] for q in qubits]
-        diagonal = self.state.full_dm.get_diag()
-
-        return sum([x for j, x in enumerate(diagonal) if
-                    all([(j // 2 ** i) % 2 == 0 for i in indices])])
+        return self.get_marginal(qubits)[0]
@@ -15,44 +15,59 @@ class Setup:
             self, filename=None,
             seed=None, state=None,
             gate_dic=None, update_rules=None,
-            qubit_dic=None, gate_set=None):
+            qubit_dic=None, gate_set=None,
+            streams=None):
 
         if filename is not None:
-            self.load(filename, seed, state)
+            self.load(filename, seed, state, streams)
         else:
             self.gate_dic = gate_dic or {}
             self.update_rules = update_rules or []
             self.qubit_dic = qubit_dic or {}
             self.gate_set = gate_set or {}
 
-    def load(self, filename, seed=None, state=None):
+    def load(self, filename, seed=None, state=None, streams=None):
+        '''
+        Loads a setup from a file. Measurement samplers are made from
+        either a seed or a numpy.random.RandomState (in which case
+        every qubit shares the same sampler), or a RandomStreams
+        (in which case every qubit gets its own sampler, drawing
+        from the stream ('sampler', qubit)).
+        '''
         with open(filename, 'r') as infile:
             setup_load_format = json.load(infile)
 
         self.update_rules = setup_load_format['update_rules']
         self.qubit_dic = setup_load_format['qubit_dic']
 
-        # Currently assumes each qubit uses the same
-        # uniform_noisy_sampler - this needs fixing
-
-        if seed is None and state is None:
+        if seed is None and state is None and streams is None:
             raise ValueError('''
-                We require either a numpy.random.RandomState
-                or a non-null seed for a setup.''')
-        readout_error = list(self.qubit_dic.values())[0]['readout_error']
-        sampler = uniform_noisy_sampler(
-            seed=seed, state=state, readout_error=readout_error)
+                We require either a numpy.random.RandomState,
+                a RandomStreams or a non-null seed for a setup.''')
+
+        if streams is None:
+            readout_error = \
+                list(self.qubit_dic.values())[0]['readout_error']
+            sampler = uniform_noisy_sampler(
+                seed=seed, state=state, readout_error=readout_error)
+            samplers = {qubit: sampler for qubit in self.qubit_dic}
+        else:
+            samplers = {
+                qubit: uniform_noisy_sampler(
+                    state=streams.random_state('sampler', qubit),
+                    readout_error=qb_params['readout_error'])
+                for qubit, qb_params in self.qubit_dic.items()}
 
-        for qb_params in self.qubit_dic.values():
-            qb_params['sampler'] = sampler
+        for qubit, qb_params in self.qubit_dic.items():
+            qb_params['sampler'] = samplers[qubit]
 
         self.gate_set = {
             tuple(gate['key']): gate['val']
             for gate in setup_load_format['gate_set']
         }
-        for gate in self.gate_set.values():
+        for key, gate in self.gate_set.items():
             if 'sampler' in gate[0] and gate[0]['sampler'] is True:
-                gate[0]['sampler'] = sampler
+                gate[0]['sampler'] = samplers[key[1]]
 
         gd = GateData()
 
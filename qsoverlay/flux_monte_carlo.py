@@ -0,0 +1,215 @@
+"""
+flux_monte_carlo: Monte Carlo simulation of a circuit over many
+realizations of quasistatic flux noise.
+
+All realizations of the flux are drawn up front as one array, and the
+flux gates of the circuit (the RotateZ gates flagged with
+quasistatic_flux_flag, see gate_functions.insert_CZ) are found once,
+so that every realization only adjusts these gates before simulating.
+Realizations can be split over a pool of worker processes; as the
+flux is drawn beforehand, the results do not depend on the number of
+workers. The statistics of the final density matrix (and optionally
+of a set of Pauli strings) are accumulated as running sums.
+"""
+import concurrent.futures
+import pickle
+import statistics
+
+import numpy as np
+
+from quantumsim.sparsedm import SparseDM
+from .pauli_functions import expectation_values
+from .state_functions import copy_state
+
+
+def flux_gate_index(circuit):
+    '''
+    Returns a dictionary from qubits to the quasistatic flux gates
+    acting on them in a circuit.
+    '''
+    index = {}
+    for gate in circuit.gates:
+        if getattr(gate, 'quasistatic_flux_flag', False):
+            index.setdefault(gate.involved_qubits[0], []).append(gate)
+    return index
+
+
+def draw_flux(qubit_dic, qubits, num_realizations, streams=None):
+    '''
+    Draws num_realizations realizations of the quasistatic flux of
+    a list of qubits, returning an array with a row per realization
+    and a column per qubit.
+
+    streams: a RandomStreams to draw the flux of each qubit from
+        (the stream ('quasistatic_flux', qubit)); by default the
+        global numpy generator is used.
+    '''
+    flux = np.zeros((num_realizations, len(qubits)))
+    for n, qubit in enumerate(qubits):
+        if streams is None:
+            random_state = np.random
+        else:
+            random_state = streams.random_state('quasistatic_flux', qubit)
+        flux[:, n] = qubit_dic[qubit]['static_flux_std'] *\
+            random_state.randn(num_realizations)
+    return flux
+
+
+def set_flux(index, qubits, flux):
+    '''
+    Sets the flux gates of a set of qubits (from flux_gate_index)
+    to a single realization of the flux.
+    '''
+    for qubit, angle in zip(qubits, flux):
+        for gate in index[qubit]:
+            gate.adjust(angle)
+
+
+class MonteCarloStatistics:
+
+    def __init__(self, samples=None):
+        '''
+        Running statistics of a set of (real or complex) array-valued
+        samples. For complex samples, the real and imaginary parts
+        are treated as separate variables: std_error then holds the
+        standard error of the real part plus 1j times that of the
+        imaginary part.
+
+        samples: an array of samples along the first axis to start with.
+        '''
+        self.count = 0
+        self.total = 0
+        self.total_sq = 0
+        if samples is not None:
+            self.add(samples)
+
+    def add(self, samples):
+        samples = np.asarray(samples)
+        self.count += len(samples)
+        self.total = self.total + samples.sum(axis=0)
+        self.total_sq = self.total_sq +\
+            (samples.real**2).sum(axis=0) +\
+            1j * (samples.imag**2).sum(axis=0)
+
+    def merge(self, other):
+        self.count += other.count
+        self.total = self.total + other.total
+        self.total_sq = self.total_sq + other.total_sq
+
+    @property
+    def mean(self):
+        return self.total / self.count
+
+    @property
+    def std_error(self):
+        mean = self.mean
+        var_real = (self.total_sq.real / self.count - mean.real**2)
+        var_imag = (self.total_sq.imag / self.count - np.imag(mean)**2)
+        scale = 1 / max(self.count - 1, 1)
+        std_error = np.sqrt(np.clip(var_real, 0, None) * scale)
+        if np.iscomplexobj(mean):
+            std_error = std_error +\
+                1j * np.sqrt(np.clip(var_imag, 0, None) * scale)
+        return std_error
+
+    def confidence_interval(self, level=0.95):
+        '''
+        Returns the (lower, upper) bounds of the normal
+        confidence interval of the mean.
+        '''
+        z = statistics.NormalDist().inv_cdf((1 + level) / 2)
+        return self.mean - z * self.std_error, self.mean + z * self.std_error
+
+
+def _simulate(circuit, index, qubits, flux, state, msmts):
+    '''
+    Simulates a set of flux realizations, returning the statistics
+    of the density matrix and of the Pauli strings in msmts.
+    '''
+    dm_statistics = MonteCarloStatistics()
+    msmt_statistics = MonteCarloStatistics()
+    for realization in flux:
+        set_flux(index, qubits, realization)
+        if state is None:
+            new_state = SparseDM(circuit.get_qubit_names())
+        else:
+            new_state = copy_state(state)
+        circuit.apply_to(new_state)
+        new_state.renormalize()
+        dm_statistics.add([new_state.full_dm.to_array()])
+        if msmts:
+            msmt_statistics.add([expectation_values(new_state, msmts)])
+    return dm_statistics, msmt_statistics
+
+
+# The circuit and arguments of a worker process
+_worker_data = {}
+
+
+def _init_flux_worker(job):
+    circuit, qubits, state, msmts = pickle.loads(job)
+    _worker_data['args'] = (circuit, flux_gate_index(circuit), qubits)
+    _worker_data['state'] = state
+    _worker_data['msmts'] = msmts
+
+
+def _flux_worker(flux):
+    return _simulate(*_worker_data['args'], flux,
+                     _worker_data['state'], _worker_data['msmts'])
+
+
+def run_flux_monte_carlo(circuit, qubit_dic, num_realizations,
+                         state=None, msmts=None, streams=None,
+                         processes=None, chunk_size=None):
+    '''
+    Simulates a circuit over num_realizations realizations of the
+    quasistatic flux of the qubits in qubit_dic (those with a
+    static_flux_std), and returns a dictionary with the
+    MonteCarloStatistics of the final 'density_matrix' (as a dense
+    array, see SparseDM.full_dm) and, if msmts is given, of the
+    'expectation_values' of the Pauli strings in msmts.
+
+    circuit: a finalized quantumsim circuit (from a Builder).
+    state: the SparseDM to start every realization from (by default
+        every qubit in the circuit starts in the ground state).
+        The order of the qubits in the dense density matrix depends
+        on the order in which they become dense, which is the same
+        in every realization.
+    streams: a RandomStreams to draw the flux from (see draw_flux).
+    processes: the number of worker processes to simulate in (if None,
+        everything is simulated in this process). Circuits containing
+        measurements are always simulated here, as their samplers
+        cannot be sent to other processes.
+    chunk_size: the number of realizations sent to a worker at once.
+
+    The flux gates are left at the flux of the last realization.
+    '''
+    index = flux_gate_index(circuit)
+    qubits = [qubit for qubit in sorted(index)
+              if qubit_dic[qubit].get('static_flux_std') is not None]
+    flux = draw_flux(qubit_dic, qubits, num_realizations, streams)
+
+    if processes is None or any(gate.is_measurement
+                                for gate in circuit.gates):
+        dm_statistics, msmt_statistics = _simulate(
+            circuit, index, qubits, flux, state, msmts)
+    else:
+        if chunk_size is None:
+            chunk_size = max(1, -(-num_realizations // (4 * processes)))
+        chunks = [flux[start:start+chunk_size]
+                  for start in range(0, num_realizations, chunk_size)]
+        job = pickle.dumps((circuit, qubits, state, msmts))
+        dm_statistics = MonteCarloStatistics()
+        msmt_statistics = MonteCarloStatistics()
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=processes, initializer=_init_flux_worker,
+                initargs=(job,)) as executor:
+            for dm_chunk, msmt_chunk in executor.map(_flux_worker, chunks):
+                dm_statistics.merge(dm_chunk)
+                msmt_statistics.merge(msmt_chunk)
+        set_flux(index, qubits, flux[-1])
+
+    results = {'density_matrix': dm_statistics}
+    if msmts:
+        results['expectation_values'] = msmt_statistics
+    return results
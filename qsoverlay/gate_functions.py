@@ -3,10 +3,39 @@ gate_functions: functions that take a builder and insert a a given set
 of gates, to be called from within the builder to execute either
 composite gates, or gates not natively within quantumsim.
 """
+import copy
+import functools
+
 import quantumsim.circuit
 from numpy import pi
 
 
+def copy_gate(prototype, time, name_map):
+    """
+    Copies a quantumsim gate to a new time and set of qubits
+    (as in quantumsim.circuit.Circuit.add_subcircuit).
+    The copy shares the PTM of the prototype.
+    """
+    gate = copy.copy(prototype)
+    gate.time = time
+    gate.involved_qubits = [name_map.get(bit, bit)
+                            for bit in prototype.involved_qubits]
+    return gate
+
+
+@functools.lru_cache(maxsize=1024)
+def _noisy_cphase_prototype(dephase_var):
+    return quantumsim.circuit.NoisyCPhase(
+        bit0='bit0', bit1='bit1', time=0, dephase_var=dephase_var)
+
+
+@functools.lru_cache(maxsize=1024)
+def _cphase_rotation_prototype(angle, dephase_var):
+    return quantumsim.circuit.CPhaseRotation(
+        angle=angle, bit0='bit0', bit1='bit1',
+        time=0, dephase_var=dephase_var)
+
+
 def X_gate(builder, bit, time):
     builder < ('RX', bit, -pi)
 
@@ -54,10 +83,10 @@ def insert_CZ(builder,
     """
     circuit = builder.circuit
 
-    g = quantumsim.circuit.NoisyCPhase(bit0=bit0,
-                                       bit1=bit1,
-                                       time=time,
-                                       dephase_var=dephase_var)
+    # The PTM of the gate only depends on dephase_var, so we
+    # copy a prototype instead of recalculating it.
+    g = copy_gate(_noisy_cphase_prototype(dephase_var), time,
+                  {'bit0': bit0, 'bit1': bit1})
     circuit.add_gate(g)
 
     if quasistatic_flux is not None:
@@ -68,6 +97,7 @@ def insert_CZ(builder,
                                         time=time * (1 + 1e-6))
         g2.quasistatic_flux_flag = True
         circuit.add_gate(g2)
+        builder.register_noise_gate('quasistatic_flux', bit0, g2)
 
 
 def insert_CPhase(builder,
@@ -86,9 +116,8 @@ def insert_CPhase(builder,
 
     circuit = builder.circuit
 
-    g = quantumsim.circuit.CPhaseRotation(angle=angle, bit0=bit0,
-                                          bit1=bit1, time=time,
-                                          dephase_var=dephase_var)
+    g = copy_gate(_cphase_rotation_prototype(angle, dephase_var), time,
+                  {'bit0': bit0, 'bit1': bit1})
 
     circuit.add_gate(g)
 
@@ -100,6 +129,7 @@ def insert_CPhase(builder,
                                         time=time * (1 + 1e-6))
         g2.quasistatic_flux_flag = True
         circuit.add_gate(g2)
+        builder.register_noise_gate('quasistatic_flux', bit0, g2)
 
 
 def insert_measurement(builder,
@@ -9,6 +9,131 @@ quantumsim.
 import numpy as np
 
 
+def kron_apply(factors, array, axis=-1):
+    """
+    Multiplies an axis of length 2^n of an array by the Kronecker
+    product of n 2x2 matrices, without forming the product, where
+    factors[n] acts on bit n of the index along the axis.
+    """
+    array = np.moveaxis(np.asarray(array), axis, -1)
+    shape = array.shape
+    tensor = array.reshape(shape[:-1] + (2,) * len(factors))
+    for n, factor in enumerate(factors):
+        # Bit n of the index is axis -(n+1) of the tensor.
+        bit_axis = tensor.ndim - 1 - n
+        tensor = np.moveaxis(
+            np.tensordot(factor, tensor, axes=([1], [bit_axis])),
+            0, bit_axis)
+    return np.moveaxis(tensor.reshape(shape), -1, axis)
+
+
+def apply_clusters(clusters, array):
+    """
+    Multiplies the last axis of length 2^n of an array by a matrix
+    acting on clusters of the n bits of the index, given as a list of
+    (positions, matrix) pairs, where matrix acts on the bits in
+    positions (with bit k of its index bit positions[k]).
+    """
+    shape = np.shape(array)
+    num_bits = int(np.log2(shape[-1]))
+    tensor = np.reshape(array, shape[:-1] + (2,) * num_bits)
+    for positions, matrix in clusters:
+        size = len(positions)
+        # Bit n of the index is axis -(n+1) of the tensor.
+        axes = [tensor.ndim - 1 - positions[n]
+                for n in reversed(range(size))]
+        tensor = np.tensordot(
+            matrix.reshape((2,) * (2 * size)), tensor,
+            axes=(list(range(size, 2 * size)), axes))
+        tensor = np.moveaxis(tensor, list(range(size)), axes)
+    return tensor.reshape(shape)
+
+
+def project_to_simplex(vectors):
+    """
+    Returns the closest probability distributions (in the least
+    squares sense) to an array of vectors along its last axis.
+    """
+    vectors = np.asarray(vectors, dtype=float)
+    size = vectors.shape[-1]
+    sorted_vectors = -np.sort(-vectors, axis=-1)
+    cumulative = np.cumsum(sorted_vectors, axis=-1) - 1
+    # The number of non-zero entries in the projection is the last
+    # k for which the k-th largest entry exceeds the shift.
+    positive = sorted_vectors * np.arange(1, size + 1) > cumulative
+    num_positive = size - np.argmax(positive[..., ::-1], axis=-1)
+    shift = np.take_along_axis(
+        cumulative, num_positive[..., None] - 1, axis=-1) /\
+        num_positive[..., None]
+    return np.maximum(vectors - shift, 0)
+
+
+def histogram(shots):
+    """
+    Returns the number of times every result occurs in a set of
+    shots (as returned by sample with output_format='full'), where
+    bit n of the index is the result of qubit n.
+    """
+    shots = np.asarray(shots)
+    results = shots.astype(np.int64) @ (1 << np.arange(shots.shape[1]))
+    return np.bincount(results, minlength=2**shots.shape[1])
+
+
+def bitmask(indices):
+    """
+    Returns the integer with the bits in indices set.
+    """
+    mask = 0
+    for index in indices:
+        mask |= 1 << int(index)
+    return mask
+
+
+def parity(values):
+    """
+    Returns the parity of the set bits of an array of
+    (at most 64 bit) non-negative integers.
+    """
+    values = np.array(values, dtype=np.uint64)
+    for shift in (32, 16, 8, 4, 2, 1):
+        values ^= values >> np.uint64(shift)
+    return (values & np.uint64(1)).astype(int)
+
+
+def pack_shots(shots):
+    """
+    Packs an array with a row of 0/1 results for every shot into
+    uint64 words, with bit n of word k the result of qubit 64 * k + n
+    (so one word per shot for up to 64 qubits).
+    """
+    shots = np.asarray(shots, dtype=np.uint64)
+    num_shots, num_qubits = shots.shape
+    num_words = -(-num_qubits // 64)
+    padded = np.zeros((num_shots, num_words * 64), dtype=np.uint64)
+    padded[:, :num_qubits] = shots
+    words = padded.reshape(num_shots, num_words, 64) <<\
+        np.arange(64, dtype=np.uint64)
+    return words.sum(axis=-1, dtype=np.uint64)
+
+
+def packed_parities(packed, output_format):
+    """
+    Returns the parity of the results of every list of qubit indices
+    in output_format, for shots packed by pack_shots, as an array with
+    a column for every list.
+    """
+    packed = np.asarray(packed, dtype=np.uint64)
+    parities = np.zeros((len(packed), len(output_format)), dtype=int)
+    for column, indices in enumerate(output_format):
+        words = {}
+        for index in indices:
+            words.setdefault(int(index) // 64, []).append(int(index) % 64)
+        for word, bits in words.items():
+            parities[:, column] ^= parity(
+                packed[:, word] & np.uint64(bitmask(bits)))
+    return parities
+
+
 class CorrelatedMeasurement:
     def __init__(self, qubits,
                  cc_matrix, populations,
@@ -27,97 +152,359 @@ class CorrelatedMeasurement:
             in order.
         """
 
+        self._setup(qubits, populations, random_state)
+        self.reported_cc_matrix = np.asarray(cc_matrix, dtype=float)
+
+        # Calculate the real cc matrix taking into account the
+        # fact that the experimental cc matrix is poisoned by
+        # the residual excitations not accounted for in experiment.
+        self.cc_matrix = kron_apply(
+            [factor.T for factor in self.pop_inverse_factors],
+            cc_matrix, axis=1)
+
+    def _setup(self, qubits, populations, random_state):
+        """
+        Sets up the qubits, the residual populations and the caches
+        shared by every measurement model.
+        """
         self.qubits = qubits
         self.num_qubits = len(qubits)
-        self.lit_string = r'{' + '0:0{}b'.format(self.num_qubits) + r'}'
         self.random_state = random_state
         self.EQ_TOL = 1e-9
+        self._inverse = None
+        self._output_tables = {}
 
-        pop_matrix = np.zeros([2**self.num_qubits, 2**self.num_qubits])
-
-        # Make pop_matrix
-        for j in range(2**self.num_qubits):
-            for k in range(2**self.num_qubits):
-                diff = j ^ k
-                pop_matrix[j, k] = 1
-                for n in range(self.num_qubits):
-                    if diff % 2 == 1:
-                        pop_matrix[j, k] *= populations[n]
-                    else:
-                        pop_matrix[j, k] *= (1-populations[n])
-                    diff = diff // 2
-                pop_matrix[k, j] = pop_matrix[j, k]
+        # The matrix of the residual populations is the Kronecker
+        # product of a 2x2 block for every qubit, so it is kept (and
+        # inverted) in factored form.
+        self.pop_factors = [np.array([[1 - p, p], [p, 1 - p]])
+                            for p in populations[:self.num_qubits]]
+        self.pop_inverse_factors = [np.linalg.inv(factor)
+                                    for factor in self.pop_factors]
 
-        # Calculate the real cc matrix taking into account the
-        # fact that the experimental cc matrix is poisoned by
-        # the residual excitations not accounted for in experiment.
-        self.cc_matrix = cc_matrix @ np.linalg.inv(pop_matrix)
+    def rho_vector(self, rho_dist):
+        """
+        Returns the distribution of the outcomes of the qubits, given
+        as the output of SparseDM.peak_multiple_measurements, as a
+        vector where bit n of the index is the outcome of qubit n.
+        """
+        outcomes = np.zeros(len(rho_dist), dtype=np.int64)
+        for n, q in enumerate(self.qubits):
+            outcomes |= np.array([x[0][q] for x in rho_dist],
+                                 dtype=np.int64) << n
+        return np.bincount(outcomes,
+                           weights=[x[1] for x in rho_dist],
+                           minlength=2**self.num_qubits)
+
+    def measurement_vector(self, rho_vec):
+        """
+        Returns the distribution of the measurement results
+        for a distribution of the outcomes of the qubits.
+        """
+        return self.cc_matrix @ rho_vec
+
+    def inverse_matrix(self):
+        """
+        Returns the inverse of the reported cc matrix (which is only
+        calculated once). As cc_matrix is the reported cc matrix times
+        the inverse of the residual population matrix, the inverse of
+        cc_matrix is this matrix followed by pop_factors (see unfold).
+        """
+        if self._inverse is None:
+            self._inverse = np.linalg.inv(self.reported_cc_matrix)
+        return self._inverse
+
+    def unfold(self, distributions):
+        """
+        Inverts measurement_vector for an array of distributions
+        of the measurement results along its last axis, applying
+        the residual populations factor by factor.
+        """
+        return kron_apply(self.pop_factors,
+                          distributions @ self.inverse_matrix().T)
+
+    def mitigate(self, histograms, project=True, output_format='full'):
+        """
+        Estimates the distributions of the outcomes of the qubits
+        from the distributions of the measurement results, by inverting
+        the measurement model (readout error mitigation).
+
+        @histograms: an array of histograms (see histogram) or
+            distributions (as returned by sample with
+            data_type='averages' and output_format='full') over the
+            2^n measurement results along its last axis. Any other
+            axes (e.g. for tomography settings) are mitigated at once.
+            Averages in any other output_format cannot be mitigated,
+            and raise a ValueError.
+        @project: whether to project every estimate onto the closest
+            probability distribution (see project_to_simplex).
+            Otherwise, the estimates may contain negative entries.
+        @output_format: a list of lists of qubit indices, to return
+            the probability that all qubits in every list are 1 (as
+            sample with data_type='averages') of the estimates
+            instead of the full distributions.
+        """
+        histograms = np.asarray(histograms, dtype=float)
+        if histograms.shape[-1] != 2**self.num_qubits:
+            raise ValueError(
+                'Can only mitigate distributions over all {} results '
+                '(output_format=\'full\'), got {} entries'.format(
+                    2**self.num_qubits, histograms.shape[-1]))
+        estimates = self.unfold(
+            histograms / histograms.sum(axis=-1, keepdims=True))
+        if project:
+            estimates = project_to_simplex(estimates)
+        if output_format != 'full':
+            estimates = estimates @ self.output_table(output_format).T
+        return estimates
 
     def sample(self, rho_dist,
                num_measurements,
                data_type='shots',  # If averages put single_shot to False in
                                    # tomo
-               output_format='full'):
+               output_format='full',
+               packed=False):
         """
         Calculates the true distribution of measurements from the
         peak_multiple_measurement function given in quantumsim,
         and generates a sampling of num_measurements measurements
         from this distribution.
-        """
-        # rho_vec will hold the leading diagonal of the density matrix
-        # (This is horribly inefficient, should be directly integrated
-        # with quantumsim.)
-        rho_vec = np.zeros(2**self.num_qubits)
-
-        for j in range(2**self.num_qubits):
-            j_list = list(reversed(self.lit_string.format(j)))
 
-            rho_vec[j] = sum([
-                x[1] for x in rho_dist if all([
-                    x[0][q] == int(j_list[n])
-                    for n, q in enumerate(self.qubits)])])
+        For data_type='shots', returns an array with a row for every
+        shot, holding the outcome of every qubit as uint8 (for
+        output_format 'full'), or the parity of the outcomes of every list of qubit
+        indices in output_format. If packed is True (and output_format
+        is 'full'), every shot is instead a row of uint64 words, where
+        bit n of word k is the outcome of qubit 64 * k + n (see
+        pack_shots).
+        """
+        rho_vec = self.rho_vector(rho_dist)
 
-        if np.abs(sum(rho_vec) - 1) > self.EQ_TOL:
-            raise ValueError('my rho normalization is: ', sum(rho_vec))
+        if np.abs(rho_vec.sum() - 1) > self.EQ_TOL:
+            raise ValueError('my rho normalization is: ', rho_vec.sum())
 
         # M_vec contains the measurement distributions.
-        M_vec = self.cc_matrix @ rho_vec
+        M_vec = self.measurement_vector(rho_vec)
 
-        if np.abs(sum(M_vec) - 1) > self.EQ_TOL:
-            raise ValueError('my measurement normalization is: ', sum(M_vec))
+        if np.abs(M_vec.sum() - 1) > self.EQ_TOL:
+            raise ValueError('my measurement normalization is: ',
+                             M_vec.sum())
 
         if data_type == 'shots':
 
-            measurements = self.random_state.choice(
-                range(2**self.num_qubits),
-                size=num_measurements,
-                p=M_vec)
-
-            measurements = [
-                np.array(list(reversed(self.lit_string.format(m))),
-                         dtype=int)
-                for m in measurements]
+            outcomes = self.random_state.choice(
+                2**self.num_qubits, size=num_measurements, p=M_vec)
 
-            if output_format is not 'full':
-                measurements = [[sum(m[indices]) % 2
-                                 for indices in output_format]
-                                for m in measurements]
+            if output_format != 'full':
+                masks = np.array([bitmask(indices)
+                                  for indices in output_format],
+                                 dtype=np.int64)
+                measurements = parity(outcomes[:, None] & masks)
+            else:
+                measurements = ((outcomes[:, None] >>
+                                 np.arange(self.num_qubits)) & 1
+                                ).astype(np.uint8)
+                if packed:
+                    measurements = pack_shots(measurements)
 
         else:
             measurements = M_vec
-            if output_format is not 'full':
-                measurements = [sum([m for j, m in enumerate(measurements)
-                                     if self.indices_in_j(indices, j)])
-                                for indices in output_format]
+            if output_format != 'full':
+                measurements = self.output_table(output_format) @ M_vec
 
         return measurements
 
+    def output_table(self, output_format):
+        """
+        Returns a matrix with a row for every list of qubit indices
+        in output_format, which picks out the measurement results
+        where all these qubits are 1 (see indices_in_j). The tables
+        are cached for every output_format.
+        """
+        key = tuple(tuple(indices) for indices in output_format)
+        if key not in self._output_tables:
+            masks = np.array([bitmask(indices) for indices in key],
+                             dtype=np.int64)[:, None]
+            results = np.arange(2**self.num_qubits, dtype=np.int64)
+            self._output_tables[key] =\
+                ((results & masks) == masks).astype(float)
+        return self._output_tables[key]
+
     @staticmethod
     def indices_in_j(indices, j):
-        n = 0
-        while j > 0:
-            if n in indices and j % 2 == 0:
-                return False
-            n += 1
-            j = j // 2
-        return True
+        """
+        Returns whether all the bits in indices are set in j.
+        """
+        mask = bitmask(indices)
+        return j & mask == mask
+
+
+class ClusteredMeasurement(CorrelatedMeasurement):
+
+    # The largest number of qubits to return the full distribution of
+    # the measurement results for (with data_type='averages').
+    max_full_qubits = 20
+
+    def __init__(self, qubits,
+                 clusters, populations,
+                 random_state):
+        """
+        A measurement model where the measurement crosstalk only acts
+        within clusters of neighbouring qubits, so that the model never
+        needs the full 2^n x 2^n cross-correlation matrix.
+
+        @qubits: list of qubits (giving order in which results
+            will be returned)
+        @clusters: a list of (cluster_qubits, cc_matrix) pairs, where
+            cc_matrix is the 2^m x 2^m cross-correlation measurement
+            matrix of the m qubits in cluster_qubits (with bit n of the
+            index the result of cluster_qubits[n]), as reported by an
+            experimentalist (see CorrelatedMeasurement). Every qubit may
+            be in at most one cluster; qubits in no cluster are read
+            out without crosstalk.
+        @populations: the residual excitations of the qubits
+            in order.
+        """
+        self._setup(qubits, populations, random_state)
+
+        positions = {qubit: n for n, qubit in enumerate(qubits)}
+        clustered = [qubit for cluster_qubits, _ in clusters
+                     for qubit in cluster_qubits]
+        if len(set(clustered)) < len(clustered):
+            raise ValueError('Qubits can only be in one cluster')
+        clusters = list(clusters) + [([qubit], np.eye(2))
+                                     for qubit in qubits
+                                     if qubit not in clustered]
+
+        # The cc matrix of every cluster, with the residual
+        # excitations taken out (see CorrelatedMeasurement), as
+        # (positions of the qubits, cc_matrix).
+        self.clusters = []
+        for cluster_qubits, cc_matrix in clusters:
+            cluster_positions = [positions[qubit] for qubit in cluster_qubits]
+            self.clusters.append((cluster_positions, kron_apply(
+                [self.pop_inverse_factors[n].T for n in cluster_positions],
+                cc_matrix, axis=1)))
+
+        # The cumulative distributions of the result of every cluster
+        # (for every outcome of its qubits), to sample shots from.
+        self.cumulative = []
+        for _, cc_matrix in self.clusters:
+            weights = np.clip(cc_matrix, 0, None)
+            self.cumulative.append(
+                np.cumsum(weights / weights.sum(axis=0), axis=0))
+
+    def measurement_vector(self, rho_vec):
+        """
+        Returns the distribution of the measurement results
+        for a distribution of the outcomes of the qubits (or an
+        array of distributions along its last axis).
+        """
+        return apply_clusters(self.clusters, rho_vec)
+
+    def inverse_matrix(self):
+        """
+        Returns the inverses of the cc matrices of the clusters, as
+        (positions, inverse) pairs (which are only calculated once).
+        """
+        if self._inverse is None:
+            self._inverse = [(positions, np.linalg.inv(cc_matrix))
+                             for positions, cc_matrix in self.clusters]
+        return self._inverse
+
+    def unfold(self, distributions):
+        """
+        Inverts measurement_vector, one cluster at a time.
+        """
+        return apply_clusters(self.inverse_matrix(), distributions)
+
+    def apply_to_shots(self, shots):
+        """
+        Returns the measurement results for a set of outcomes of the
+        qubits, given as an array with a row of outcomes for every shot
+        (as uint8). The cc matrices are applied as probabilities, so
+        any negative entries are set to zero.
+        """
+        shots = np.array(shots, dtype=np.uint8)
+        for (positions, _), cumulative in zip(self.clusters,
+                                              self.cumulative):
+            bits = np.arange(len(positions))
+            outcomes = shots[:, positions].astype(np.int64) @ (1 << bits)
+            draws = self.random_state.rand(len(shots))
+            results = np.sum(cumulative[:, outcomes] < draws, axis=0)
+            results = np.minimum(results, len(cumulative) - 1)
+            shots[:, positions] = (results[:, None] >> bits) & 1
+        return shots
+
+    def sample(self, rho_dist,
+               num_measurements,
+               data_type='shots',
+               output_format='full',
+               packed=False):
+        """
+        As CorrelatedMeasurement.sample. For data_type='shots', the
+        shots are sampled from the outcomes in rho_dist, and the
+        crosstalk is applied to every shot (see apply_to_shots), so
+        that the number of qubits is only limited by rho_dist.
+        For data_type='averages', the averages in output_format are
+        calculated from the clusters they involve only (see
+        marginal_averages); the full distribution is only returned
+        for up to max_full_qubits qubits.
+        """
+        probabilities = np.array([x[1] for x in rho_dist])
+        if np.abs(probabilities.sum() - 1) > self.EQ_TOL:
+            raise ValueError('my rho normalization is: ',
+                             probabilities.sum())
+
+        if data_type != 'shots':
+            if output_format != 'full':
+                return self.marginal_averages(rho_dist, output_format)
+            if self.num_qubits > self.max_full_qubits:
+                raise ValueError(
+                    'The full distribution of {} qubits is too large; '
+                    'ask for averages in output_format instead'
+                    .format(self.num_qubits))
+            return super().sample(rho_dist, num_measurements, data_type,
+                                  output_format)
+
+        outcomes = np.array([[x[0][q] for q in self.qubits]
+                             for x in rho_dist], dtype=np.uint8)
+        choices = self.random_state.choice(
+            len(rho_dist), size=num_measurements,
+            p=probabilities / probabilities.sum())
+        shots = self.apply_to_shots(outcomes[choices])
+
+        if output_format != 'full':
+            return packed_parities(pack_shots(shots), output_format)
+        if packed:
+            return pack_shots(shots)
+        return shots
+
+    def marginal_averages(self, rho_dist, output_format):
+        """
+        Returns the probability that all qubits in a list of qubit
+        indices are measured as 1, for every list in output_format
+        (as CorrelatedMeasurement.output_table), using only the
+        distribution of the qubits in the clusters of the list.
+        """
+        probabilities = np.array([x[1] for x in rho_dist])
+        averages = []
+        for indices in output_format:
+            clusters = [(positions, cc_matrix)
+                        for positions, cc_matrix in self.clusters
+                        if any(n in indices for n in positions)]
+            qubits = [n for positions, _ in clusters for n in positions]
+            local = {n: k for k, n in enumerate(qubits)}
+            outcomes = np.array(
+                [[x[0][self.qubits[n]] for n in qubits] for x in rho_dist],
+                dtype=np.int64).reshape(len(rho_dist), len(qubits)) @\
+                (1 << np.arange(len(qubits)))
+            rho_vec = np.bincount(outcomes, weights=probabilities,
+                                  minlength=2**len(qubits))
+            M_vec = apply_clusters(
+                [([local[n] for n in positions], cc_matrix)
+                 for positions, cc_matrix in clusters], rho_vec)
+            mask = bitmask(local[n] for n in indices)
+            results = np.arange(2**len(qubits), dtype=np.int64)
+            averages.append(M_vec[(results & mask) == mask].sum())
+        return np.array(averages)
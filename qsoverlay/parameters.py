@@ -0,0 +1,215 @@
+"""
+parameters: symbolic parameters for qsoverlay circuits.
+
+A string in the angle slot of a gate description (i.e.
+('RY', 'q0', 'theta_3')) is read by the builder as a symbolic
+parameter. The builder creates the gate at the current value of the
+parameter, and records the gate in a ParameterTable, which can later
+rebind the parameter by adjusting only the gates that depend on it.
+"""
+
+
+class Parameter:
+    '''
+    A symbolic parameter, representing scale * name + offset.
+    Composite gates can do affine arithmetic with parameters
+    (i.e. -angle / 2) before feeding them back to the builder.
+    '''
+
+    def __init__(self, name, scale=1, offset=0):
+        self.name = name
+        self.scale = scale
+        self.offset = offset
+
+    def value(self, values):
+        return self.scale * values[self.name] + self.offset
+
+    def __neg__(self):
+        return Parameter(self.name, -self.scale, -self.offset)
+
+    def __pos__(self):
+        return self
+
+    def __add__(self, other):
+        return Parameter(self.name, self.scale, self.offset + other)
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        return Parameter(self.name, self.scale, self.offset - other)
+
+    def __rsub__(self, other):
+        return Parameter(self.name, -self.scale, other - self.offset)
+
+    def __mul__(self, other):
+        return Parameter(self.name, self.scale * other, self.offset * other)
+
+    __rmul__ = __mul__
+
+    def __truediv__(self, other):
+        return Parameter(self.name, self.scale / other, self.offset / other)
+
+    def __eq__(self, other):
+        return isinstance(other, Parameter) and\
+            (self.name, self.scale, self.offset) ==\
+            (other.name, other.scale, other.offset)
+
+    def __hash__(self):
+        return hash((self.name, self.scale, self.offset))
+
+    def __repr__(self):
+        return 'Parameter({!r}, {}, {})'.format(
+            self.name, self.scale, self.offset)
+
+
+def as_parameter(arg):
+    '''
+    Converts a string (optionally starting with a minus sign)
+    to a Parameter. Other arguments are returned unchanged.
+    '''
+    if isinstance(arg, str):
+        if arg.startswith('-'):
+            return Parameter(arg[1:], -1)
+        return Parameter(arg)
+    return arg
+
+
+def is_symbolic(arg):
+    return isinstance(arg, (str, Parameter))
+
+
+def negate_symbolic(arg):
+    '''
+    Returns the negative of a gate argument in a circuit list,
+    toggling the minus sign of string parameters.
+    '''
+    if isinstance(arg, str):
+        return arg[1:] if arg.startswith('-') else '-' + arg
+    return -arg
+
+
+class ParameterTable:
+    '''
+    Records which gates in a circuit depend on which parameters,
+    so that parameters can be rebound without rebuilding the circuit.
+    '''
+
+    def __init__(self):
+        # List of (gate, arguments to gate.adjust), where the
+        # arguments are numbers or Parameters.
+        self.gates = []
+        # Indices in self.gates of the gates using each parameter.
+        self.index = {}
+        # The current value of every parameter (starting at 0).
+        self.values = {}
+        # Whether the lists above are shared with a fork (see fork),
+        # and the function called on the gates before bind changes
+        # them, which returns the gates to change (see Builder.fork).
+        self._shared = False
+        self.claim = None
+
+    @property
+    def names(self):
+        '''
+        The parameter names in order of first appearance, which is
+        the order of the vector accepted by bind.
+        '''
+        return list(self.index)
+
+    def evaluate(self, args):
+        '''
+        Returns the values of a list of arguments, with
+        unknown parameters taken to be 0.
+        '''
+        return [arg.scale * self.values.get(arg.name, 0) + arg.offset
+                if isinstance(arg, Parameter) else arg for arg in args]
+
+    def add(self, gate, args):
+        '''
+        Records a gate whose adjust method takes args
+        (with at least one of these a Parameter).
+        '''
+        if self._shared:
+            self._shared = False
+            self.gates = list(self.gates)
+            self.index = {name: list(indices)
+                          for name, indices in self.index.items()}
+        n = len(self.gates)
+        self.gates.append((gate, args))
+        for arg in args:
+            if isinstance(arg, Parameter):
+                self.values.setdefault(arg.name, 0)
+                indices = self.index.setdefault(arg.name, [])
+                if not indices or indices[-1] != n:
+                    indices.append(n)
+
+    def bind(self, values):
+        '''
+        Sets the value of a set of parameters, adjusting the gates
+        that depend on them.
+
+        values: either a dictionary from parameter names to values
+            (names not in this table are ignored), or a vector of
+            values in the order of self.names.
+        '''
+        if not isinstance(values, dict):
+            names = self.names
+            if len(values) != len(names):
+                raise ValueError(
+                    'Expected {} parameter values ({}), got {}'.format(
+                        len(names), ', '.join(names), len(values)))
+            values = dict(zip(names, values))
+
+        changed = set()
+        for name, value in values.items():
+            if name in self.index and self.values[name] != value:
+                self.values[name] = value
+                changed.update(self.index[name])
+
+        indices = sorted(changed)
+        gates = [self.gates[n][0] for n in indices]
+        if self.claim is not None:
+            gates = self.claim(gates)
+        for gate, n in zip(gates, indices):
+            gate.adjust(*self.evaluate(self.gates[n][1]))
+
+    def copy(self, gate_map):
+        '''
+        Returns a copy of the table for a copy of the circuit, where
+        gate_map maps the id of every copied gate to the gate in the
+        copy (other gates are shared with the copy).
+        '''
+        table = ParameterTable()
+        table.gates = [(gate_map.get(id(gate), gate), args)
+                       for gate, args in self.gates]
+        table.index = {name: list(indices)
+                       for name, indices in self.index.items()}
+        table.values = dict(self.values)
+        return table
+
+    def fork(self):
+        '''
+        Returns a copy of the table sharing the gates with this one
+        (with its own parameter values), for a fork of the builder.
+        Either table copies its lists before adding a gate.
+        '''
+        table = ParameterTable()
+        table.gates = self.gates
+        table.index = self.index
+        table.values = dict(self.values)
+        self._shared = table._shared = True
+        return table
+
+    def remap(self, gate_map):
+        '''
+        Replaces gates in the table, where gate_map maps the id of
+        every replaced gate to its replacement.
+        '''
+        self.gates = [(gate_map.get(id(gate), gate), args)
+                      for gate, args in self.gates]
+
+    def __getstate__(self):
+        # The claim function belongs to a builder, which is not stored.
+        state = dict(self.__dict__)
+        state['claim'] = None
+        return state
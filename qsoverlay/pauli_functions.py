@@ -0,0 +1,274 @@
+"""
+pauli_functions: expectation values of Pauli strings on quantumsim
+states, calculated without building the Pauli operators.
+
+The numpy density matrices of quantumsim (DensityNP) store the state in
+the Pauli basis [|0><0|, X/sqrt(2), Y/sqrt(2), |1><1|] of every qubit,
+so the expectation value of a Pauli string can be read off directly
+from at most 2^n entries. Other density matrices are converted to a
+dense matrix, on which a Pauli string picks out one entry in every row.
+
+For estimates from a finite number of shots, Pauli strings are grouped
+into qubit-wise commuting sets that are measured from shared shots.
+"""
+import numpy as np
+import quantumsim.circuit
+from .state_functions import copy_state
+
+_sqrt2 = np.sqrt(2)
+
+
+def pauli_label(label):
+    '''
+    Returns 'I', 'X', 'Y' or 'Z' for a Pauli label
+    (where the identity may also be given as 1).
+    '''
+    if label == 1 or label == 'I':
+        return 'I'
+    if label in ('X', 'Y', 'Z'):
+        return label
+    raise ValueError('qubit measurements must be X, Y, Z')
+
+
+def pauli_expectation_ptm(dm, labels):
+    '''
+    Returns the expectation value of a Pauli string on a density
+    matrix in the Pauli basis.
+
+    dm: the density matrix as a tensor with one axis of length 4 for
+        every qubit, in reverse qubit order (as DensityNP.dm).
+    labels: a list with the Pauli label of every qubit.
+    '''
+    # X and Y pick a single element along their axis, while I and Z
+    # sum the two diagonal elements (with a sign for Z), so the
+    # result depends on at most 2^n entries of dm.
+    index = []
+    diagonal_labels = []
+    for label in reversed(labels):
+        if label == 'X':
+            index.append(1)
+        elif label == 'Y':
+            index.append(2)
+        else:
+            index.append(slice(None, None, 3))
+            diagonal_labels.append(label)
+
+    values = dm[tuple(index)]
+    for label in reversed(diagonal_labels):
+        if label == 'Z':
+            values = values[..., 0] - values[..., 1]
+        else:
+            values = values[..., 0] + values[..., 1]
+
+    return float(values) * _sqrt2 ** (len(labels) - len(diagonal_labels))
+
+
+def pauli_expectation_dense(dm, labels):
+    '''
+    Returns the expectation value of a Pauli string on a dense
+    density matrix, where qubit i is bit i of the row index.
+
+    dm: the density matrix as a 2^n x 2^n array.
+    labels: a list with the Pauli label of every qubit.
+    '''
+    # A Pauli string P has one non-zero entry in every row j, in
+    # column j ^ x_mask, which is (-i)^(number of Ys) times the
+    # parity of the Z and Y bits of j.
+    x_mask = 0
+    phase_bits = []
+    num_y = 0
+    for n, label in enumerate(labels):
+        if label in ('X', 'Y'):
+            x_mask |= 1 << n
+        if label in ('Y', 'Z'):
+            phase_bits.append(n)
+        if label == 'Y':
+            num_y += 1
+
+    rows = np.arange(dm.shape[0])
+    parity = np.zeros(dm.shape[0], dtype=int)
+    for n in phase_bits:
+        parity ^= (rows >> n) & 1
+
+    result = (-1j) ** num_y * np.sum(
+        (1 - 2 * parity) * dm[rows ^ x_mask, rows])
+    assert np.abs(np.imag(result)) < 1e-9
+    return float(np.real(result))
+
+
+def expectation_values(state, msmts):
+    '''
+    Returns the expectation values of a list of Pauli strings on a
+    SparseDM. Qubits outside the dense part of the state are in a
+    basis state, so only contribute a sign (for Z) or zero (for X, Y).
+
+    msmts: a list of dictionaries, containing 'X', 'Y' or 'Z' for
+        each non-trivial qubit label.
+    '''
+    state.apply_all_pending()
+    state.renormalize()
+
+    dm = getattr(state.full_dm, 'dm', None)
+    if isinstance(dm, np.ndarray):
+        expectation = pauli_expectation_ptm
+    else:
+        dm = state.full_dm.to_array()
+        expectation = pauli_expectation_dense
+
+    num_dense = len(state.idx_in_full_dm)
+    results = []
+    for msmt in msmts:
+        mult = 1
+        labels = ['I'] * num_dense
+        for qubit, label in msmt.items():
+            label = pauli_label(label)
+            if qubit in state.idx_in_full_dm:
+                labels[state.idx_in_full_dm[qubit]] = label
+            elif label == 'Z':
+                mult *= (-1) ** state.classical[qubit]
+            elif label != 'I':
+                mult = 0
+
+        if mult == 0:
+            results.append(0.)
+        else:
+            results.append(mult * expectation(dm, labels))
+
+    return np.array(results)
+
+
+def qubitwise_commuting_groups(msmts, weights=None):
+    '''
+    Partitions a list of Pauli strings into groups that commute
+    qubit-wise (i.e. every qubit has the same Pauli in every string
+    of the group that acts on it), so that every group can be measured
+    from the same shots. Strings are placed greedily, in order of
+    decreasing absolute weight, in the first group they fit in.
+
+    msmts: a list of dictionaries from qubits to Pauli labels.
+    weights: the weight of every string (by default all 1).
+    Returns a list of (basis, indices) pairs, where basis is a
+    dictionary from qubits to the Pauli measured on them, and indices
+    lists the strings in the group.
+    '''
+    if weights is None:
+        weights = [1] * len(msmts)
+    order = sorted(range(len(msmts)), key=lambda n: -abs(weights[n]))
+
+    groups = []
+    for n in order:
+        msmt = {qubit: pauli_label(label)
+                for qubit, label in msmts[n].items()}
+        msmt = {qubit: label for qubit, label in msmt.items()
+                if label != 'I'}
+        for basis, indices in groups:
+            if all(basis.get(qubit, label) == label
+                   for qubit, label in msmt.items()):
+                basis.update(msmt)
+                indices.append(n)
+                break
+        else:
+            groups.append((msmt, [n]))
+
+    return groups
+
+
+def basis_change_circuit(basis, title='basis change'):
+    '''
+    Returns a quantumsim circuit of noiseless rotations that maps the
+    eigenbasis of the Pauli of every qubit in basis to the Z basis.
+    '''
+    circuit = quantumsim.circuit.Circuit(title)
+    for qubit, label in sorted(basis.items()):
+        if label == 'X':
+            circuit.add_gate(quantumsim.circuit.RotateY(
+                bit=qubit, time=0, angle=-np.pi/2))
+        elif label == 'Y':
+            circuit.add_gate(quantumsim.circuit.RotateX(
+                bit=qubit, time=0, angle=np.pi/2))
+    return circuit
+
+
+def allocate_shots(group_weights, num_shots):
+    '''
+    Splits num_shots over groups, giving every group one shot first
+    and the rest in proportion to their weights (rounding by largest
+    remainder). If all weights are zero, the rest is split evenly.
+    '''
+    group_weights = np.abs(np.array(group_weights, dtype=float))
+    if num_shots < len(group_weights):
+        raise ValueError('Need at least one shot for each of the '
+                         '{} groups'.format(len(group_weights)))
+    if group_weights.sum() == 0:
+        group_weights = np.ones(len(group_weights))
+    num_free = num_shots - len(group_weights)
+    exact = num_free * group_weights / group_weights.sum()
+    shots = np.floor(exact).astype(int)
+    remainder = num_free - shots.sum()
+    if remainder > 0:
+        shots[np.argsort(shots - exact)[:remainder]] += 1
+    return shots + 1
+
+
+def sample_group(state, basis, msmts, num_shots, random_state=np.random):
+    '''
+    Estimates the expectation values of a group of qubit-wise
+    commuting Pauli strings on a SparseDM from num_shots shared
+    shots in the basis of the group. The state is not changed.
+
+    Returns an array with the estimate of every string in msmts.
+    '''
+    state = copy_state(state)
+    # Qubits in a basis state still give random outcomes in X or Y.
+    for qubit, label in basis.items():
+        if label != 'Z':
+            state.ensure_dense(qubit)
+    basis_change_circuit(basis).apply_to(state)
+    state.renormalize()
+
+    probabilities = np.clip(state.full_dm.get_diag(), 0, None)
+    counts = random_state.multinomial(
+        num_shots, probabilities / probabilities.sum())
+    outcomes = np.arange(len(counts))
+
+    estimates = []
+    for msmt in msmts:
+        sign = 1
+        parity = np.zeros(len(counts), dtype=int)
+        for qubit, label in msmt.items():
+            if pauli_label(label) == 'I':
+                continue
+            if qubit in state.idx_in_full_dm:
+                parity ^= (outcomes >> state.idx_in_full_dm[qubit]) & 1
+            else:
+                sign *= (-1) ** state.classical[qubit]
+        estimates.append(sign * np.dot(counts, 1 - 2 * parity) / num_shots)
+
+    return np.array(estimates)
+
+
+def sample_expectation_values(state, msmts, num_shots, weights=None,
+                              random_state=np.random):
+    '''
+    Estimates the expectation values of a list of Pauli strings on a
+    SparseDM from a total of num_shots shots. The strings are grouped
+    with qubitwise_commuting_groups, the shots are allocated to the
+    groups in proportion to the summed absolute weights of their
+    strings, and all strings in a group are estimated from the
+    same shots (see sample_group).
+
+    Returns an array with the estimate of every string in msmts.
+    '''
+    if weights is None:
+        weights = [1] * len(msmts)
+    groups = qubitwise_commuting_groups(msmts, weights)
+    shots = allocate_shots(
+        [sum(abs(weights[n]) for n in indices) for _, indices in groups],
+        num_shots)
+
+    results = np.zeros(len(msmts))
+    for (basis, indices), group_shots in zip(groups, shots):
+        results[indices] = sample_group(
+            state, basis, [msmts[n] for n in indices], group_shots,
+            random_state)
+    return results
@@ -0,0 +1,568 @@
+"""
+qasm_reader: a streaming reader for OpenQASM 2 files, converting them into
+qsoverlay circuit lists (see circuit_builder.Builder.add_openqasm).
+
+The reader supports qreg/creg declarations, register indexing and
+broadcasting, gate definitions (compiled once, and expanded once per set
+of parameters), barrier, measure and reset. Gates from qelib1.inc are
+translated to the names of the qsoverlay gate set by a gate map, or
+defined in terms of other gates (see builtin_gates).
+Classical control (if statements) and opaque gates are not supported.
+"""
+import io
+import math
+import re
+
+from numpy import pi
+
+# Marks a barrier in the stream of gate descriptions from the reader
+# (a barrier description is (BARRIER, qubit0, qubit1, ..)).
+BARRIER = 'barrier'
+
+
+def euler_angles(theta, phi, lamda):
+    """
+    Returns the arguments (phi, theta, lamda) of a RotateEuler gate
+    for the qasm gate U(theta, phi, lamda) (up to a global phase).
+    """
+    return phi + pi / 2, theta, lamda - pi / 2
+
+
+def u2_euler_angles(phi, lamda):
+    """
+    Returns the arguments of a RotateEuler gate for u2(phi, lamda).
+    """
+    return euler_angles(pi / 2, phi, lamda)
+
+
+# Translation of qelib1.inc gates to the DiCarlo gate set.
+# Each entry is either the name of a gate in the gate_dic, a
+# tuple of the gate name and arguments to append after the qubits,
+# or a tuple of the gate name and a function converting the qasm
+# parameters into the arguments. Gates mapped to None are ignored.
+default_gate_map = {
+    'id': None,
+    'x': 'X',
+    'y': 'Y',
+    'z': 'Z',
+    'h': 'H',
+    's': ('RZ', pi / 2),
+    'sdg': ('RZ', -pi / 2),
+    't': ('RZ', pi / 4),
+    'tdg': ('RZ', -pi / 4),
+    'rx': 'RX',
+    'ry': 'RY',
+    'rz': 'RZ',
+    'u1': 'RZ',
+    'U': ('RotateEuler', euler_angles),
+    'u3': ('RotateEuler', euler_angles),
+    'u2': ('RotateEuler', u2_euler_angles),
+    'cx': 'CNOT',
+    'CX': 'CNOT',
+    'cz': 'CZ',
+    'cu1': 'CPhase',
+    'reset': 'Reset',
+    'measure': 'Measure'
+}
+
+# Gates of qelib1.inc defined in terms of other gates, used
+# when they are not in the gate map.
+builtin_gates = '''
+gate swap a, b { cx a, b; cx b, a; cx a, b; }
+'''
+
+_token_re = re.compile(
+    r'(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?'  # numbers
+    r'|[A-Za-z_]\w*'  # identifiers
+    r'|"[^"]*"'  # strings
+    r'|->|=='
+    r'|\S')
+
+_functions = {
+    'sin': math.sin,
+    'cos': math.cos,
+    'tan': math.tan,
+    'exp': math.exp,
+    'ln': math.log,
+    'sqrt': math.sqrt
+}
+
+_binary_ops = {
+    '+': lambda a, b: a + b,
+    '-': lambda a, b: a - b,
+    '*': lambda a, b: a * b,
+    '/': lambda a, b: a / b,
+    '^': lambda a, b: a ** b
+}
+
+
+class QasmError(ValueError):
+    pass
+
+
+def tokenize_qasm(text):
+    """
+    Splits a piece of (comment-free) qasm into a list of tokens.
+    """
+    return _token_re.findall(text)
+
+
+def read_chunks(source, chunk_size=1 << 16):
+    """
+    Yields complete lines of text from a file name or a file object,
+    reading chunk_size characters at a time.
+    """
+    if isinstance(source, str):
+        with open(source, 'r') as infile:
+            yield from read_chunks(infile, chunk_size)
+        return
+
+    tail = ''
+    while True:
+        chunk = source.read(chunk_size)
+        if not chunk:
+            break
+        lines = (tail + chunk).split('\n')
+        tail = lines.pop()
+        yield from lines
+    if tail:
+        yield tail
+
+
+class QasmReader:
+
+    def __init__(self, register_map=None, gate_map=None,
+                 gate_names=None, chunk_size=1 << 16):
+        """
+        A streaming reader converting OpenQASM 2 into gate descriptions
+        for a qsoverlay builder.
+
+        @register_map: a dictionary from register names to the list of
+            names of the qubits (or classical bits) in the register.
+            Registers not in the map are named register + index
+            (i.e. q[3] becomes 'q3').
+        @gate_map: translation of qasm gate names to gates in the
+            gate_dic of the builder (see default_gate_map).
+        @gate_names: the names of the gates in the gate_dic of the
+            builder, which can be called directly. Calling any other
+            gate that is neither in the map nor defined (in the qasm
+            or in builtin_gates) raises a QasmError.
+        @chunk_size: number of characters read from the file at once.
+        """
+        self.register_map = register_map or {}
+        self.gate_map = default_gate_map if gate_map is None else gate_map
+        self.gate_names = set(gate_names or [])
+        self.chunk_size = chunk_size
+
+        self.registers = {}
+        self.line_number = 0
+
+        # The builtin gates are compiled like any gate definition,
+        # but kept apart, as the gate map takes precedence over them.
+        self.gate_definitions = {}
+        for tokens in self.statements(io.StringIO(builtin_gates)):
+            self.define_gate(tokens)
+        self.builtin_definitions = self.gate_definitions
+        self.gate_definitions = {}
+        self.line_number = 0
+
+        # Expansions of defined gates for a given set of parameters,
+        # stored in terms of the positions of the qubit arguments.
+        self._expansions = {}
+
+    def read(self, source):
+        """
+        Yields the circuit list of a qasm file (given as a file name
+        or a file object), one gate description at a time. Barriers
+        are returned as (BARRIER, qubit0, qubit1, ..).
+        Errors are raised as QasmErrors, giving the line number
+        of the end of the statement.
+        """
+        for tokens in self.statements(source):
+            try:
+                descs = self.parse_statement(tokens)
+            except QasmError as error:
+                raise QasmError('Line {}: {}'.format(
+                    self.line_number, error)) from None
+            yield from descs
+
+    def statements(self, source):
+        """
+        Yields the token list of each statement in the source
+        (without the closing semicolon). Gate definitions are
+        returned as a single statement including their body.
+        """
+        tokens = []
+        depth = 0
+        for line in read_chunks(source, self.chunk_size):
+            self.line_number += 1
+            comment = line.find('//')
+            if comment >= 0:
+                line = line[:comment]
+
+            line_tokens = _token_re.findall(line)
+            if not line_tokens:
+                continue
+
+            # Quick path for lines of complete statements.
+            if depth == 0 and line_tokens[-1] == ';' and\
+                    '{' not in line_tokens and '}' not in line_tokens:
+                start = 0
+                for n, token in enumerate(line_tokens):
+                    if token == ';':
+                        if tokens:
+                            yield tokens + line_tokens[start:n]
+                            tokens = []
+                        elif n > start:
+                            yield line_tokens[start:n]
+                        start = n + 1
+                continue
+
+            for token in line_tokens:
+                if token == '{':
+                    depth += 1
+                    tokens.append(token)
+                elif token == '}':
+                    depth -= 1
+                    tokens.append(token)
+                    if depth == 0:
+                        yield tokens
+                        tokens = []
+                elif token == ';' and depth == 0:
+                    if tokens:
+                        yield tokens
+                    tokens = []
+                else:
+                    tokens.append(token)
+
+        if tokens or depth != 0:
+            raise QasmError('Unexpected end of file: {}'.format(
+                ' '.join(tokens)))
+
+    def parse_statement(self, tokens):
+        """
+        Converts the tokens of a single statement into a list of gate
+        descriptions.
+        """
+        keyword = tokens[0]
+
+        if keyword in ('OPENQASM', 'include'):
+            return []
+
+        if keyword in ('qreg', 'creg'):
+            if len(tokens) != 5 or tokens[2] != '[' or tokens[4] != ']':
+                raise QasmError('Invalid register: ' + ' '.join(tokens))
+            name = tokens[1]
+            size = int(tokens[3])
+            if name in self.register_map:
+                bits = list(self.register_map[name])
+                if len(bits) != size:
+                    raise QasmError(
+                        'Register {} has size {}, but {} names were '
+                        'given'.format(name, size, len(bits)))
+            else:
+                bits = [name + str(j) for j in range(size)]
+            self.registers[name] = bits
+            return []
+
+        if keyword == 'gate':
+            self.define_gate(tokens)
+            return []
+
+        if keyword in ('opaque', 'if'):
+            raise QasmError('{} statements are not supported'.format(
+                keyword))
+
+        if keyword == 'measure':
+            try:
+                arrow = tokens.index('->')
+            except ValueError:
+                raise QasmError('Invalid measurement: ' + ' '.join(tokens))
+            qubits = self.parse_argument(tokens[1:arrow])
+            bits = self.parse_argument(tokens[arrow+1:])
+            if len(qubits) != len(bits):
+                raise QasmError('Register sizes do not match: ' +
+                                ' '.join(tokens))
+            return [(self.gate_map.get('measure', 'Measure'), qubit, bit)
+                    for qubit, bit in zip(qubits, bits)]
+
+        if keyword == 'barrier':
+            qubits = [qubit for arg in _split_list(tokens[1:])
+                      for qubit in self.parse_argument(arg)]
+            return [(BARRIER, *qubits)]
+
+        name, params, args = self.parse_call(tokens)
+        param_values = [_evaluate(param, {}) for param in params]
+        arg_lists = [self.parse_argument(arg) for arg in args]
+
+        # Broadcast over registers.
+        num_calls = max(len(arg) for arg in arg_lists)
+        if any(len(arg) not in (1, num_calls) for arg in arg_lists):
+            raise QasmError('Register sizes do not match: ' +
+                            ' '.join(tokens))
+
+        descs = []
+        for j in range(num_calls):
+            qubits = [arg[j] if len(arg) > 1 else arg[0]
+                      for arg in arg_lists]
+            descs.extend(self.expand(name, param_values, qubits))
+        return descs
+
+    def parse_call(self, tokens):
+        """
+        Splits a gate call into its name, parameter expressions
+        and the token lists of its arguments.
+        """
+        name = tokens[0]
+        if len(tokens) > 1 and tokens[1] == '(':
+            close = _matching_bracket(tokens, 1)
+            params = [_parse_expression(param)
+                      for param in _split_list(tokens[2:close])]
+            arg_tokens = tokens[close+1:]
+        else:
+            params = []
+            arg_tokens = tokens[1:]
+        return name, params, _split_list(arg_tokens)
+
+    def parse_argument(self, tokens):
+        """
+        Returns the list of bit names referred to by an argument
+        (either a full register, or an element of one).
+        """
+        try:
+            register = self.registers[tokens[0]]
+        except KeyError:
+            raise QasmError('Unknown register: ' + tokens[0])
+        if len(tokens) == 1:
+            return register
+        if len(tokens) != 4 or tokens[1] != '[' or tokens[3] != ']' or\
+                not tokens[2].isdigit():
+            raise QasmError('Invalid argument: ' + ' '.join(tokens))
+        index = int(tokens[2])
+        if index >= len(register):
+            raise QasmError('Index out of range of register {}: {}'.format(
+                tokens[0], ' '.join(tokens)))
+        return [register[index]]
+
+    def define_gate(self, tokens):
+        """
+        Compiles a gate definition
+        gate name(param0, ..) arg0, .. { body }.
+        The body is stored as a list of (name, parameter expressions,
+        argument positions).
+        """
+        open_brace = tokens.index('{')
+        if tokens[-1] != '}':
+            raise QasmError('Invalid gate definition: ' + ' '.join(tokens))
+
+        name, params, args = self.parse_call(tokens[1:open_brace])
+        param_names = [param[1] for param in params]
+        if any(param[0] != 'var' for param in params):
+            raise QasmError('Invalid gate parameters: ' + ' '.join(tokens))
+        arg_positions = {arg[0]: n for n, arg in enumerate(args)}
+
+        body = []
+        statement = []
+        for token in tokens[open_brace+1:-1]:
+            if token != ';':
+                statement.append(token)
+                continue
+            if statement[0] == 'barrier':
+                statement = []
+                continue
+            call_name, call_params, call_args = self.parse_call(statement)
+            try:
+                positions = [arg_positions[arg[0]] for arg in call_args]
+            except KeyError:
+                raise QasmError('Unknown argument in gate {}: {}'.format(
+                    name, ' '.join(statement)))
+            body.append((call_name, call_params, positions))
+            statement = []
+        if statement:
+            raise QasmError('Missing ; in gate {}: {}'.format(
+                name, ' '.join(statement)))
+
+        self.gate_definitions[name] = (param_names, body)
+
+    def expand(self, name, param_values, qubits):
+        """
+        Returns the gate descriptions for a gate call
+        on a given list of qubits.
+        """
+        if name in self.gate_definitions or (
+                name not in self.gate_map and
+                name in self.builtin_definitions):
+            key = (name, *param_values)
+            try:
+                expansion = self._expansions[key]
+            except KeyError:
+                expansion = self._expand_definition(name, param_values)
+                self._expansions[key] = expansion
+            return [(gate_name, *[qubits[n] for n in positions], *args)
+                    for gate_name, positions, args in expansion]
+
+        try:
+            target = self.gate_map[name]
+        except KeyError:
+            if name not in self.gate_names:
+                raise QasmError('Unknown gate: ' + name)
+            target = name
+        if target is None:
+            return []
+        if isinstance(target, tuple):
+            if len(target) == 2 and callable(target[1]):
+                try:
+                    args = target[1](*param_values)
+                except TypeError:
+                    raise QasmError('Wrong number of parameters for ' + name)
+                return [(target[0], *qubits, *args)]
+            return [(target[0], *qubits, *target[1:], *param_values)]
+        return [(target, *qubits, *param_values)]
+
+    def _expand_definition(self, name, param_values):
+        """
+        Expands a defined gate into gates of the gate set, as
+        a list of (gate_name, argument positions, parameters).
+        """
+        if name in self.gate_definitions:
+            param_names, body = self.gate_definitions[name]
+        else:
+            param_names, body = self.builtin_definitions[name]
+        if len(param_names) != len(param_values):
+            raise QasmError('Gate {} takes {} parameters'.format(
+                name, len(param_names)))
+        env = dict(zip(param_names, param_values))
+
+        expansion = []
+        for call_name, call_params, positions in body:
+            values = [_evaluate(param, env) for param in call_params]
+            for desc in self.expand(call_name, values, positions):
+                expansion.append((desc[0], desc[1:len(positions)+1],
+                                  desc[len(positions)+1:]))
+        return expansion
+
+
+def _split_list(tokens):
+    """
+    Splits a list of tokens at the top-level commas.
+    """
+    result = []
+    current = []
+    depth = 0
+    for token in tokens:
+        if token == ',' and depth == 0:
+            result.append(current)
+            current = []
+            continue
+        if token in ('(', '['):
+            depth += 1
+        elif token in (')', ']'):
+            depth -= 1
+        current.append(token)
+    if current:
+        result.append(current)
+    return result
+
+
+def _matching_bracket(tokens, start):
+    depth = 0
+    for n in range(start, len(tokens)):
+        if tokens[n] == '(':
+            depth += 1
+        elif tokens[n] == ')':
+            depth -= 1
+            if depth == 0:
+                return n
+    raise QasmError('Unmatched bracket: ' + ' '.join(tokens))
+
+
+def _parse_expression(tokens):
+    """
+    Parses an arithmetic expression into a tree of tuples:
+    ('num', value), ('var', name), ('neg', a), ('call', function, a)
+    or (operator, a, b). Constant subexpressions are evaluated.
+    """
+    expr, n = _parse_sum(tokens, 0)
+    if n != len(tokens):
+        raise QasmError('Invalid expression: ' + ' '.join(tokens))
+    return expr
+
+
+def _fold(expr):
+    if all(arg[0] == 'num' for arg in expr[1:] if type(arg) is tuple):
+        return ('num', _evaluate(expr, {}))
+    return expr
+
+
+def _parse_sum(tokens, n):
+    expr, n = _parse_product(tokens, n)
+    while n < len(tokens) and tokens[n] in ('+', '-'):
+        right, m = _parse_product(tokens, n + 1)
+        expr = _fold((tokens[n], expr, right))
+        n = m
+    return expr, n
+
+
+def _parse_product(tokens, n):
+    expr, n = _parse_power(tokens, n)
+    while n < len(tokens) and tokens[n] in ('*', '/'):
+        right, m = _parse_power(tokens, n + 1)
+        expr = _fold((tokens[n], expr, right))
+        n = m
+    return expr, n
+
+
+def _parse_power(tokens, n):
+    expr, n = _parse_unary(tokens, n)
+    if n < len(tokens) and tokens[n] == '^':
+        right, n = _parse_power(tokens, n + 1)
+        expr = _fold(('^', expr, right))
+    return expr, n
+
+
+def _parse_unary(tokens, n):
+    if n >= len(tokens):
+        raise QasmError('Invalid expression: ' + ' '.join(tokens))
+    if tokens[n] == '-':
+        expr, n = _parse_unary(tokens, n + 1)
+        return _fold(('neg', expr)), n
+    if tokens[n] == '+':
+        return _parse_unary(tokens, n + 1)
+    return _parse_primary(tokens, n)
+
+
+def _parse_primary(tokens, n):
+    token = tokens[n]
+    if token == '(':
+        expr, n = _parse_sum(tokens, n + 1)
+        if n >= len(tokens) or tokens[n] != ')':
+            raise QasmError('Invalid expression: ' + ' '.join(tokens))
+        return expr, n + 1
+    if token == 'pi':
+        return ('num', pi), n + 1
+    if token in _functions and n + 1 < len(tokens) and\
+            tokens[n + 1] == '(':
+        expr, n = _parse_primary(tokens, n + 1)
+        return _fold(('call', token, expr)), n
+    if token[0].isdigit() or token[0] == '.':
+        return ('num', float(token)), n + 1
+    if token[0].isalpha() or token[0] == '_':
+        return ('var', token), n + 1
+    raise QasmError('Invalid expression: ' + ' '.join(tokens))
+
+
+def _evaluate(expr, env):
+    kind = expr[0]
+    if kind == 'num':
+        return expr[1]
+    if kind == 'var':
+        try:
+            return env[expr[1]]
+        except KeyError:
+            raise QasmError('Unknown parameter: ' + expr[1])
+    if kind == 'neg':
+        return -_evaluate(expr[1], env)
+    if kind == 'call':
+        return _functions[expr[1]](_evaluate(expr[2], env))
+    return _binary_ops[kind](_evaluate(expr[1], env),
+                             _evaluate(expr[2], env))
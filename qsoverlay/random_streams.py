@@ -0,0 +1,75 @@
+"""
+random_streams: named, independent random number streams derived from
+a single root seed (following numpy's SeedSequence).
+
+Every sampler, noise process and worker draws from its own stream,
+named for instance ('sampler', 'q0') or ('quasistatic_flux', 'q1').
+A stream only depends on the root seed and its name, not on the order
+in which the streams are created, so results stay identical however
+the work is divided over processes.
+"""
+import hashlib
+
+import numpy as np
+
+
+def _name_key(part):
+    '''
+    Converts part of a stream name to a non-negative integer
+    for the spawn key of a SeedSequence.
+    '''
+    if isinstance(part, (int, np.integer)) and part >= 0:
+        return int(part)
+    digest = hashlib.sha256(str(part).encode()).digest()
+    return int.from_bytes(digest[:8], 'little')
+
+
+class RandomStreams:
+
+    def __init__(self, seed=None):
+        '''
+        A set of named random number streams.
+
+        seed: an integer, a numpy SeedSequence, or None
+            (to take fresh entropy from the operating system).
+        '''
+        self.states = {}
+        self.reseed(seed)
+
+    def reseed(self, seed):
+        '''
+        Changes the root seed. Random states that were already handed
+        out are reseeded in place, so that samplers holding them draw
+        from the new streams.
+        '''
+        if not isinstance(seed, np.random.SeedSequence):
+            seed = np.random.SeedSequence(seed)
+        self.seed_sequence = seed
+        for name, random_state in self.states.items():
+            random_state.seed(self.seed_sequence_for(*name).generate_state(4))
+
+    def seed_sequence_for(self, *name):
+        '''
+        Returns the SeedSequence of a named stream.
+        '''
+        spawn_key = tuple(_name_key(part) for part in name)
+        return np.random.SeedSequence(
+            self.seed_sequence.entropy,
+            spawn_key=tuple(self.seed_sequence.spawn_key) + spawn_key)
+
+    def random_state(self, *name):
+        '''
+        Returns the numpy RandomState of a named stream (the same
+        object on every call, so that the stream continues).
+        '''
+        if name not in self.states:
+            self.states[name] = np.random.RandomState(
+                self.seed_sequence_for(*name).generate_state(4))
+        return self.states[name]
+
+    def child(self, *name):
+        '''
+        Returns a new RandomStreams rooted at a named stream
+        (e.g. for a worker process).
+        '''
+        return RandomStreams(self.seed_sequence_for(*name))
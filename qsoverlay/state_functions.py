@@ -0,0 +1,103 @@
+"""
+state_functions: helper functions for quantumsim SparseDM states.
+"""
+from collections import defaultdict
+
+import numpy as np
+
+from quantumsim.sparsedm import SparseDM
+
+
+def copy_state(state):
+    '''
+    Returns an independent copy of a SparseDM. (SparseDM.copy shares
+    the cache of pending single-qubit gates between the copies, and
+    does not copy the classical probability.)
+    '''
+    new_state = state.copy()
+    new_state.single_ptms_to_do = defaultdict(list, {
+        bit: list(ptms) for bit, ptms in state.single_ptms_to_do.items()})
+    new_state.classical_probability = state.classical_probability
+    new_state.max_bits_in_full_dm = state.max_bits_in_full_dm
+    return new_state
+
+
+def marginal_distribution(state, qubits, diagonal=None):
+    '''
+    Returns the probabilities of the measurement outcomes of a list
+    of qubits in a SparseDM, as a vector of length 2^len(qubits),
+    where bit i of the index is the outcome of qubits[i].
+
+    diagonal: the diagonal of state.full_dm, if already known.
+    '''
+    if diagonal is None:
+        diagonal = state.full_dm.get_diag()
+
+    # Bit i of the index of the diagonal is the qubit in position i
+    # of the dense matrix, so the qubit in position i is axis n-1-i
+    # of the diagonal reshaped to a tensor.
+    num_dense = len(state.idx_in_full_dm)
+    tensor = np.reshape(diagonal, (2,) * num_dense)
+    dense_qubits = [qubit for qubit in qubits
+                    if qubit in state.idx_in_full_dm]
+    axes = [num_dense - 1 - state.idx_in_full_dm[qubit]
+            for qubit in dense_qubits]
+    other_axes = tuple(axis for axis in range(num_dense)
+                       if axis not in axes)
+    tensor = np.sum(tensor, axis=other_axes)
+    # After summing, the remaining axes are in increasing order;
+    # put them in reverse order of the dense qubits.
+    order = np.argsort(axes)
+    tensor = np.transpose(tensor, np.argsort(order)[::-1])
+
+    # Qubits outside the dense matrix have a fixed outcome.
+    index = [slice(None) if qubit in state.idx_in_full_dm
+             else state.classical[qubit] for qubit in reversed(qubits)]
+    marginal = np.zeros((2,) * len(qubits))
+    marginal[tuple(index)] = tensor
+    return marginal.reshape(-1)
+
+
+def circuit_superoperator(circuit, qubits):
+    '''
+    Returns the superoperator of a circuit without measurements on
+    a list of qubits (which should include every qubit it acts on),
+    as a 4^k x 4^k matrix acting on the density matrix of the qubits
+    in the Pauli basis of quantumsim, flattened in reverse qubit order
+    (as DensityNP.dm). Returns None if quantumsim does not store
+    density matrices as numpy arrays.
+    '''
+    # The circuit is applied to the identity map, stored as a state of
+    # the qubits and a reference copy of them: as every gate acts
+    # linearly on the qubits only, this leaves the superoperator.
+    num_qubits = len(qubits)
+    references = [' reference {}'.format(n) for n in range(num_qubits)]
+    probe = SparseDM(list(qubits) + references)
+    for bit in list(qubits) + references:
+        probe.ensure_dense(bit)
+    if not isinstance(getattr(probe.full_dm, 'dm', None), np.ndarray):
+        return None
+
+    size = 4 ** num_qubits
+    probe.full_dm.dm = np.eye(size).reshape((4,) * (2 * num_qubits))
+    circuit.apply_to(probe)
+    return probe.full_dm.dm.reshape(size, size).T
+
+
+def apply_superoperator(state, qubits, superoperator):
+    '''
+    Applies a superoperator (as from circuit_superoperator) on a
+    list of qubits to a SparseDM.
+    '''
+    for qubit in qubits:
+        state.ensure_dense(qubit)
+        state.combine_and_apply_single_ptm(qubit)
+
+    num_qubits = len(qubits)
+    dm = state.full_dm.dm
+    axes = [dm.ndim - 1 - state.idx_in_full_dm[qubit]
+            for qubit in reversed(qubits)]
+    tensor = superoperator.reshape((4,) * (2 * num_qubits))
+    dm = np.tensordot(tensor, dm, axes=(
+        list(range(num_qubits, 2 * num_qubits)), axes))
+    state.full_dm.dm = np.moveaxis(dm, list(range(num_qubits)), axes)
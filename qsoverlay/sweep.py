@@ -0,0 +1,119 @@
+"""
+sweep: runs a Controller over many parameter points (e.g. to scan the
+landscape of a VQE) in a pool of worker processes.
+
+Every worker loads the Controller once. The points are split into
+chunks, and every chunk reseeds the random streams of the worker
+(see random_streams) from its own named stream, so the results do not
+depend on the number of workers or on which worker runs which chunk.
+"""
+import concurrent.futures
+import os
+import tempfile
+
+import numpy as np
+
+from .experiment_controller import Controller
+from .experiment_setup import Setup
+from .random_streams import RandomStreams
+
+# The Controller and random streams of a worker process
+_worker_data = {}
+
+
+def _init_sweep_worker(filename, setup_filename, targets):
+    streams = RandomStreams()
+    setup = Setup(filename=setup_filename, streams=streams)
+    _worker_data['controller'] = Controller(filename, setup,
+                                            targets=targets,
+                                            streams=streams)
+    _worker_data['streams'] = streams
+
+
+def _run_chunk(chunk):
+    '''
+    Runs a chunk of points, given as (seed_sequence, points,
+    circuit_sequence, sweep_circuit, msmts, num_repetitions).
+    '''
+    seed_sequence, points, circuit_sequence, sweep_circuit, msmts,\
+        num_repetitions = chunk
+    controller = _worker_data['controller']
+    _worker_data['streams'].reseed(seed_sequence)
+
+    results = []
+    for point in points:
+        controller.make_state()
+        for circuit in circuit_sequence:
+            if circuit == sweep_circuit:
+                circuit = (circuit, *point)
+            controller.apply_circuit(circuit)
+        results.append(controller.get_expectation_values(
+            msmts, num_repetitions))
+    return results
+
+
+def run_sweep(filename, setup, points, circuit_sequence, sweep_circuit,
+              msmts, num_repetitions=None, seed=None, processes=None,
+              chunk_size=None, targets=None):
+    '''
+    Evaluates a set of Pauli strings after a sequence of circuits
+    for every point in a list of parameter vectors.
+
+    filename: the circuits file for the Controller (see Controller.load).
+    setup: the setup, as a filename or a Setup (which is saved
+        to a temporary file for the workers).
+    points: a 2-D array with a parameter vector in every row.
+    circuit_sequence: the circuits to apply to a new state for every
+        point (in the format of Controller.apply_circuit).
+    sweep_circuit: the name of the circuit in circuit_sequence that
+        receives the parameters of the point.
+    msmts, num_repetitions: the Pauli strings to evaluate
+        (see Controller.get_expectation_values).
+    seed: the root seed of the random streams, or a RandomStreams
+        (the chunks use its streams ('chunk', 0), ('chunk', 1), ...).
+    processes: the number of worker processes (if None, the points
+        are run in this process).
+    chunk_size: the number of points in a chunk (by default, the
+        points are split into 64 chunks). Sampled results depend on
+        the chunk size, but not on the number of processes.
+    targets: passed on to the Controller to prune the circuits.
+
+    Returns an array with a row of results for every point,
+    in the order of points.
+    '''
+    points = np.atleast_2d(points)
+    if chunk_size is None:
+        chunk_size = max(1, -(-len(points) // 64))
+    starts = range(0, len(points), chunk_size)
+    if not isinstance(seed, RandomStreams):
+        seed = RandomStreams(seed)
+    chunks = [(seed.seed_sequence_for('chunk', n),
+               points[start:start+chunk_size],
+               circuit_sequence, sweep_circuit, msmts, num_repetitions)
+              for n, start in enumerate(starts)]
+
+    temp_name = None
+    if not isinstance(setup, str):
+        handle, temp_name = tempfile.mkstemp(suffix='.json')
+        os.close(handle)
+        setup.save(temp_name)
+        setup = temp_name
+
+    try:
+        if processes is None:
+            _init_sweep_worker(filename, setup, targets)
+            try:
+                results = [_run_chunk(chunk) for chunk in chunks]
+            finally:
+                _worker_data.clear()
+        else:
+            with concurrent.futures.ProcessPoolExecutor(
+                    max_workers=processes,
+                    initializer=_init_sweep_worker,
+                    initargs=(filename, setup, targets)) as executor:
+                results = list(executor.map(_run_chunk, chunks))
+    finally:
+        if temp_name is not None:
+            os.remove(temp_name)
+
+    return np.array([result for chunk in results for result in chunk])
@@ -1,5 +1,8 @@
+import io
 from qsoverlay.circuit_builder import Builder
+from qsoverlay.circuit_passes import prune_circuit_list
 from qsoverlay.DiCarlo_setup import quick_setup
+from qsoverlay.qasm_reader import QasmError
 from quantumsim.sparsedm import SparseDM
 import pytest
 import numpy as np
@@ -119,6 +122,132 @@ class TestBuilder:
         assert np.abs(diag[1]) < 1e-10
         assert np.abs(diag[2]) < 1e-10
 
+    def test_openqasm(self):
+        qubit_list = ['swap', 'cp']
+        with pytest.warns(UserWarning):
+            # We did not provide any seed
+            setup = quick_setup(qubit_list, noise_flag=False)
+        b = Builder(setup)
+        qasm = io.StringIO(
+            'OPENQASM 2.0;\n'
+            'include "qelib1.inc";\n'
+            'qreg q[2]; creg c[2];\n'
+            '// a comment; with a semicolon\n'
+            'gate bell a, b {\n'
+            '  ry(pi/2) a; ry(2*pi/4) b;\n'
+            '  cz b, a; ry(-pi/2) b;\n'
+            '}\n'
+            'bell q[0], q[1];\n'
+            'barrier q;\n'
+            'measure q -> c;\n')
+        b.add_openqasm(qasm, register_map={'q': qubit_list,
+                                           'c': ['c0', 'c1']})
+        assert b.circuit_list[:4] == [
+            ('RY', 'swap', np.pi/2), ('RY', 'cp', np.pi/2),
+            ('CZ', 'cp', 'swap'), ('RY', 'cp', -np.pi/2)]
+        assert b.circuit_list[4:] == [
+            ('barrier', 'swap', 'cp'),
+            ('Measure', 'swap', 'c0'), ('Measure', 'cp', 'c1')]
+        # The barrier aligns both measurements
+        assert b.times['swap'] == b.times['cp']
+
+        with pytest.raises(QasmError):
+            b.add_openqasm(io.StringIO('qreg r[1]; if(c==1) x r[0];'))
+
+    def test_openqasm_gates(self):
+        qubit_list = ['q0', 'q1']
+        with pytest.warns(UserWarning):
+            # We did not provide any seed
+            setup = quick_setup(qubit_list, noise_flag=False)
+
+        def final_dm(qasm):
+            b = Builder(setup)
+            b.add_openqasm(io.StringIO('qreg q[2];\n' + qasm))
+            b.finalize()
+            state = SparseDM(b.circuit.get_qubit_names())
+            b.circuit.apply_to(state)
+            for qubit in qubit_list:
+                state.ensure_dense(qubit)
+            return state.full_dm.to_array()
+
+        def u_matrix(theta, phi, lamda):
+            return np.array([
+                [np.cos(theta/2), -np.exp(1j*lamda) * np.sin(theta/2)],
+                [np.exp(1j*phi) * np.sin(theta/2),
+                 np.exp(1j*(phi+lamda)) * np.cos(theta/2)]])
+
+        for qasm, unitary in [
+                ('U(0.3, 0.7, 1.1) q[0]; h q[0];',
+                 u_matrix(np.pi/2, 0, np.pi) @ u_matrix(0.3, 0.7, 1.1)),
+                ('u3(0.3, 0.7, 1.1) q[0]; h q[0];',
+                 u_matrix(np.pi/2, 0, np.pi) @ u_matrix(0.3, 0.7, 1.1)),
+                ('u2(0.7, 1.1) q[0]; h q[0];',
+                 u_matrix(np.pi/2, 0, np.pi) @
+                 u_matrix(np.pi/2, 0.7, 1.1))]:
+            psi = unitary[:, 0]
+            expected = np.kron(np.diag([1, 0]), np.outer(psi, psi.conj()))
+            assert np.allclose(final_dm(qasm), expected)
+
+        dm = final_dm('x q[0]; swap q[0], q[1];')
+        assert np.isclose(dm[2, 2], 1)
+
+    def test_openqasm_errors(self):
+        qubit_list = ['q0', 'q1']
+        with pytest.warns(UserWarning):
+            # We did not provide any seed
+            setup = quick_setup(qubit_list, noise_flag=False)
+        b = Builder(setup)
+        for qasm, message in [
+                ('qreg q[2];\nfoo q[0];', 'Line 2: Unknown gate: foo'),
+                ('qreg q[2];\nrx(pi/2) q[5];', 'Line 2: Index out of range'),
+                ('qreg q[2];\ngate g(t) a { rx(t) a; rz(2*t) a }\n',
+                 'Line 2: Missing ; in gate g')]:
+            with pytest.raises(QasmError, match=message):
+                b.add_openqasm(io.StringIO(qasm))
+
+    def test_openqasm_barrier_reschedule(self):
+        qubit_list = ['q0', 'q1']
+        with pytest.warns(UserWarning):
+            # We did not provide any seed
+            setup = quick_setup(qubit_list, noise_flag=False)
+        b = Builder(setup)
+        b.add_openqasm(io.StringIO(
+            'qreg q[2];\n'
+            'x q[1]; x q[0]; x q[0];\n'
+            'barrier q;\n'
+            'x q[0]; x q[0];\n'))
+        b.reschedule('alap')
+        # The gate on q1 stays before the barrier, halfway the circuit
+        q1_op = [op for op in b._ops if op[0] == ('q1',)][0]
+        barrier_op = [op for op in b._ops if not op[4]][0]
+        assert np.isclose(q1_op[5] + q1_op[2], barrier_op[5])
+        assert np.isclose(2 * barrier_op[5], max(b.times.values()))
+
+        # The barrier is saved in the circuit list, so replaying
+        # the list (one by one or in bulk) keeps it.
+        times = [g.time for g in b.circuit.gates]
+        for bulk in [False, True]:
+            replay = Builder(setup)
+            replay.add_circuit_list(b.circuit_list, bulk=bulk)
+            assert replay.circuit_list == b.circuit_list
+            replay.reschedule('alap')
+            assert [g.time for g in replay.circuit.gates] == times
+
+        # Pruning keeps the barrier, without making q1 live
+        pruned = prune_circuit_list(b.circuit_list, ['q0'], setup.gate_dic)
+        assert ('barrier', 'q0', 'q1') in pruned
+        assert not any('q1' in desc for desc in pruned
+                       if desc[0] != 'barrier')
+
+    def test_qasm_qubits_last(self):
+        qubit_list = ['q0', 'q1']
+        with pytest.warns(UserWarning):
+            # We did not provide any seed
+            setup = quick_setup(qubit_list, noise_flag=False)
+        b = Builder(setup)
+        b.add_qasm(['RY 1.5 q0 q1'], qubits_first=False)
+        assert b.circuit_list == [('RY', 'q0', 1.5)]
+
     def test_make_imperfect_bell(self):
         qubit_list = ['swap', 'cp']
         with pytest.warns(UserWarning):
@@ -162,3 +291,393 @@ class TestBuilder:
         b.add_gate('RY', ['q0'], angle=np.pi/2, time=0)
         assert b.times['q0'] == setup.gate_set[('RY', 'q0')][1]['gate_time']
         assert b.circuit.gates[-1].time == 0
+
+    def test_dispatch_record(self):
+        qubit_list = ['q0', 'q1']
+        with pytest.warns(UserWarning):
+            # We did not provide any seed
+            setup = quick_setup(qubit_list, noise_flag=False)
+        b = Builder(setup)
+        record = b.get_dispatch(('CZ', 'q0', 'q1'))
+        assert record['kind'] == 'builder'
+        assert record['circuit_args']['bit0'] == 'q0'
+        assert record['circuit_args']['bit1'] == 'q1'
+        assert b.get_dispatch(('CZ', 'q0', 'q1')) is record
+
+        record = b.get_dispatch(('Measure', 'q0'))
+        assert record['time_offset'] == 0
+        record = b.get_dispatch(('RY', 'q0'))
+        assert record['kind'] == 'gate'
+        assert record['time_offset'] == record['gate_time'] / 2
+
+    def test_dispatch_invalidation(self):
+        qubit_list = ['q0']
+        with pytest.warns(UserWarning):
+            # We did not provide any seed
+            setup = quick_setup(qubit_list, noise_flag=False)
+        b = Builder(setup)
+        b < ('RY', 'q0', np.pi/2)
+        assert b.times['q0'] == 20
+
+        new_gate_set = {key: [{**val[0]}, {**val[1]}]
+                        for key, val in setup.gate_set.items()}
+        new_gate_set[('RY', 'q0')][1]['gate_time'] = 50
+        b.gate_set = new_gate_set
+        b < ('RY', 'q0', np.pi/2)
+        assert b.times['q0'] == 70
+
+        b.gate_set[('RY', 'q0')][1]['gate_time'] = 10
+        b.invalidate_dispatch()
+        b < ('RY', 'q0', np.pi/2)
+        assert b.times['q0'] == 80
+
+    def test_bulk_circuit_list(self):
+        qubit_list = ['q0', 'q1', 'q2']
+        with pytest.warns(UserWarning):
+            # We did not provide any seed
+            setup = quick_setup(qubit_list)
+        circuit_list = [
+            ('RY', 'q0', np.pi/2),
+            ('Had', 'q1'),
+            ('CNOT', 'q0', 'q1'),
+            ('RX', 'q2', 0.3, 1),
+            (('RY', 'q2', 0.1), ('CZ', 'q0', 'q1')),
+            ('Measure', 'q0', 'm0'),
+            ('CRX', 'q1', 'q2', 0.2),
+            ('RY', 'q0', np.pi/2, 1),
+            ('Measure', 'q2', 'm2')]
+
+        b = Builder(setup)
+        adjustable_gates = b.add_circuit_list(circuit_list)
+        b_bulk = Builder(setup)
+        adjustable_gates_bulk = b_bulk.add_circuit_list(circuit_list,
+                                                        bulk=True)
+
+        assert b.circuit_list == b_bulk.circuit_list
+        assert b.times == b_bulk.times
+        assert len(b.circuit.gates) == len(b_bulk.circuit.gates)
+        for g0, g1 in zip(b.circuit.gates, b_bulk.circuit.gates):
+            assert type(g0) is type(g1)
+            assert g0.time == g1.time
+            assert g0.involved_qubits == g1.involved_qubits
+        assert len(adjustable_gates) == len(adjustable_gates_bulk) == 2
+        for g0, g1 in zip(adjustable_gates, adjustable_gates_bulk):
+            assert b.circuit.gates.index(g0) ==\
+                b_bulk.circuit.gates.index(g1)
+
+    def test_bulk_fixed_time_composite(self):
+        qubit_list = ['q0', 'q1']
+        with pytest.warns(UserWarning):
+            # We did not provide any seed
+            setup = quick_setup(qubit_list)
+        # A composite gate with a time fixed in the gate set
+        setup.gate_set[('Had', 'q1')][0]['time'] = 5
+        circuit_list = [
+            ('RY', 'q1', np.pi/2),
+            ('Had', 'q1'),
+            ('RX', 'q0', 0.3),
+            ('CZ', 'q0', 'q1'),
+            ('RY', 'q1', 0.2)]
+
+        b = Builder(setup)
+        b.add_circuit_list(circuit_list)
+        b_bulk = Builder(setup)
+        b_bulk.add_circuit_list(circuit_list, bulk=True)
+
+        assert b.times == b_bulk.times
+        assert [(type(g), g.time, g.involved_qubits)
+                for g in b.circuit.gates] ==\
+            [(type(g), g.time, g.involved_qubits)
+             for g in b_bulk.circuit.gates]
+
+    def test_alap_schedule(self):
+        qubit_list = ['q0', 'q1', 'q2', 'q3']
+        with pytest.warns(UserWarning):
+            # We did not provide any seed
+            setup = quick_setup(qubit_list)
+        circuit_list = [
+            (('RY', 'q0', 0.1), ('RX', 'q2', 0.3)),
+            ('RY', 'q0', np.pi/2),
+            ('RY', 'q0', np.pi/2),
+            ('RX', 'q1', 0.3),
+            ('CZ', 'q0', 'q1'),
+            ('CZ', 'q0', 'q2')]
+
+        expected_times = {'asap': 10, 'alap': 50, 'balanced': 30}
+        for schedule, bulk in [('asap', False), ('alap', False),
+                               ('balanced', True)]:
+            b = Builder(setup, schedule=schedule)
+            b.add_circuit_list(circuit_list, bulk=bulk)
+            b.finalize()
+            assert b.times['q0'] == 140
+
+            def gate_times(qubit):
+                return [g.time for g in b.circuit.gates
+                        if g.involves_qubit(qubit) and
+                        not hasattr(g, 'autogenerated')]
+
+            # The gates on q0 are on the critical path, and the
+            # simultaneous gate on q2 stays aligned with them.
+            assert gate_times('q0')[:3] == [10, 30, 50]
+            assert gate_times('q2')[0] == 10
+
+            # The gate on q1 moves towards the CZ.
+            assert gate_times('q1')[0] == expected_times[schedule]
+
+            # q3 has no gates, so only rests when scheduled asap.
+            assert any(g.involves_qubit('q3') for g in b.circuit.gates) ==\
+                (schedule == 'asap')
+
+    def test_fixed_time_reschedule(self):
+        qubit_list = ['q0', 'q1']
+        with pytest.warns(UserWarning):
+            # We did not provide any seed
+            setup = quick_setup(qubit_list)
+        b = Builder(setup, schedule='alap')
+        b.add_gate('RX', ['q1'], angle=0.2)
+        b.add_gate('RX', ['q1'], angle=0.3, time=30)
+        for _ in range(5):
+            b.add_gate('RY', ['q0'], angle=0.1)
+        b.add_gate('CZ', ['q0', 'q1'])
+        b.finalize()
+
+        gates = [g for g in b.circuit.gates if g.involves_qubit('q1')]
+        user_gates = [g for g in gates if not hasattr(g, 'autogenerated')]
+        # The gate before the fixed gate has to end before it,
+        # and q1 rests from the start of its first gate.
+        assert [g.time for g in user_gates[:2]] == [10, 30]
+        assert min(g.time for g in gates if hasattr(g, 'autogenerated'))\
+            < 30
+
+    def test_conditional_reschedule(self):
+        qubit_list = ['q0', 'q1']
+        with pytest.warns(UserWarning):
+            # We did not provide any seed
+            setup = quick_setup(qubit_list)
+        for schedule in ['asap', 'alap']:
+            b = Builder(setup, schedule=schedule)
+            b.add_gate('Measure', ['q0'], output_bit='m0')
+            b.add_gate('RX', ['q1'], angle=np.pi, conditional_bit='m0')
+            for _ in range(40):
+                b.add_gate('RY', ['q1'], angle=0.1)
+            b.finalize()
+
+            measurement = [g for g in b.circuit.gates
+                           if g.is_measurement][0]
+            conditional = [g for g in b.circuit.gates
+                           if g.conditional_bit == 'm0'][0]
+            # The conditional gate waits for the measured bit
+            assert measurement.time < conditional.time
+            assert b.circuit.gates.index(measurement) <\
+                b.circuit.gates.index(conditional)
+
+    def test_symbolic_parameters(self):
+        qubit_list = ['q0', 'q1']
+        with pytest.warns(UserWarning):
+            # We did not provide any seed
+            setup = quick_setup(qubit_list, noise_flag=False)
+
+        def final_dm(circuit_list, bulk=False, values=None):
+            b = Builder(setup)
+            b.add_circuit_list(circuit_list, bulk=bulk)
+            if values is not None:
+                b.parameters.bind(values)
+            b.finalize()
+            state = SparseDM(b.circuit.get_qubit_names())
+            b.circuit.apply_to(state)
+            return state.full_dm.to_array(), b
+
+        symbolic_list = [
+            ('RY', 'q0', 'theta'),
+            ('CRX', 'q0', 'q1', '-phi'),
+            ('RotateEuler', 'q1', 0.3, 'theta', 0.2)]
+        numeric_list = [
+            ('RY', 'q0', 0.7),
+            ('CRX', 'q0', 'q1', -1.1),
+            ('RotateEuler', 'q1', 0.3, 0.7, 0.2)]
+        target, _ = final_dm(numeric_list)
+
+        for bulk in [False, True]:
+            dm, b = final_dm(symbolic_list, bulk, {'theta': 0.7, 'phi': 1.1})
+            assert np.allclose(dm, target)
+            assert b.circuit_list == symbolic_list
+            assert b.parameters.names == ['theta', 'phi']
+
+            dm, _ = final_dm(symbolic_list, bulk, [0.7, 1.1])
+            assert np.allclose(dm, target)
+
+        b = Builder(setup)
+        b.add_circuit_list(symbolic_list)
+        reverse_b = b.make_reverse_circuit()
+        assert reverse_b.circuit_list[-1] == ('RY', 'q0', '-theta')
+        assert reverse_b.circuit_list[-2] == ('CRX', 'q0', 'q1', 'phi')
+
+    def test_fuse_single_qubit_gates(self):
+        qubit_list = ['q0', 'q1']
+        with pytest.warns(UserWarning):
+            # We did not provide any seed
+            setup = quick_setup(qubit_list)
+        circuit_list = [
+            ('H', 'q0'),
+            ('RX', 'q1', 0.3),
+            ('CNOT', 'q0', 'q1'),
+            ('RY', 'q0', 'theta'),
+            ('RX', 'q0', 0.2),
+            ('RZ', 'q1', 0.4, True),
+            ('RX', 'q1', 0.1)]
+
+        dms = []
+        num_gates = []
+        for fuse in [False, True]:
+            b = Builder(setup)
+            adjustable_gates = b.add_circuit_list(circuit_list)
+            b.finalize(fuse=fuse)
+            b.parameters.bind({'theta': 0.5})
+            adjustable_gates[0].adjust(0.6)
+            assert adjustable_gates[0] in b.circuit.gates
+            state = SparseDM(b.circuit.get_qubit_names())
+            b.circuit.apply_to(state)
+            dms.append(state.full_dm.to_array())
+            num_gates.append(len(b.circuit.gates))
+
+        assert np.allclose(dms[0], dms[1])
+        assert num_gates[1] < num_gates[0]
+
+    def test_virtual_z(self):
+        qubit_list = ['q0', 'q1']
+        with pytest.warns(UserWarning):
+            # We did not provide any seed
+            setup = quick_setup(qubit_list, noise_flag=False)
+        circuit_list = [
+            ('RY', 'q0', np.pi/2),
+            ('RZ', 'q0', 0.3),
+            ('RX', 'q0', 0.5),
+            ('RZ', 'q1', 0.7),
+            ('CZ', 'q0', 'q1'),
+            ('RZ', 'q0', 1.1),
+            ('RotateEuler', 'q0', 0.2, 0.4, 0.6),
+            ('RZ', 'q1', 0.2),
+            ('H', 'q1'),
+            ('RZ', 'q0', 0.9)]
+
+        dms = []
+        for virtual_z, bulk in [(False, False), (True, False), (True, True)]:
+            b = Builder(setup, virtual_z=virtual_z)
+            b.add_circuit_list(circuit_list, bulk=bulk)
+            b.finalize()
+            state = SparseDM(b.circuit.get_qubit_names())
+            b.circuit.apply_to(state)
+            dms.append(state.full_dm.to_array())
+
+            assert b.circuit_list == circuit_list
+            if virtual_z:
+                # Only the frame of q1 before the Hadamard,
+                # and the final frame of q0 remain.
+                z_gates = [g for g in b.circuit.gates
+                           if type(g).__name__ == 'RotateZ']
+                assert len(z_gates) == 2
+                # The Z rotations take no time
+                oneq_time = setup.gate_set[('RZ', 'q0')][1]['gate_time']
+                assert b.times['q0'] == circuit_time - 3 * oneq_time
+            else:
+                circuit_time = b.times['q0']
+
+        assert np.allclose(dms[0], dms[1])
+        assert np.allclose(dms[0], dms[2])
+
+    def test_fork(self):
+        qubit_list = ['q0', 'q1']
+        with pytest.warns(UserWarning):
+            # We did not provide any seed
+            setup = quick_setup(qubit_list)
+        prefix = [
+            ('RY', 'q0', np.pi/2),
+            ('CZ', 'q0', 'q1'),
+            ('RX', 'q1', 'theta'),
+            ('RY', 'q0', 0.3, True)]
+        suffixes = [
+            [('RX', 'q0', 0.4)],
+            [('CZ', 'q0', 'q1'), ('RY', 'q1', 0.2)],
+            [('RY', 'q1', 1.2), ('RX', 'q1', 0.4)]]
+
+        def final_dm(b):
+            state = SparseDM(b.circuit.get_qubit_names())
+            b.circuit.apply_to(state)
+            return state.full_dm.to_array()
+
+        parent = Builder(setup, schedule='alap')
+        parent.add_circuit_list(prefix)
+        num_gates = len(parent.circuit.gates)
+        times = dict(parent.times)
+
+        forks = [parent.fork() for suffix in suffixes]
+        for fork, suffix in zip(forks, suffixes):
+            fork.add_circuit_list(suffix)
+            fork.parameters.bind({'theta': 0.7})
+            fork.finalize()
+
+            b = Builder(setup, schedule='alap')
+            b.add_circuit_list(prefix + suffix)
+            b.parameters.bind({'theta': 0.7})
+            b.finalize()
+
+            assert fork.circuit_list == b.circuit_list
+            assert fork.times == b.times
+            assert [g.time for g in fork.circuit.gates] ==\
+                [g.time for g in b.circuit.gates]
+            assert np.allclose(final_dm(fork), final_dm(b))
+
+        # The parent is unchanged, and can still be finalized by itself
+        assert len(parent.circuit.gates) == num_gates
+        assert parent.times == times
+        assert parent.circuit_list == prefix
+        assert parent.parameters.values == {'theta': 0}
+        parent.parameters.bind({'theta': 0.7})
+        parent.finalize()
+
+        b = Builder(setup, schedule='alap')
+        b.add_circuit_list(prefix)
+        b.parameters.bind({'theta': 0.7})
+        b.finalize()
+        assert [g.time for g in parent.circuit.gates] ==\
+            [g.time for g in b.circuit.gates]
+        assert np.allclose(final_dm(parent), final_dm(b))
+
+    def test_fork_copy_on_write(self):
+        qubit_list = ['q0', 'q1']
+        with pytest.warns(UserWarning):
+            # We did not provide any seed
+            setup = quick_setup(qubit_list)
+        prefix = [
+            ('RY', 'q0', np.pi/2),
+            ('CZ', 'q0', 'q1'),
+            ('RX', 'q1', 'theta'),
+            ('RY', 'q0', 0.3, True)]
+
+        parent = Builder(setup)
+        adjustable, = parent.add_circuit_list(prefix)
+        prefix_gates = list(parent.circuit.gates)
+        bound_gate, _ = parent.parameters.gates[0]
+
+        fork = parent.fork()
+        fork.add_circuit_list([('RX', 'q0', 0.4)])
+        fork.parameters.bind({'theta': 0.7})
+        fork.finalize()
+
+        # Only the gate changed by the fork is copied
+        fork_gates = {id(gate) for gate in fork.circuit.gates}
+        for gate in prefix_gates:
+            assert (id(gate) in fork_gates) == (gate is not bound_gate)
+        assert parent.circuit.gates == prefix_gates
+        assert parent.parameters.gates[0][0] is bound_gate
+        assert fork.parameters.gates[0][0] is not bound_gate
+        assert np.isclose(bound_gate.angle, 0)
+        assert np.isclose(fork.parameters.gates[0][0].angle, 0.7)
+
+        # Adjusting a shared gate through the builder copies it too
+        new_gate = parent.adjust_gate(adjustable, 0.5)
+        assert new_gate is not adjustable
+        assert new_gate in parent.circuit.gates
+        assert adjustable in fork.circuit.gates
+        assert np.isclose(adjustable.angle, 0.3)
+        assert parent.adjust_gate(new_gate, 0.6) is new_gate
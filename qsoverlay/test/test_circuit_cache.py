@@ -0,0 +1,109 @@
+import pytest
+
+from qsoverlay.circuit_builder import Builder
+from qsoverlay.circuit_cache import CircuitCache
+from qsoverlay.DiCarlo_setup import quick_setup
+from quantumsim.sparsedm import SparseDM
+import numpy as np
+import tempfile
+
+
+def final_probabilities(compiled):
+    state = SparseDM(compiled.circuit.get_qubit_names())
+    compiled.circuit.apply_to(state)
+    return compiled.measurement_gates[0].probabilities[-1]
+
+
+class TestCircuitCache:
+
+    circuit_list = [
+        ('RY', 'q0', np.pi/2),
+        ('CZ', 'q0', 'q1'),
+        ('RX', 'q0', 'theta'),
+        ('Measure', 'q0', 'm0', True)]
+
+    def test_memory_cache(self):
+        with pytest.warns(UserWarning):
+            # We did not provide any seed
+            setup = quick_setup(['q0', 'q1'])
+        cache = CircuitCache()
+        c0 = cache.compile(self.circuit_list, setup)
+        c1 = cache.compile(self.circuit_list, setup)
+        assert (cache.hits, cache.misses) == (1, 1)
+        assert c0.circuit is not c1.circuit
+        assert len(c0.circuit.gates) == len(c1.circuit.gates)
+
+        # Copies are independent of each other
+        c1.parameters.bind({'theta': np.pi/2})
+        p0 = final_probabilities(c0)
+        p1 = final_probabilities(c1)
+        assert not np.allclose(p0, p1)
+        assert len(c0.measurement_gates[0].probabilities) == 1
+        assert len(c1.measurement_gates[0].probabilities) == 1
+
+        # Changing the setup changes the key
+        setup.qubit_dic['q0']['t1'] /= 2
+        cache.compile(self.circuit_list, setup)
+        assert cache.misses == 2
+
+    def test_lru_eviction(self):
+        with pytest.warns(UserWarning):
+            # We did not provide any seed
+            setup = quick_setup(['q0', 'q1'])
+        cache = CircuitCache(max_entries=2)
+        for angle in [0.1, 0.2, 0.3, 0.1]:
+            cache.compile([('RY', 'q0', angle)], setup)
+        assert len(cache.entries) == 2
+        assert cache.misses == 4
+
+    def test_disk_cache(self):
+        with pytest.warns(UserWarning):
+            # We did not provide any seed
+            setup = quick_setup(['q0', 'q1'])
+        directory = tempfile.mkdtemp()
+        c0 = CircuitCache(directory=directory).compile(
+            self.circuit_list, setup)
+
+        cache = CircuitCache(directory=directory)
+        c1 = cache.compile(self.circuit_list, setup)
+        assert cache.hits == 1
+        assert np.allclose(final_probabilities(c0),
+                           final_probabilities(c1))
+
+    def test_builder_options(self):
+        with pytest.warns(UserWarning):
+            # We did not provide any seed
+            setup = quick_setup(['q0', 'q1'])
+        cache = CircuitCache()
+        cache.compile(self.circuit_list, setup)
+        cache.compile(self.circuit_list, setup,
+                      builder=Builder(setup, virtual_z=True))
+        cache.compile(self.circuit_list, setup,
+                      builder=Builder(setup, schedule='alap'))
+        cache.compile(self.circuit_list, setup, builder=Builder(setup))
+        assert (cache.hits, cache.misses) == (1, 3)
+
+    def test_noise_gates(self):
+        with pytest.warns(UserWarning):
+            # We did not provide any seed
+            setup = quick_setup(['q0', 'q1'])
+        cache = CircuitCache()
+        cache.compile(self.circuit_list, setup)
+        compiled = cache.compile(self.circuit_list, setup)
+        gates = compiled.noise_gates[('t1', 'q0')]
+        assert gates
+        assert all(any(gate is g for g in compiled.circuit.gates)
+                   for gate in gates)
+        assert not any(gate is g for gate in gates
+                       for g in cache.entries[cache.key(
+                           self.circuit_list, setup)].circuit.gates)
+
+    def test_missing_sampler(self):
+        with pytest.warns(UserWarning):
+            # We did not provide any seed
+            setup = quick_setup(['q0', 'q1'])
+        directory = tempfile.mkdtemp()
+        CircuitCache(directory=directory).compile(self.circuit_list, setup)
+        with pytest.raises(ValueError):
+            CircuitCache(directory=directory).compile(
+                self.circuit_list, setup, samplers={})
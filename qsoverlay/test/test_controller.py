@@ -0,0 +1,226 @@
+import pytest
+
+from qsoverlay.circuit_passes import light_cone
+from qsoverlay.experiment_controller import Controller
+from qsoverlay.measurement_models import CorrelatedMeasurement
+from qsoverlay.DiCarlo_setup import quick_setup
+import numpy as np
+import quantumsim.circuit
+import json
+import os
+import tempfile
+
+
+def write_circuits(circuit_lists, qubits, mbits):
+    filename = os.path.join(tempfile.mkdtemp(), 'circuits.json')
+    with open(filename, 'w') as outfile:
+        json.dump({'mbits': mbits,
+                   'qubits': qubits,
+                   'circuit_lists': circuit_lists,
+                   'angle_convert_matrices': {}}, outfile)
+    return filename
+
+
+class TestController:
+
+    def test_light_cone_pruning(self):
+        qubit_list = ['q0', 'q1', 'q2', 'q3', 'q4']
+        with pytest.warns(UserWarning):
+            # We did not provide any seed
+            setup = quick_setup(qubit_list)
+        circuit_lists = {
+            'prep': [
+                ('RY', 'q0', 0.4),
+                ('RY', 'q1', 0.9),
+                ('CZ', 'q0', 'q1'),
+                ('RY', 'q2', 0.3),
+                ('CZ', 'q2', 'q3'),
+                # q3 is in the ground state, so this is deterministic
+                ('Measure', 'q3', 'm3')],
+            'entangle': [
+                ('CZ', 'q1', 'q2'),
+                ('RX', 'q4', 0.2)]}
+        filename = write_circuits(circuit_lists, qubit_list, ['m3'])
+
+        full = Controller(filename, setup)
+        pruned = Controller(filename, setup, targets=['q0'])
+
+        # q2 enters the light cone of q0 through the second circuit
+        assert pruned.qubits == ['q0', 'q1', 'q2', 'q3']
+        assert pruned.mbits == ['m3']
+        assert len(pruned.circuits['entangle'].gates) <\
+            len(full.circuits['entangle'].gates)
+
+        msmts = [{'q0': 'Z'}, {'q0': 'X', 'q1': 'X'}, {'q1': 'Y'}]
+        results = []
+        for controller in [full, pruned]:
+            controller.apply_circuit_list(['prep', 'entangle'])
+            results.append(controller.get_expectation_values(msmts))
+        assert np.allclose(results[0], results[1])
+
+    def test_simulate_tomo(self):
+        qubit_list = ['q0', 'q1']
+        with pytest.warns(UserWarning):
+            # We did not provide any seed
+            setup = quick_setup(qubit_list)
+        circuit_lists = {
+            'prep': [
+                ('RY', 'q0', np.pi/2),
+                ('CZ', 'q0', 'q1'),
+                ('RX', 'q1', 0.4)],
+            'tomo_x': [('RY', 'q0', -np.pi/2), ('RY', 'q1', -np.pi/2)],
+            'tomo_y': [('RX', 'q0', np.pi/2), ('RX', 'q1', 0.3, True)],
+            'tomo_z': []}
+        filename = write_circuits(circuit_lists, qubit_list, [])
+        controller = Controller(filename, setup)
+        model = CorrelatedMeasurement(
+            qubit_list, np.eye(4), [0, 0], np.random.RandomState(1))
+        tomo_circuits = ['tomo_x', ('tomo_y', np.pi/2), 'tomo_z']
+
+        expected = []
+        for tomo_circuit in tomo_circuits:
+            controller.make_state()
+            controller < 'prep'
+            controller < tomo_circuit
+            controller.state.renormalize()
+            expected.append(model.sample(
+                controller.state.peak_multiple_measurements(qubit_list),
+                1, data_type='averages'))
+
+        for processes in [None, 2]:
+            data = controller.simulate_tomo(
+                'prep', tomo_circuits, model, 1, 'full', 'averages',
+                processes=processes)
+            assert np.allclose(data, expected)
+
+    def test_get_marginal(self):
+        qubit_list = ['q0', 'q1', 'q2']
+        with pytest.warns(UserWarning):
+            # We did not provide any seed
+            setup = quick_setup(qubit_list)
+        circuit_lists = {
+            'prep': [
+                ('RY', 'q0', 0.4),
+                ('RY', 'q2', 2.1),
+                ('CZ', 'q0', 'q2'),
+                ('RX', 'q0', 1.3)]}
+        filename = write_circuits(circuit_lists, qubit_list, [])
+        controller = Controller(filename, setup)
+        assert controller.get_prob_all_zero(['q0', 'q1']) == 1
+
+        controller < 'prep'
+        controller.state.apply_all_pending()
+        dm = controller.state.full_dm.to_array()
+        diagonal = np.real(np.diag(dm))
+        idx = controller.state.idx_in_full_dm
+
+        # q1 is still in the ground state, outside the dense matrix
+        qubits = ['q2', 'q1', 'q0']
+        expected = np.zeros(8)
+        for j, p in enumerate(diagonal):
+            outcome = (j >> idx['q2'] & 1) + 4 * (j >> idx['q0'] & 1)
+            expected[outcome] += p
+        assert np.allclose(controller.get_marginal(qubits), expected)
+        assert controller.get_marginal(qubits) is\
+            controller.get_marginal(qubits)
+        assert np.isclose(controller.get_prob_all_zero(['q0', 'q2']),
+                          expected[0])
+
+        controller < 'prep'
+        assert not np.isclose(controller.get_prob_all_zero(['q0', 'q2']),
+                              expected[0])
+
+    def test_repeated_superoperator(self):
+        # q3 and q4 only rest, so the circuit splits into small groups
+        qubit_list = ['q0', 'q1', 'q2', 'q3', 'q4']
+        with pytest.warns(UserWarning):
+            # We did not provide any seed
+            setup = quick_setup(qubit_list)
+        circuit_lists = {
+            'prep': [('RY', 'q0', 0.7), ('RX', 'q2', 1.1),
+                     ('RX', 'q3', 0.6)],
+            'round': [
+                ('RY', 'q1', 0.3),
+                ('CZ', 'q0', 'q1'),
+                ('RX', 'q0', 0.2, True),
+                ('CZ', 'q1', 'q2')]}
+        filename = write_circuits(circuit_lists, qubit_list, [])
+        controller = Controller(filename, setup)
+        msmts = [{'q0': 'Z'}, {'q0': 'X', 'q1': 'Y'}, {'q2': 'X'},
+                 {'q0': 'Z', 'q1': 'Z', 'q2': 'Z'}, {'q3': 'Z'}]
+
+        def check(round):
+            controller.make_state()
+            controller < 'prep'
+            expected_data = [controller.apply_circuit(round)
+                             for _ in range(7)]
+            expected = controller.get_expectation_values(msmts)
+
+            controller.make_state()
+            controller < 'prep'
+            assert controller.apply_circuit((7, round)) == expected_data
+            assert np.allclose(
+                controller.get_expectation_values(msmts), expected)
+
+        for round in [('round', 0.5), ('round', 0.9), 'round']:
+            check(round)
+        entry = controller._superoperators['round']
+        assert [qubits for qubits, _ in entry['superoperators']] ==\
+            [['q3'], ['q4'], ['q0', 'q1', 'q2']]
+
+        # Adjusting a gate by hand replaces its PTM
+        controller.adjust_gates['round'][0].adjust(1.3)
+        check('round')
+        assert controller._superoperators['round'] is not entry
+
+        controller.max_superoperator_qubits = 2
+        controller.clear_superoperator_cache()
+        check('round')
+        assert controller._superoperators['round']['superoperators'] is None
+
+    def test_bind_without_parameters(self):
+        circuit = quantumsim.circuit.Circuit('rx')
+        circuit.add_qubit('q0')
+        circuit.add_gate(quantumsim.circuit.RotateX('q0', 0, 0))
+        controller = Controller(qubits=['q0'], circuits={'rx': circuit},
+                                adjust_gates={'rx': circuit.gates})
+        controller.apply_circuit(('rx', [0.3]))
+        with pytest.raises(ValueError):
+            controller.apply_circuit(('rx', {'theta': 0.3}))
+
+    def test_light_cone_conditional(self):
+        gate_dic = {
+            'Measure': {'num_qubits': 1, 'user_kws': ['output_bit']},
+            'CX': {'num_qubits': 1,
+                   'user_kws': ['angle', 'conditional_bit']}}
+        circuit_list = [
+            ('Measure', 'q3', 'm3'),
+            ('CX', 'q0', np.pi, 'm3'),
+            ('CX', 'q1', 0.2, None, 1)]
+        keep, live = light_cone(circuit_list, ['q0'], gate_dic)
+        # The measurement feeds the conditional gate, while the
+        # adjustable gate on q1 is outside the cone
+        assert keep == [True, True, False]
+        assert live == {'q0', 'q3', 'm3'}
+
+    def test_light_cone_adjust_gates(self):
+        qubit_list = ['q0', 'q1']
+        with pytest.warns(UserWarning):
+            # We did not provide any seed
+            setup = quick_setup(qubit_list)
+        circuit_lists = {
+            'prep': [
+                ('RX', 'q1', 0.2, 1),
+                ('RY', 'q0', 0.4, 1)]}
+        filename = write_circuits(circuit_lists, qubit_list, [])
+
+        full = Controller(filename, setup)
+        pruned = Controller(filename, setup, targets=['q0'])
+        assert pruned.qubits == ['q0']
+        assert pruned.adjust_gates['prep'][0] is None
+
+        results = []
+        for controller in [full, pruned]:
+            controller.apply_circuit(('prep', [0.5, 1.1]))
+            results.append(controller.get_expectation_values([{'q0': 'X'}]))
+        assert np.allclose(results[0], results[1])
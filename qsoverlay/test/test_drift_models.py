@@ -0,0 +1,141 @@
+from qsoverlay.circuit_builder import Builder
+from qsoverlay.DiCarlo_setup import quick_setup
+from qsoverlay.drift_models import DriftRule, OrnsteinUhlenbeck, RandomWalk
+from qsoverlay.random_streams import RandomStreams
+from qsoverlay.update_functions import (
+    register_update_rule, update_function_dic)
+import quantumsim.circuit
+import numpy as np
+
+
+def make_builder(update_rules=None):
+    setup = quick_setup(['q0', 'q1'], streams=RandomStreams(0))
+    if update_rules is not None:
+        setup.update_rules = update_rules
+    b = Builder(setup)
+    b.add_circuit_list([('RX', 'q0', 0.1), ('RZ', 'q1', 0.2),
+                        ('CZ', 'q0', 'q1'), ('RX', 'q0', 0.3),
+                        ('RY', 'q1', 0.4)])
+    b.finalize()
+    return b
+
+
+class TestDriftModels:
+
+    def test_processes(self):
+        random_state = np.random.RandomState(0)
+        model = OrnsteinUhlenbeck(mean=1, std=0.1, correlation_time=2)
+        values = [5]
+        for _ in range(20000):
+            values.append(model.step(values[-1], random_state))
+        assert abs(np.mean(values[100:]) - 1) < 0.01
+        assert abs(np.std(values[100:]) - 0.1) < 0.01
+
+        walk = RandomWalk(step_std=1, lower=0, upper=2)
+        values = [1]
+        for _ in range(1000):
+            values.append(walk.step(values[-1], random_state, dt=4))
+        assert min(values) == 0 and max(values) == 2
+
+    def test_drift_rule(self):
+        t1 = make_builder().qubit_dic['q0']['t1']
+        rule = DriftRule({
+            't1': OrnsteinUhlenbeck(t1, t1 / 10, 100),
+            ('dephasing_axis', 'q0'): RandomWalk(1e-4, lower=0),
+            'dephasing': RandomWalk(1e-4, lower=0)}, rtol=0)
+        assert rule.noise_params == ['dephasing', 'dephasing_axis', 't1']
+        register_update_rule('drift', rule)
+        try:
+            b = make_builder(['drift'])
+        finally:
+            del update_function_dic['drift']
+        waiting_gates = [gate for gate in b.circuit.gates
+                         if isinstance(gate, quantumsim.circuit.AmpPhDamp)]
+        assert waiting_gates
+        assert len(b.noise_gates[('dephasing_axis', 'q0')]) == 2
+
+        streams = RandomStreams(1)
+        for _ in range(3):
+            rule(b, streams=streams)
+
+        # Every refreshed gate matches a gate built from scratch
+        for gate in waiting_gates:
+            qubit = b.qubit_dic[gate.involved_qubits[0]]
+            new_gate = quantumsim.circuit.AmpPhDamp(
+                'q0', 0, gate.duration, qubit['t1'], qubit['t2'])
+            assert np.allclose(gate.ptm, new_gate.ptm)
+        for gate in b.noise_gates[('dephasing_axis', 'q0')]:
+            new_gate = quantumsim.circuit.RotateX(
+                'q0', 0, gate.angle,
+                dephasing_axis=b.qubit_dic['q0']['dephasing_axis'],
+                dephasing_angle=b.qubit_dic['q0']['dephasing_angle'])
+            assert np.allclose(gate.ptm, new_gate.ptm)
+        for gate in b.noise_gates[('dephasing', 'q1')]:
+            new_gate = quantumsim.circuit.RotateZ(
+                'q1', 0, gate.angle,
+                dephasing=b.qubit_dic['q1']['dephasing'])
+            assert np.allclose(gate.ptm, new_gate.ptm)
+
+    def test_tolerance(self):
+        b = make_builder()
+        rule = DriftRule({'t2': RandomWalk(1e-9)}, rtol=0.1)
+        register_update_rule('drift', rule)
+        try:
+            b.update_rules = ['drift']
+            b.update()
+            ptms = [gate.ptm for gate in b.noise_gates[('t2', 'q0')]]
+            t2 = b.noise_values[('t2', 'q0')]
+            for _ in range(100):
+                b.update()
+            # The drift stayed within the tolerance
+            assert b.noise_values[('t2', 'q0')] == t2
+            assert b.qubit_dic['q0']['t2'] != t2
+            assert all(gate.ptm is p for gate, p in zip(
+                b.noise_gates[('t2', 'q0')], ptms))
+        finally:
+            del update_function_dic['drift']
+
+    def test_streams(self):
+        values = []
+        for _ in range(2):
+            b = make_builder()
+            rule = DriftRule({'t1': RandomWalk(100, lower=1)})
+            streams = RandomStreams(3)
+            for _ in range(5):
+                rule(b, streams=streams)
+            values.append(b.qubit_dic['q1']['t1'])
+        assert values[0] == values[1]
+
+    def test_clamp_damping(self):
+        b = make_builder()
+        t1 = b.qubit_dic['q0']['t1']
+        # Steps far larger than t1 cross zero and 2 * t1 right away
+        rule = DriftRule({'t1': RandomWalk(10 * t1),
+                          't2': RandomWalk(10 * t1)}, rtol=0)
+        streams = RandomStreams(2)
+        for _ in range(20):
+            rule(b, streams=streams)
+            for qubit in b.circuit.qubits:
+                params = b.qubit_dic[qubit.name]
+                assert 0 < params['t1'] and 0 < params['t2']
+                assert params['t2'] <= 2 * params['t1']
+                assert (qubit.t1, qubit.t2) == (params['t1'], params['t2'])
+            for gate in b.circuit.gates:
+                if isinstance(gate, quantumsim.circuit.AmpPhDamp):
+                    assert 0 < gate.t1 and 0 < gate.t2
+                    assert gate.t2 <= 2 * gate.t1
+        # New resting gates accept the drifted values
+        b.add_gate('RX', ['q0'], angle=0.1)
+        b.finalize()
+
+    def test_registered_rotations(self):
+        # Rotations are only registered for parameters that drift
+        b = make_builder()
+        assert ('dephasing_axis', 'q0') not in b.noise_gates
+        assert ('dephasing', 'q1') not in b.noise_gates
+
+        def rule(builder, **kwargs):
+            pass
+
+        b = make_builder([rule])
+        assert len(b.noise_gates[('dephasing_axis', 'q0')]) == 2
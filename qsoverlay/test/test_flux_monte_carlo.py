@@ -0,0 +1,76 @@
+from qsoverlay.circuit_builder import Builder
+from qsoverlay.DiCarlo_setup import quick_setup
+from qsoverlay.flux_monte_carlo import (
+    MonteCarloStatistics, draw_flux, flux_gate_index, run_flux_monte_carlo)
+from qsoverlay.random_streams import RandomStreams
+from quantumsim.sparsedm import SparseDM
+import numpy as np
+
+
+class TestFluxMonteCarlo:
+
+    circuit_list = [
+        ('RY', 'q0', np.pi/2),
+        ('RY', 'q1', np.pi/2),
+        ('CZ', 'q0', 'q1'),
+        ('RX', 'q0', np.pi/2),
+        ('CZ', 'q1', 'q0')]
+
+    def test_statistics(self):
+        samples = np.random.RandomState(0).randn(50, 3) * (1 + 2j)
+        stats = MonteCarloStatistics(samples[:20])
+        stats.merge(MonteCarloStatistics(samples[20:]))
+        assert np.allclose(stats.mean, samples.mean(axis=0))
+        assert np.allclose(stats.std_error.real,
+                           samples.real.std(axis=0, ddof=1) / np.sqrt(50))
+        assert np.allclose(stats.std_error.imag,
+                           samples.imag.std(axis=0, ddof=1) / np.sqrt(50))
+        low, high = stats.confidence_interval(0.95)
+        assert np.allclose((high - low).real,
+                           2 * 1.959964 * stats.std_error.real)
+
+    def test_flux_monte_carlo(self):
+        setup = quick_setup(['q0', 'q1'], static_flux_std=0.3,
+                            high_frequency=True,
+                            streams=RandomStreams(0))
+        b = Builder(setup)
+        b.add_circuit_list(self.circuit_list)
+        b.finalize()
+        index = flux_gate_index(b.circuit)
+        assert sorted(index) == ['q0', 'q1']
+        assert [len(gates) for _, gates in sorted(index.items())] == [1, 1]
+
+        num_realizations = 12
+        results = [run_flux_monte_carlo(
+                       b.circuit, setup.qubit_dic, num_realizations,
+                       msmts=[{'q0': 'X'}, {'q1': 'Y'}],
+                       streams=RandomStreams(1), processes=processes,
+                       chunk_size=5)
+                   for processes in [None, 2]]
+        for key in ['density_matrix', 'expectation_values']:
+            assert results[0][key].count == num_realizations
+            assert np.allclose(results[0][key].mean, results[1][key].mean)
+            assert np.allclose(results[0][key].std_error,
+                               results[1][key].std_error)
+
+        # Compare to building the circuit for every realization
+        # (the flux is on the first qubit of a CZ)
+        flux = draw_flux(setup.qubit_dic, ['q0', 'q1'], num_realizations,
+                         RandomStreams(1))
+        dms = []
+        for realization in flux:
+            setup.gate_set[('CZ', 'q0', 'q1')][0]['quasistatic_flux'] =\
+                realization[0]
+            setup.gate_set[('CZ', 'q1', 'q0')][0]['quasistatic_flux'] =\
+                realization[1]
+            b = Builder(setup)
+            b.add_circuit_list(self.circuit_list)
+            b.finalize()
+            state = SparseDM(b.circuit.get_qubit_names())
+            b.circuit.apply_to(state)
+            dms.append(state.full_dm.to_array())
+        assert np.allclose(results[0]['density_matrix'].mean,
+                           np.mean(dms, axis=0))
+        assert np.allclose(results[0]['density_matrix'].std_error.real,
+                           np.std(np.real(dms), axis=0, ddof=1) /
+                           np.sqrt(num_realizations))
@@ -0,0 +1,231 @@
+import pytest
+from qsoverlay.measurement_models import (
+    ClusteredMeasurement, CorrelatedMeasurement, histogram, kron_apply,
+    pack_shots, packed_parities, project_to_simplex)
+import numpy as np
+
+
+def random_cc_matrix(num_qubits, random_state):
+    cc_matrix = np.eye(2**num_qubits) +\
+        0.05 * random_state.rand(2**num_qubits, 2**num_qubits)
+    return cc_matrix / cc_matrix.sum(axis=0)
+
+
+class TestCorrelatedMeasurement:
+
+    def test_pop_matrix(self):
+        random_state = np.random.RandomState(0)
+        populations = [0.01, 0.05, 0.1]
+        cc_matrix = random_cc_matrix(3, random_state)
+        model = CorrelatedMeasurement(['q0', 'q1', 'q2'], cc_matrix,
+                                      populations, random_state)
+
+        pop_matrix = np.zeros([8, 8])
+        for j in range(8):
+            for k in range(8):
+                pop_matrix[j, k] = np.prod([
+                    populations[n] if (j ^ k) >> n & 1
+                    else 1 - populations[n] for n in range(3)])
+        assert np.allclose(model.cc_matrix,
+                           cc_matrix @ np.linalg.inv(pop_matrix))
+
+        vectors = random_state.rand(5, 8)
+        assert np.allclose(kron_apply(model.pop_factors, vectors),
+                           vectors @ pop_matrix.T)
+
+    def test_sample_shots(self):
+        qubits = ['q0', 'q1', 'q2']
+        random_state = np.random.RandomState(0)
+        probabilities = random_state.rand(8)
+        probabilities /= probabilities.sum()
+        # The outcomes as given by SparseDM.peak_multiple_measurements
+        rho_dist = [({'q0': j & 1, 'q1': j >> 1 & 1, 'q2': j >> 2}, p)
+                    for j, p in enumerate(probabilities)]
+        model = CorrelatedMeasurement(
+            qubits, random_cc_matrix(3, random_state), [0.01, 0.02, 0.03],
+            np.random.RandomState(1))
+        assert np.allclose(model.rho_vector(rho_dist), probabilities)
+
+        M_vec = model.cc_matrix @ probabilities
+        expected = np.random.RandomState(1).choice(8, size=100, p=M_vec)
+        shots = model.sample(rho_dist, 100)
+        assert shots.shape == (100, 3) and shots.dtype == np.uint8
+        assert np.array_equal(shots @ [1, 2, 4], expected)
+
+        model.random_state = np.random.RandomState(1)
+        packed = model.sample(rho_dist, 100, packed=True)
+        assert packed.dtype == np.uint64
+        assert np.array_equal(packed, expected[:, None])
+
+        model.random_state = np.random.RandomState(1)
+        parities = model.sample(rho_dist, 100,
+                                output_format=[[0], [0, 2], [0, 1, 2]])
+        assert np.array_equal(parities, np.array([
+            shots[:, 0], shots[:, 0] ^ shots[:, 2],
+            shots[:, 0] ^ shots[:, 1] ^ shots[:, 2]]).T)
+
+    def test_mitigate(self):
+        random_state = np.random.RandomState(4)
+        model = CorrelatedMeasurement(
+            ['q0', 'q1'], random_cc_matrix(2, random_state), [0.01, 0.02],
+            random_state)
+        rho_vecs = random_state.rand(10, 4)
+        rho_vecs /= rho_vecs.sum(axis=1, keepdims=True)
+        M_vecs = rho_vecs @ model.cc_matrix.T
+        assert np.allclose(model.mitigate(M_vecs, project=False), rho_vecs)
+        assert np.allclose(model.mitigate(1000 * M_vecs), rho_vecs)
+        assert np.allclose(model.unfold(M_vecs),
+                           M_vecs @ np.linalg.inv(model.cc_matrix).T)
+
+        # Marginals are taken from the mitigated distributions, but
+        # cannot be mitigated themselves
+        output_format = [[0], [0, 1]]
+        assert np.allclose(
+            model.mitigate(M_vecs, output_format=output_format),
+            rho_vecs @ model.output_table(output_format).T)
+        averages = model.sample([({'q0': 1, 'q1': 0}, 1)], 1,
+                                data_type='averages',
+                                output_format=output_format)
+        with pytest.raises(ValueError):
+            model.mitigate(averages)
+
+        shots = model.sample([({'q0': 1, 'q1': 0}, 1)], 1000)
+        estimate = model.mitigate(histogram(shots), project=True)
+        assert np.all(estimate >= 0) and np.isclose(estimate.sum(), 1)
+        assert estimate[1] > 0.95
+
+    def test_pack_shots(self):
+        shots = np.random.RandomState(5).randint(2, size=(20, 130))
+        packed = pack_shots(shots)
+        assert packed.dtype == np.uint64 and packed.shape == (20, 3)
+        for n in range(130):
+            bits = (packed[:, n // 64] >> np.uint64(n % 64)) & np.uint64(1)
+            assert np.array_equal(bits, shots[:, n])
+        output_format = [[0, 64, 129], [5], []]
+        assert np.array_equal(
+            packed_parities(packed, output_format),
+            np.array([shots[:, indices].sum(axis=1) % 2
+                      for indices in output_format]).T)
+
+    def test_project_to_simplex(self):
+        random_state = np.random.RandomState(5)
+        vectors = random_state.randn(20, 6)
+        projections = project_to_simplex(vectors)
+        assert np.all(projections >= 0)
+        assert np.allclose(projections.sum(axis=1), 1)
+        # The projection is closer than other distributions
+        for vector, projection in zip(vectors, projections):
+            others = random_state.dirichlet(np.ones(6), size=100)
+            assert np.all(np.linalg.norm(others - vector, axis=1) >=
+                          np.linalg.norm(projection - vector))
+        distribution = random_state.dirichlet(np.ones(6))
+        assert np.allclose(project_to_simplex(distribution), distribution)
+
+    def test_averages(self):
+        random_state = np.random.RandomState(6)
+        model = CorrelatedMeasurement(
+            ['q0', 'q1', 'q2'], random_cc_matrix(3, random_state),
+            [0, 0, 0], random_state)
+        probabilities = random_state.rand(8)
+        probabilities /= probabilities.sum()
+        rho_dist = [({'q0': j & 1, 'q1': j >> 1 & 1, 'q2': j >> 2}, p)
+                    for j, p in enumerate(probabilities)]
+        output_format = [[0], [2], [0, 1], [0, 1, 2], []]
+        M_vec = model.sample(rho_dist, 1, data_type='averages')
+
+        averages = model.sample(rho_dist, 1, data_type='averages',
+                                output_format=output_format)
+        expected = [sum(M_vec[j] for j in range(8)
+                        if all(j >> n & 1 for n in indices))
+                    for indices in output_format]
+        assert np.allclose(averages, expected)
+        assert len(model._output_tables) == 1
+
+        # Bits beyond the highest set bit of j are not set
+        assert not CorrelatedMeasurement.indices_in_j([2], 1)
+        assert not CorrelatedMeasurement.indices_in_j([0], 0)
+        assert CorrelatedMeasurement.indices_in_j([0, 2], 7)
+
+
+class TestClusteredMeasurement:
+
+    def test_measurement_vector(self):
+        random_state = np.random.RandomState(2)
+        qubits = ['q0', 'q1', 'q2']
+        populations = [0.01, 0.02, 0.03]
+        cc_02 = random_cc_matrix(2, random_state)
+        cc_1 = random_cc_matrix(1, random_state)
+        model = ClusteredMeasurement(
+            qubits, [(['q0', 'q2'], cc_02), (['q1'], cc_1)], populations,
+            random_state)
+
+        # The same model with the full cc matrix
+        cc_matrix = np.zeros([8, 8])
+        for j in range(8):
+            for k in range(8):
+                cc_matrix[j, k] = cc_02[(j & 1) | (j >> 2) << 1,
+                                        (k & 1) | (k >> 2) << 1] *\
+                    cc_1[j >> 1 & 1, k >> 1 & 1]
+        full_model = CorrelatedMeasurement(qubits, cc_matrix, populations,
+                                           random_state)
+
+        rho_vecs = random_state.rand(4, 8)
+        assert np.allclose(model.measurement_vector(rho_vecs),
+                           rho_vecs @ full_model.cc_matrix.T)
+        M_vecs = model.measurement_vector(rho_vecs)
+        assert np.allclose(model.mitigate(M_vecs),
+                           full_model.mitigate(M_vecs))
+
+        rho_dist = [({'q0': j & 1, 'q1': j >> 1 & 1, 'q2': j >> 2}, p)
+                    for j, p in enumerate(rho_vecs[0] / rho_vecs[0].sum())]
+        assert np.allclose(
+            model.sample(rho_dist, 1, data_type='averages'),
+            full_model.sample(rho_dist, 1, data_type='averages'))
+        output_format = [[0], [1, 2], [0, 1, 2], []]
+        assert np.allclose(
+            model.sample(rho_dist, 1, data_type='averages',
+                         output_format=output_format),
+            full_model.sample(rho_dist, 1, data_type='averages',
+                              output_format=output_format))
+
+    def test_sample_shots(self):
+        qubits = ['q{}'.format(n) for n in range(60)]
+        cc_matrix = np.array([[0.9, 0.2, 0.1, 0],
+                              [0.05, 0.7, 0, 0.1],
+                              [0.05, 0, 0.8, 0.1],
+                              [0, 0.1, 0.1, 0.8]])
+        clusters = [(qubits[n:n+2], cc_matrix) for n in range(0, 60, 2)]
+        model = ClusteredMeasurement(qubits, clusters, [0] * 60,
+                                     np.random.RandomState(3))
+
+        # Every pair of qubits starts out in 01
+        outcome = {qubit: n % 2 for n, qubit in enumerate(qubits)}
+        shots = model.sample([(outcome, 1)], 2000)
+        assert shots.shape == (2000, 60)
+        results = shots[:, 0::2] + 2 * shots[:, 1::2]
+        frequencies = np.bincount(results.reshape(-1), minlength=4) /\
+            results.size
+        assert np.allclose(frequencies, cc_matrix[:, 2], atol=0.01)
+
+        model.random_state = np.random.RandomState(4)
+        shots = model.sample([(outcome, 1)], 10)
+        model.random_state = np.random.RandomState(4)
+        packed = model.sample([(outcome, 1)], 10, packed=True)
+        assert packed.dtype == np.uint64 and packed.shape == (10, 1)
+        assert np.array_equal(packed, pack_shots(shots))
+        assert np.array_equal(
+            (packed >> np.arange(60, dtype=np.uint64)) & np.uint64(1), shots)
+
+        model.random_state = np.random.RandomState(4)
+        parities = model.sample([(outcome, 1)], 10,
+                                output_format=[[0, 1], [2]])
+        assert parities.shape == (10, 2) and parities.dtype == int
+        assert np.array_equal(parities[:, 0], shots[:, 0] ^ shots[:, 1])
+        assert np.array_equal(parities[:, 1], shots[:, 2])
+
+        # Averages only use the clusters they involve
+        averages = model.sample([(outcome, 1)], 1, data_type='averages',
+                                output_format=[[0], [1], [0, 59]])
+        assert np.allclose(averages, [0.1, 0.9, 0.09])
+        with pytest.raises(ValueError):
+            model.sample([(outcome, 1)], 1, data_type='averages')
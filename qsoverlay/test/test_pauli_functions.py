@@ -0,0 +1,90 @@
+import pytest
+import itertools
+
+from qsoverlay.pauli_functions import (
+    allocate_shots, expectation_values, pauli_expectation_dense,
+    pauli_expectation_ptm, qubitwise_commuting_groups,
+    sample_expectation_values)
+from quantumsim.sparsedm import SparseDM
+from quantumsim import ptm
+import numpy as np
+
+paulis = {'I': np.eye(2),
+          'X': np.array([[0, 1], [1, 0]]),
+          'Y': np.array([[0, -1j], [1j, 0]]),
+          'Z': np.diag([1, -1])}
+
+
+def random_state(names, classical=(), seed=0):
+    random_state = np.random.RandomState(seed)
+    state = SparseDM(names + list(classical))
+    for name in names:
+        state.ensure_dense(name)
+    for _ in range(3):
+        for name in names:
+            state.apply_ptm(name, ptm.rotate_x_ptm(random_state.rand() * 3))
+            state.apply_ptm(name, ptm.rotate_y_ptm(random_state.rand() * 3))
+            state.apply_ptm(name, ptm.amp_ph_damping_ptm(0.1, 0.05))
+        for name0, name1 in zip(names[:-1], names[1:]):
+            state.cphase(name0, name1)
+    state.apply_all_pending()
+    return state
+
+
+def kron_expectation(dm, labels):
+    op = paulis[labels[0]]
+    for label in labels[1:]:
+        op = np.kron(paulis[label], op)
+    return np.real(np.trace(op @ dm))
+
+
+class TestPauliFunctions:
+
+    def test_pauli_strings(self):
+        state = random_state(['a', 'b', 'c'])
+        dense_dm = state.full_dm.to_array()
+        for labels in itertools.product('IXYZ', repeat=3):
+            expected = kron_expectation(dense_dm, labels)
+            assert np.isclose(
+                pauli_expectation_ptm(state.full_dm.dm, labels), expected)
+            assert np.isclose(
+                pauli_expectation_dense(dense_dm, labels), expected)
+
+    def test_expectation_values(self):
+        state = random_state(['a', 'b'], classical=['m'])
+        state.classical['m'] = 1
+
+        dense_dm = state.full_dm.to_array()
+        msmts = [{'a': 'X'}, {'a': 'Z', 'b': 'Y'}, {'b': 'X', 'm': 'Z'},
+                 {'a': 'Y', 'm': 'X'}, {}]
+        expected = [kron_expectation(dense_dm, ['X', 'I']),
+                    kron_expectation(dense_dm, ['Z', 'Y']),
+                    -kron_expectation(dense_dm, ['I', 'X']),
+                    0, 1]
+        assert np.allclose(expectation_values(state, msmts), expected)
+
+    def test_commuting_groups(self):
+        msmts = [{'a': 'X'}, {'a': 'Z', 'b': 'Z'}, {'a': 'X', 'b': 'Y'},
+                 {'b': 'Z'}, {'a': 1, 'b': 'Y'}]
+        groups = qubitwise_commuting_groups(msmts, [1, 3, 1, 2, 1])
+        assert groups == [({'a': 'Z', 'b': 'Z'}, [1, 3]),
+                          ({'a': 'X', 'b': 'Y'}, [0, 2, 4])]
+        assert list(allocate_shots([5, 3], 100)) == [62, 38]
+        assert list(allocate_shots([1, 0], 10)) == [9, 1]
+        for weights in [[1, 0, 0], [0.2, 0.3, 0.5], [0, 0, 0]]:
+            assert allocate_shots(weights, 11).sum() == 11
+        with pytest.raises(ValueError):
+            allocate_shots([1, 1, 1], 2)
+
+    def test_sample_expectation_values(self):
+        state = random_state(['a', 'b'], classical=['m'])
+        state.classical['m'] = 1
+        msmts = [{'a': 'X'}, {'a': 'Z', 'b': 'Y'}, {'b': 'X', 'm': 'Z'},
+                 {'a': 'Y', 'm': 'X'}, {'a': 'Y', 'b': 'Y'}]
+        exact = expectation_values(state, msmts)
+        estimates = sample_expectation_values(
+            state, msmts, 100000, [1, 2, 1, 1, 1],
+            np.random.RandomState(4))
+        assert np.allclose(estimates, exact, atol=0.03)
+        # The state is unchanged
+        assert np.allclose(expectation_values(state, msmts), exact)
@@ -0,0 +1,49 @@
+from qsoverlay.random_streams import RandomStreams
+from qsoverlay.DiCarlo_setup import quick_setup
+from qsoverlay.circuit_builder import Builder
+import numpy as np
+
+
+class TestRandomStreams:
+
+    def test_named_streams(self):
+        s0 = RandomStreams(3)
+        s1 = RandomStreams(3)
+        # Streams only depend on the seed and the name
+        a = s0.random_state('sampler', 'q0').rand(5)
+        s0.random_state('sampler', 'q1').rand(5)
+        s1.random_state('sampler', 'q1').rand(5)
+        assert np.allclose(s1.random_state('sampler', 'q0').rand(5), a)
+        assert not np.allclose(s0.random_state('sampler', 'q1').rand(5),
+                               s0.random_state('sampler', 'q0').rand(5))
+        assert not np.allclose(RandomStreams(4).random_state(
+            'sampler', 'q0').rand(5), a)
+
+        # Reseeding works in place
+        random_state = s0.random_state('sampler', 'q0')
+        s0.reseed(3)
+        assert np.allclose(random_state.rand(5), a)
+
+        child = s0.child('worker', 2)
+        assert np.allclose(child.random_state('x').rand(3),
+                           s1.child('worker', 2).random_state('x').rand(3))
+
+    def test_setup_streams(self):
+        qubit_list = ['q0', 'q1']
+        setups = [quick_setup(qubit_list, static_flux_std=0.1,
+                              streams=RandomStreams(seed))
+                  for seed in [1, 1, 2]]
+        fluxes = [[setup.qubit_dic[q]['quasistatic_flux']
+                   for q in qubit_list] for setup in setups]
+        assert fluxes[0] == fluxes[1]
+        assert fluxes[0] != fluxes[2]
+        assert fluxes[0][0] != fluxes[0][1]
+
+        # The update rule draws new flux from the streams of the qubits
+        builders = [Builder(setup) for setup in setups[:2]]
+        for b, seed in zip(builders, [5, 5]):
+            b.update(streams=RandomStreams(seed))
+        assert [b.qubit_dic['q0']['quasistatic_flux']
+                for b in builders] == [
+            0.1 * RandomStreams(5).random_state(
+                'quasistatic_flux', 'q0').randn()] * 2
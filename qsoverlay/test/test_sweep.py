@@ -0,0 +1,47 @@
+import pytest
+
+from qsoverlay.experiment_controller import Controller
+from qsoverlay.DiCarlo_setup import quick_setup
+from qsoverlay.sweep import run_sweep
+from qsoverlay.test.test_controller import write_circuits
+import numpy as np
+
+
+class TestSweep:
+
+    def test_run_sweep(self):
+        qubit_list = ['q0', 'q1']
+        with pytest.warns(UserWarning):
+            # We did not provide any seed
+            setup = quick_setup(qubit_list)
+        circuit_lists = {
+            'prep': [('RY', 'q1', np.pi/2)],
+            'ansatz': [
+                ('RY', 'q0', 0, True),
+                ('CZ', 'q0', 'q1'),
+                ('RX', 'q1', 0, True)]}
+        filename = write_circuits(circuit_lists, qubit_list, [])
+        msmts = [{'q0': 'Z'}, {'q0': 'X', 'q1': 'Y'}, {'q1': 'Z'}]
+        points = np.random.RandomState(2).rand(7, 2) * np.pi
+
+        controller = Controller(filename, setup)
+        expected = []
+        for point in points:
+            controller.make_state()
+            controller.apply_circuit_list(['prep', ('ansatz', *point)])
+            expected.append(controller.get_expectation_values(msmts))
+
+        results = run_sweep(filename, setup, points, ['prep', 'ansatz'],
+                            'ansatz', msmts)
+        assert results.shape == (7, 3)
+        assert np.allclose(results, expected)
+
+        # Sampled results only depend on the seed
+        sampled = [
+            run_sweep(filename, setup, points, ['prep', 'ansatz'],
+                      'ansatz', msmts, num_repetitions=100, seed=5,
+                      processes=processes, chunk_size=2)
+            for processes in [None, 2]]
+        assert np.allclose(sampled[0], sampled[1])
+        assert not np.allclose(sampled[0], expected)
+        assert np.allclose(sampled[0], expected, atol=0.5)
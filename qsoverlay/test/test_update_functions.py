@@ -0,0 +1,59 @@
+import pytest
+
+from qsoverlay.circuit_builder import Builder
+from qsoverlay.DiCarlo_setup import quick_setup
+from qsoverlay.random_streams import RandomStreams
+from qsoverlay.update_functions import (
+    register_update_rule, update_function_dic)
+from quantumsim import ptm
+import numpy as np
+
+
+class TestUpdateFunctions:
+
+    def test_update_quasistatic_flux(self):
+        setup = quick_setup(['q0', 'q1'], static_flux_std=0.3,
+                            high_frequency=True, streams=RandomStreams(0))
+        b = Builder(setup)
+        b.add_circuit_list([('CZ', 'q0', 'q1'), ('RX', 'q0', 0.1),
+                            ('CZ', 'q1', 'q0'), ('CZ', 'q0', 'q1')])
+        assert sorted(key for key in b.noise_gates
+                      if key[0] == 'quasistatic_flux') ==\
+            [('quasistatic_flux', 'q0'), ('quasistatic_flux', 'q1')]
+        assert len(b.noise_gates[('quasistatic_flux', 'q0')]) == 2
+        flux_gates = [g for g in b.circuit.gates
+                      if getattr(g, 'quasistatic_flux_flag', False)]
+        assert len(flux_gates) == 3
+
+        fork = b.fork()
+        fork.update(streams=RandomStreams(1))
+        for qubit in ['q0', 'q1']:
+            flux = fork.qubit_dic[qubit]['quasistatic_flux']
+            assert flux == 0.3 * RandomStreams(1).random_state(
+                'quasistatic_flux', qubit).randn()
+            for gate in fork.noise_gates[('quasistatic_flux', qubit)]:
+                assert np.allclose(gate.ptm, ptm.rotate_z_ptm(flux))
+            # The gates of the parent are not changed
+            for gate in b.noise_gates[('quasistatic_flux', qubit)]:
+                assert not np.allclose(gate.ptm, ptm.rotate_z_ptm(flux))
+
+    def test_register_update_rule(self):
+        with pytest.warns(UserWarning):
+            # We did not provide any seed
+            setup = quick_setup(['q0'])
+
+        def scale_t1(builder, factor=1, **kwargs):
+            for qubit in builder.qubit_dic.values():
+                qubit['t1'] *= factor
+
+        register_update_rule('scale_t1', scale_t1)
+        try:
+            with pytest.raises(ValueError):
+                register_update_rule('scale_t1', lambda builder: None)
+            setup.update_rules = ['scale_t1']
+            b = Builder(setup)
+            t1 = b.qubit_dic['q0']['t1']
+            b.update(factor=2)
+            assert b.qubit_dic['q0']['t1'] == 2 * t1
+        finally:
+            del update_function_dic['scale_t1']
@@ -1,34 +1,66 @@
 '''
 Update functions: functions to update a quantumsim circuit
 (for instance, between experiments to account for fluctuating noise).
+
+Every update rule is called as rule(builder, **kwargs). The gates that
+depend on a noise parameter of a qubit are registered with the builder
+when they are inserted (see Builder.register_noise_gate), so a rule
+only needs to look up builder.claim_noise_gates(parameter, qubit)
+(which copies gates shared with a fork of the builder before the rule
+changes them, see Builder.fork).
+New rules are added with register_update_rule (see for instance
+drift_models.DriftRule, which lets noise parameters drift slowly).
 '''
-from quantumsim import ptm
 import numpy as np
 
-def update_quasistatic_flux(builder, **kwargs):
+
+def update_quasistatic_flux(builder, streams=None, **kwargs):
 
     '''
     Puts new quasistatic flux for 2 qubit gates
+
+    streams: a RandomStreams to draw the flux of each qubit from
+        (from the stream ('quasistatic_flux', qubit)); by default
+        the global numpy generator is used.
     '''
 
     qubit_dic = builder.qubit_dic
-    circuit = builder.circuit
-
-    for qubit in qubit_dic:
-        if qubit['static_flux_std'] is not None:
 
+    for name, qubit in qubit_dic.items():
+        if qubit.get('static_flux_std') is not None:
+            if streams is None:
+                random_state = np.random
+            else:
+                random_state = streams.random_state('quasistatic_flux', name)
             qubit['quasistatic_flux'] =\
-                qubit['static_flux_std'] * np.random.randn()
+                qubit['static_flux_std'] * random_state.randn()
+
+            for gate in builder.claim_noise_gates('quasistatic_flux', name):
+                gate.adjust(qubit['quasistatic_flux'])
+
+
+# The noise parameters the rule changes (see Builder.get_dispatch)
+update_quasistatic_flux.noise_params = ('quasistatic_flux',)
 
-    for gate in circuit.gates:
-        try:
-            if gate.quasistatic_flux_flag is True:
-                qubit = qubit_dic[gate.involved_qubits[0]]
-                new_ptm = ptm.rotate_z_ptm(qubit['quasistatic_flux'])
-                gate.ptm = new_ptm
-        except:
-            pass
 
 update_function_dic = {
     'update_quasistatic_flux': update_quasistatic_flux
 }
+
+
+def register_update_rule(name, function):
+    '''
+    Makes an update rule available under a name, so that it can be
+    listed in the update_rules of a setup. The function is called
+    as function(builder, **kwargs) on every Builder.update.
+
+    A function with a noise_params attribute (a list of the noise
+    parameters it changes, as DriftRule.noise_params) only gets the
+    rotations depending on these parameters in builder.noise_gates;
+    otherwise every noisy rotation is registered.
+    '''
+    if name in update_function_dic and\
+            update_function_dic[name] is not function:
+        raise ValueError('An update rule named {} already exists'
+                         .format(name))
+    update_function_dic[name] = function